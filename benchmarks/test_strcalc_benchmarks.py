@@ -0,0 +1,108 @@
+"""Benchmarks for `strcalc` module.
+
+Run with ``tox -e benchmark``. To compare two states of the code on the same machine,
+store a run of the first with ``tox -e benchmark -- --benchmark-save=baseline benchmarks``
+and compare the second against it with
+``tox -e benchmark -- --benchmark-compare --benchmark-compare-fail=mean:25% benchmarks``.
+Saved runs are machine specific and not committed.
+"""
+
+from typing import Any, Callable
+
+import pytest
+
+from formelsammlung.strcalc import (
+    StringCalculator,
+    calculate_many,
+    calculate_string,
+    compile_expression,
+)
+
+
+Benchmark = Callable[..., Any]
+
+#: Expressions representative for the different kinds of input.
+EXPRESSIONS = {
+    "simple": "(1 + 2) / 3",
+    "variables": "a * (b + 1) - a / (b - 2)",
+    "functions": "sqrt(a * a + b * b) + max(a, b) ** 0.5",
+    "conditions": "a / b if b != 0 and 0 < a < 10 else -a",
+    "script": "base = a * b; base + base ** 2 - a",
+    "complex": "(1 + 2j) * (a - 3j) ** 2 / (b + 1j)",
+    "big_integers": "a ** 300 * b ** 200 // 7 ** 100",
+    "deep_sum": "+".join(["a"] * 500),
+    "deep_power": "(a - 2) ** " * 300 + "b",
+}
+VARIABLES = {"a": 3, "b": 4}
+
+
+@pytest.mark.parametrize("name", list(EXPRESSIONS))
+def test_parse(benchmark: Benchmark, name: str) -> None:
+    """Benchmark parsing and compiling without cache."""
+    calculator = StringCalculator(cache_size=0)
+
+    benchmark(calculator.compile, EXPRESSIONS[name])
+
+
+@pytest.mark.parametrize("parser", ["auto", "ast"])
+@pytest.mark.parametrize("name", ["simple", "variables"])
+def test_parse_parser(benchmark: Benchmark, name: str, parser: str) -> None:
+    """Benchmark compiling short formulas with the fast path parser and the ast path."""
+    calculator = StringCalculator(cache_size=0, parser=parser)
+
+    benchmark(calculator.compile, EXPRESSIONS[name])
+
+
+@pytest.mark.parametrize("name", list(EXPRESSIONS))
+def test_evaluate(benchmark: Benchmark, name: str) -> None:
+    """Benchmark evaluating a compiled expression."""
+    compiled = compile_expression(EXPRESSIONS[name])
+
+    benchmark(compiled.evaluate, VARIABLES)
+
+
+@pytest.mark.parametrize("name", list(EXPRESSIONS))
+def test_to_function(benchmark: Benchmark, name: str) -> None:
+    """Benchmark calling the native function of a compiled expression."""
+    compiled = compile_expression(EXPRESSIONS[name])
+    function = compiled.to_function()
+
+    benchmark(function, *(VARIABLES[variable] for variable in compiled.names))
+
+
+@pytest.mark.parametrize("name", ["simple", "variables", "functions"])
+def test_calculate_string_cached(benchmark: Benchmark, name: str) -> None:
+    """Benchmark the hot path of `calculate_string` with a cache hit."""
+    calculate_string(EXPRESSIONS[name], VARIABLES)
+
+    benchmark(calculate_string, EXPRESSIONS[name], VARIABLES)
+
+
+def test_evaluate_many(benchmark: Benchmark) -> None:
+    """Benchmark evaluating a compiled expression for many rows."""
+    compiled = compile_expression(EXPRESSIONS["variables"])
+    rows = [{"a": a, "b": b} for a in range(100) for b in range(3, 13)]
+
+    benchmark(compiled.evaluate_many, rows)
+
+
+def test_evaluate_columns(benchmark: Benchmark) -> None:
+    """Benchmark evaluating a compiled expression over columns."""
+    compiled = compile_expression(EXPRESSIONS["variables"])
+    columns = {"a": list(range(1000)), "b": [b % 10 + 3 for b in range(1000)]}
+
+    benchmark(compiled.evaluate_columns, columns)
+
+
+def test_calculate_many(benchmark: Benchmark) -> None:
+    """Benchmark parsing and calculating many expressions on a thread pool."""
+    expressions = [f"{num} * (2 + {num}) ** 2" for num in range(1000)]
+    calculator = StringCalculator(cache_size=0)
+
+    def _calculate() -> None:
+        for _ in calculate_many(
+            expressions, workers=2, executor="thread", chunksize=100, calculator=calculator
+        ):
+            pass
+
+    benchmark(_calculate)
@@ -1,78 +1,4033 @@
 """Calculate arithmetic expressions from strings."""
 
 import ast
+import cmath
+import contextlib
+import decimal
+import fractions
+import functools
+import heapq
+import io
+import itertools
+import keyword
+import marshal
+import math
 import operator
+import os
+import re
+import struct
 import sys
-from typing import Optional, Union
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from formelsammlung import __version__
+
+if TYPE_CHECKING:  # pragma: no cover
+    import mmap
+    import multiprocessing.connection
+    import multiprocessing.context
+    import multiprocessing.process
+    import sqlite3
+    from concurrent.futures import Executor, Future
 
 
 NumberType = Union[int, float, complex]
 NUMBERTYPES = (int, float, complex)
 
+#: Binary operators supported by the calculator.
+_BINARY_OPERATORS: Dict[type, Callable[..., Any]] = {
+    ast.Add: operator.add,  #: a + b
+    ast.Sub: operator.sub,  #: a - b
+    ast.Mult: operator.mul,  #: a * b
+    ast.Pow: operator.pow,  #: a ** b
+    ast.Div: operator.truediv,  #: a / b
+    ast.FloorDiv: operator.floordiv,  #: a // b
+    ast.Mod: operator.mod,  #: a % b
+    ast.LShift: operator.lshift,  #: a << b
+    ast.RShift: operator.rshift,  #: a >> b
+    ast.BitAnd: operator.and_,  #: a & b
+    ast.BitOr: operator.or_,  #: a | b
+    ast.BitXor: operator.xor,  #: a ^ b
+    ast.MatMult: operator.matmul,  #: a @ b
+}
+#: Unary operators supported by the calculator.
+_UNARY_OPERATORS: Dict[type, Callable[..., Any]] = {
+    ast.UAdd: operator.pos,  #: + a
+    ast.USub: operator.neg,  #: - a
+    ast.Not: operator.not_,  #: not a
+    ast.Invert: operator.invert,  #: ~ a
+}
+#: Comparison operators supported by the calculator.
+_COMPARE_OPERATORS: Dict[type, Callable[..., Any]] = {
+    ast.Eq: operator.eq,  #: a == b
+    ast.NotEq: operator.ne,  #: a != b
+    ast.Lt: operator.lt,  #: a < b
+    ast.LtE: operator.le,  #: a <= b
+    ast.Gt: operator.gt,  #: a > b
+    ast.GtE: operator.ge,  #: a >= b
+}
+
+#: Bitwise operators ``<<``, ``>>``, ``&``, ``|``, ``^`` and ``~``.
+BITWISE_OPERATORS: FrozenSet[Callable[..., Any]] = frozenset(
+    (operator.lshift, operator.rshift, operator.and_, operator.or_, operator.xor, operator.invert)
+)
+#: All operators which can be enabled.
+ALL_OPERATORS: FrozenSet[Callable[..., Any]] = frozenset(
+    itertools.chain(
+        _BINARY_OPERATORS.values(), _UNARY_OPERATORS.values(), _COMPARE_OPERATORS.values()
+    )
+)
+#: Operators enabled unless configured otherwise: arithmetic, comparisons and ``not``.
+DEFAULT_OPERATORS = ALL_OPERATORS - BITWISE_OPERATORS - {operator.matmul}
+
+#: Functions callable by name in expressions unless configured otherwise.
+DEFAULT_FUNCTIONS: Mapping[str, Callable[..., Any]] = MappingProxyType(
+    {
+        "abs": abs,
+        "max": max,
+        "min": min,
+        "round": round,
+        **{
+            name: getattr(math, name)
+            for name in (
+                "acos",
+                "acosh",
+                "asin",
+                "asinh",
+                "atan",
+                "atan2",
+                "atanh",
+                "ceil",
+                "copysign",
+                "cos",
+                "cosh",
+                "degrees",
+                "exp",
+                "fabs",
+                "floor",
+                "fmod",
+                "hypot",
+                "log",
+                "log10",
+                "log2",
+                "radians",
+                "sin",
+                "sinh",
+                "sqrt",
+                "tan",
+                "tanh",
+                "trunc",
+            )
+        },
+        "phase": cmath.phase,
+        "rect": cmath.rect,
+    }
+)
+#: Functions without side effects whose calls with constant arguments are folded.
+_PURE_FUNCTIONS = frozenset(DEFAULT_FUNCTIONS.values())
+
+#: Symbols and precedences of the operators for creating expression strings.
+_OPERATOR_SYMBOLS = {
+    operator.not_: ("not ", 3),
+    operator.eq: ("==", 4),
+    operator.ne: ("!=", 4),
+    operator.lt: ("<", 4),
+    operator.le: ("<=", 4),
+    operator.gt: (">", 4),
+    operator.ge: (">=", 4),
+    operator.or_: ("|", 5),
+    operator.xor: ("^", 6),
+    operator.and_: ("&", 7),
+    operator.lshift: ("<<", 8),
+    operator.rshift: (">>", 8),
+    operator.add: ("+", 9),
+    operator.sub: ("-", 9),
+    operator.mul: ("*", 10),
+    operator.matmul: ("@", 10),
+    operator.truediv: ("/", 10),
+    operator.floordiv: ("//", 10),
+    operator.mod: ("%", 10),
+    operator.pos: ("+", 11),
+    operator.neg: ("-", 11),
+    operator.invert: ("~", 11),
+    operator.pow: ("**", 12),
+}
+_ATOM_PRECEDENCE = 13
+_COMPARE_PRECEDENCE = 4
+_IF_PRECEDENCE = 0
+
+#: Maximum estimated bit length of an integer power for constant folding.
+_FOLD_MAX_BITS = 4096
+#: Bit length assumed for variables and inexact constants in the cost estimate.
+_COST_VALUE_BITS = 64
+#: Maximum estimated bit length of an integer result counted as cheap in the cost.
+_CHEAP_BITS = 4096
+
+#: Names of the NumPy ufuncs used by the ``numpy`` engine for the operators.
+_NUMPY_UFUNCS = {
+    operator.add: "add",
+    operator.sub: "subtract",
+    operator.mul: "multiply",
+    operator.pow: "power",
+    operator.truediv: "true_divide",
+    operator.floordiv: "floor_divide",
+    operator.mod: "mod",
+    operator.pos: "positive",
+    operator.neg: "negative",
+    operator.eq: "equal",
+    operator.ne: "not_equal",
+    operator.lt: "less",
+    operator.le: "less_equal",
+    operator.gt: "greater",
+    operator.ge: "greater_equal",
+    operator.not_: "logical_not",
+    operator.lshift: "left_shift",
+    operator.rshift: "right_shift",
+    operator.and_: "bitwise_and",
+    operator.or_: "bitwise_or",
+    operator.xor: "bitwise_xor",
+    operator.invert: "invert",
+    operator.matmul: "matmul",
+    abs: "absolute",
+    math.acos: "arccos",
+    math.acosh: "arccosh",
+    math.asin: "arcsin",
+    math.asinh: "arcsinh",
+    math.atan: "arctan",
+    math.atan2: "arctan2",
+    math.atanh: "arctanh",
+    math.copysign: "copysign",
+    math.cos: "cos",
+    math.cosh: "cosh",
+    math.degrees: "degrees",
+    math.exp: "exp",
+    math.fabs: "fabs",
+    math.fmod: "fmod",
+    math.hypot: "hypot",
+    math.log10: "log10",
+    math.log2: "log2",
+    math.radians: "radians",
+    math.sin: "sin",
+    math.sinh: "sinh",
+    math.sqrt: "sqrt",
+    math.tan: "tan",
+    math.tanh: "tanh",
+}
+#: Operators and functions whose ufuncs calculate exactly like Python for floats.
+_NUMPY_EXACT = frozenset(
+    (
+        operator.add,
+        operator.sub,
+        operator.mul,
+        operator.truediv,
+        operator.pos,
+        operator.neg,
+        operator.not_,
+        abs,
+        math.fabs,
+        math.sqrt,
+        *_COMPARE_OPERATORS.values(),
+    )
+)
+
+#: Opcodes of the postfix program created by :func:`compile_expression`.
+_CONST = 0
+_NAME = 1
+_UNARY = 2
+_BINARY = 3
+_CALL = 4
+#: Jumps skip the number of instructions given as argument; all jumps go forward.
+_JUMP = 5
+_JUMP_IF_FALSE_OR_POP = 6
+_JUMP_IF_TRUE_OR_POP = 7
+_POP_JUMP_IF_FALSE = 8
+#: Comparison within a chain, jumps to the end of the chain if it is false.
+_COMPARE = 9
+#: Store the value in the slot after the variables of a script.
+_STORE = 10
+#: Keep the value in the slot for common subexpressions without removing it.
+_SET = 11
+
+#: Symbols and precedences of the boolean operators by their jump opcode.
+_BOOL_SYMBOLS = {_JUMP_IF_FALSE_OR_POP: ("and", 2), _JUMP_IF_TRUE_OR_POP: ("or", 1)}
+
+_Instruction = Tuple[int, Any]
+
+#: Operators whose results can have more bits than their operands.
+_GROWING_OPERATORS = (operator.add, operator.sub, operator.mul, operator.pow, operator.lshift)
+
+#: Operators which can result in a :class:`bool` for numbers.
+_BOOL_OPERATORS = frozenset(
+    (operator.not_, operator.and_, operator.or_, operator.xor, *_COMPARE_OPERATORS.values())
+)
+
+#: Number types with arbitrarily growing precision checked against the bit limit.
+_EXACT_TYPES = (int, fractions.Fraction)
+
+#: Bit limit of a :class:`StringCalculator` for :class:`fractions.Fraction` without
+#: given limits, as exact powers of converted float literals can take forever.
+_FRACTION_MAX_BITS = 1_000_000
+
+#: Largest integer written as JSON number by the ``strcalc`` command, as JSON parsers
+#: commonly read numbers as doubles.
+_JSON_MAX_INT = 2**53
+
+#: Version of the serialized program format, increased on incompatible changes.
+BYTECODE_VERSION = 1
+#: Header of a serialized program: magic, :data:`BYTECODE_VERSION`, :data:`marshal.version`.
+_BYTECODE_HEADER = struct.Struct("<4sHH")
+_BYTECODE_MAGIC = b"SCBC"
+#: Header of a catalogue file: magic, versions like above and offset of the index.
+_CATALOGUE_HEADER = struct.Struct("<4sHHQ")
+_CATALOGUE_MAGIC = b"SCAT"
+#: Tables of a :class:`DiskCache` for the cached programs and the library version.
+_DISK_CACHE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS programs (key TEXT PRIMARY KEY, data BLOB NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS programs_used ON programs (used);
+"""
+
+#: Operators of the parsers without :mod:`ast` by symbol with their :mod:`ast` class
+#: and precedence.
+_DEEP_BINARY = {
+    _OPERATOR_SYMBOLS[func][0]: (node, _OPERATOR_SYMBOLS[func][1])
+    for node, func in _BINARY_OPERATORS.items()
+}
+_DEEP_UNARY = {
+    _OPERATOR_SYMBOLS[func][0].strip(): (node, _OPERATOR_SYMBOLS[func][1])
+    for node, func in _UNARY_OPERATORS.items()
+}
+_DEEP_COMPARE = {_OPERATOR_SYMBOLS[func][0]: node for node, func in _COMPARE_OPERATORS.items()}
+_DEEP_BOOL = {
+    symbol: (ast.Or if opcode == _JUMP_IF_TRUE_OR_POP else ast.And, precedence)
+    for opcode, (symbol, precedence) in _BOOL_SYMBOLS.items()
+}
+
+#: Tokens of the fast path parser after optional blanks: arithmetic operators,
+#: parentheses, ASCII names and number literals without underscores or prefixes.
+_SIMPLE_TOKEN = re.compile(
+    r"[ \t]*(\*\*|//|[-+*/%()]"
+    r"|[A-Za-z_][A-Za-z0-9_]*(?!\w)"
+    r"|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[jJ]?(?![\w.]))",
+    re.ASCII,
+)
+#: Arithmetic operators of the fast path parser.
+_SIMPLE_BINARY = {symbol: _DEEP_BINARY[symbol] for symbol in ("+", "-", "*", "/", "//", "%", "**")}
+_SIMPLE_UNARY = {symbol: _DEEP_UNARY[symbol][0] for symbol in ("+", "-")}
+_SIMPLE_UNARY_PRECEDENCE = _DEEP_UNARY["-"][1]
+#: Longer expressions are left to :func:`ast.parse`.
+_SIMPLE_MAX_TOKENS = 100
+
+#: Tokens of the parser for expressions too deep for :func:`ast.parse` after optional
+#: blanks: operators, delimiters and line breaks, names and number literals.
+_DEEP_TOKEN = re.compile(
+    r"[ \t\f\r]*(?:(\*\*|//|<<|>>|<=|>=|==|!=|[-+*/%@&|^~<>()=,;\n])"
+    r"|([^\W\d]\w*)"
+    r"|(0[xXoObB][0-9a-fA-F_]+|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][-+]?\d[\d_]*)?[jJ]?))"
+)
+
+#: Monotonic time after which the running evaluation is aborted.
+_DEADLINE: ContextVar[float] = ContextVar("_DEADLINE", default=math.inf)
+
+
+class StringCalculatorError(Exception):
+    """Exception for the StringCalculator."""
+
+
+class Limits(NamedTuple):
+    """Resource limits for compiling and evaluating expressions.
+
+    Limits are checked before the expensive work is done and a violation raises a
+    :exc:`StringCalculatorError`. ``None`` disables the respective limit.
+    """
+
+    #: Maximum number of characters of an expression.
+    max_length: Optional[int] = None
+    #: Maximum number of :mod:`ast` nodes of an expression.
+    max_nodes: Optional[int] = None
+    #: Maximum absolute value of an exponent for ``**`` and of the digits of ``round``.
+    max_exponent: Optional[float] = None
+    #: Maximum bit length of integer constants and results, also checked for the
+    #: power of ten ``round`` computes for exact numbers.
+    max_bits: Optional[int] = None
+    #: Maximum wall-clock time in seconds per evaluation. It is checked before each
+    #: operation, so a single running operation is not interrupted.
+    timeout: Optional[float] = None
+
+
+def _unwrap(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Return the operator function wrapped by :func:`_guard_operator`."""
+    return getattr(func, "__wrapped__", func)
+
+
+def _guard_operator(func: Callable[..., Any], limits: Limits) -> Callable[..., Any]:
+    """Wrap the operator function to enforce the limits if any apply to it.
+
+    Violations raise :exc:`ValueError` which is converted to
+    :exc:`StringCalculatorError` with the expression by the caller.
+    """
+    max_exponent, max_bits, timeout = limits.max_exponent, limits.max_bits, limits.timeout
+    is_pow, is_round = func is operator.pow, func is round
+    if max_bits is not None and func not in _GROWING_OPERATORS and not is_round:
+        max_bits = None
+    if timeout is None and max_bits is None and (max_exponent is None or not (is_pow or is_round)):
+        return func
+
+    @functools.wraps(func)
+    def guarded(*args: Any) -> Any:  # noqa: ANN401
+        if timeout is not None and time.monotonic() > _DEADLINE.get():
+            raise ValueError(f"Evaluation exceeded the time limit of {timeout} seconds.")
+        if is_pow:
+            base, exponent = args
+            if max_exponent is not None and abs(exponent) > max_exponent:
+                raise ValueError(f"Exponent exceeds the limit of {max_exponent}.")
+            if (
+                max_bits is not None
+                and type(base) in _EXACT_TYPES
+                and type(exponent) in _EXACT_TYPES
+                and exponent.denominator == 1
+                and (exponent > 0 or type(base) is fractions.Fraction)
+            ):
+                #: divided instead of multiplied as huge exponents overflow floats
+                base_bits = math.log2(max(abs(base.numerator), base.denominator))
+                if base_bits and abs(exponent) > max_bits / base_bits:
+                    raise ValueError(f"Result exceeds the limit of {max_bits} bits.")
+        elif (
+            max_bits is not None
+            and func is operator.mul
+            and all(type(arg) in _EXACT_TYPES for arg in args)
+            and sum(_bits(arg) for arg in args) - 1 > max_bits
+        ):
+            raise ValueError(f"Result exceeds the limit of {max_bits} bits.")
+        elif (
+            max_bits is not None
+            and func is operator.lshift
+            and all(type(arg) is int for arg in args)
+            and args[0].bit_length() + args[1] > max_bits
+        ):
+            raise ValueError(f"Result exceeds the limit of {max_bits} bits.")
+        elif (
+            is_round
+            and len(args) == 2
+            and isinstance(args[0], _EXACT_TYPES)
+            and isinstance(args[1], _EXACT_TYPES)
+        ):
+            #: rounding computes ``10 ** ndigits`` for fractions and negative digits
+            ndigits = -args[1]
+            if isinstance(args[0], fractions.Fraction):
+                ndigits = max(ndigits, args[1])
+            if max_exponent is not None and ndigits > max_exponent:
+                raise ValueError(f"Exponent exceeds the limit of {max_exponent}.")
+            if max_bits is not None and ndigits > max_bits / math.log2(10):
+                raise ValueError(f"Result exceeds the limit of {max_bits} bits.")
+        result = func(*args)
+        if max_bits is not None and type(result) in _EXACT_TYPES and _bits(result) > max_bits:
+            raise ValueError(f"Result exceeds the limit of {max_bits} bits.")
+        return result
+
+    return guarded
+
+
+def _bits(value: Any) -> int:  # noqa: ANN401
+    """Return the bit length of an integer or the larger one of a fraction's terms."""
+    if type(value) is fractions.Fraction:
+        return max(value.numerator.bit_length(), value.denominator.bit_length())
+    return value.bit_length()  # type: ignore[no-any-return]
+
+
+def _constant_text(value: Any) -> Tuple[str, int]:  # noqa: ANN401
+    """Return the expression string of a constant and its precedence."""
+    if type(value) is fractions.Fraction and value.denominator != 1:
+        return f"{value.numerator}/{value.denominator}", _OPERATOR_SYMBOLS[operator.truediv][1]
+    if isinstance(value, (decimal.Decimal, fractions.Fraction)):
+        text = str(value)
+    else:
+        text = repr(value).replace("inf", "1e999")
+    if text[0] == "-":
+        return text, _OPERATOR_SYMBOLS[operator.neg][1]
+    return text, _ATOM_PRECEDENCE
+
+
+def _encode_constant(value: Any) -> Any:  # noqa: ANN401
+    """Convert a constant of the program to a value supported by :mod:`marshal`."""
+    if type(value) in (bool, int, float, complex):
+        return value
+    if type(value) is decimal.Decimal:
+        return ("Decimal", str(value))
+    if type(value) is fractions.Fraction:
+        return ("Fraction", value.numerator, value.denominator)
+    raise ValueError(f"Constant `{value!r}` cannot be serialized.")
+
+
+def _decode_constant(value: Any) -> Any:  # noqa: ANN401
+    """Convert a serialized constant back, see :func:`_encode_constant`."""
+    if type(value) in (bool, int, float, complex):
+        return value
+    if value[0] == "Decimal":
+        return decimal.Decimal(value[1])
+    if value[0] == "Fraction":
+        return fractions.Fraction(value[1], value[2])
+    raise ValueError(f"Unknown serialized constant `{value!r}`.")
+
+
+def _check_index(value: Any, stop: int, start: int = 0) -> None:  # noqa: ANN401
+    """Check a slot index or jump offset of a serialized program is within the range."""
+    if type(value) is not int or not start <= value < stop:
+        raise ValueError(f"Argument `{value!r}` is out of range.")
+
+
+def _check_header(
+    header: struct.Struct, magic: bytes, data: Union[bytes, "mmap.mmap"]
+) -> Tuple[Any, ...]:
+    """Unpack the header of serialized data and check its magic and versions."""
+    if len(data) < header.size:
+        raise ValueError("Data is too short for a serialized compiled expression.")
+    fields = header.unpack_from(data)
+    if fields[0] != magic:
+        raise ValueError("Data is no serialized compiled expression.")
+    if fields[1:3] != (BYTECODE_VERSION, marshal.version):
+        raise ValueError(
+            f"Unsupported bytecode version {fields[1]} with marshal version {fields[2]}, "
+            f"expected {BYTECODE_VERSION} with {marshal.version}."
+        )
+    return fields
+
+
+@functools.lru_cache(maxsize=None)
+def _import_numpy() -> Any:  # noqa: ANN401
+    """Import :mod:`numpy` on first use or return ``None`` if it is not installed."""
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ModuleNotFoundError:
+        return None
+    return numpy
+
+
+def _check_function(name: str, func: Callable[..., Any]) -> None:
+    """Validate a function to be registered under the name."""
+    if not isinstance(name, str) or not name.isidentifier():
+        raise ValueError(f"Function name `{name}` is no valid identifier.")
+    if not callable(func):
+        raise TypeError(f"Function `{name}` is not callable.")
+
+
+def _numpy_function(numpy: Any, func: Callable[..., Any], count: int) -> Any:  # noqa: ANN401
+    """Return the NumPy ufunc for the function or vectorize it as Python function."""
+    func = _unwrap(func)
+    if func in _NUMPY_UFUNCS:
+        return getattr(numpy, _NUMPY_UFUNCS[func])
+    if count == 0:
+        return func
+    return numpy.frompyfunc(func, count, 1)
+
+
+def _jump_target(position: int, opcode: int, arg: Any) -> Optional[int]:  # noqa: ANN401
+    """Return the position a jump instruction jumps to or ``None`` for other ones."""
+    if opcode == _COMPARE:
+        return position + 1 + arg[1]  # type: ignore[no-any-return]
+    if opcode in (_JUMP, _JUMP_IF_FALSE_OR_POP, _JUMP_IF_TRUE_OR_POP, _POP_JUMP_IF_FALSE):
+        return position + 1 + arg  # type: ignore[no-any-return]
+    return None
+
+
+def _has_repeated_operation(code: List[_Instruction]) -> bool:
+    """Return if an operation is repeated together with the instruction before it.
+
+    A repeated subexpression ends with an operation preceded by the end of its last
+    operand, so without such a pair there is nothing to eliminate. Constants which
+    compare equal, like ``1`` and ``1.0``, count as repeated too.
+    """
+    pairs: Set[Tuple[Optional[_Instruction], Any]] = set()
+    previous = None
+    for instruction in code:
+        if instruction[0] in (_UNARY, _BINARY, _CALL):
+            pair = (previous, instruction[1])
+            if pair in pairs:
+                return True
+            pairs.add(pair)
+        previous = instruction
+    return False
+
+
+def _eliminate_common_subexpressions(
+    code: List[_Instruction], first_slot: int
+) -> Tuple[List[_Instruction], int, int]:
+    """Evaluate structurally identical subexpressions only once.
+
+    Subexpressions are numbered by their instruction and the numbers of their
+    operands. The first occurrence of a repeated one keeps its value in a slot and
+    later occurrences, which are always evaluated after it, load the slot instead.
+    Subexpressions containing jumps or calls of functions not in
+    :data:`DEFAULT_FUNCTIONS` are left as they are.
+
+    :param code: Program to optimize.
+    :param first_slot: First free slot for the values.
+    :return: The optimized program, the number of used slots and the number of
+        instructions no longer evaluated.
+    """
+    if not _has_repeated_operation(code):
+        return code, 0, 0
+    size = len(code)
+    numbers: Dict[Tuple[Any, ...], int] = {}
+    #: value number and start of the instructions of the subexpression ending there
+    value_numbers: List[Optional[int]] = [None] * size
+    starts = [0] * size
+    versions: Dict[int, int] = {}
+    joins: Dict[int, int] = {}
+    #: conditionally evaluated ranges of instructions
+    branches: List[Tuple[int, int]] = []
+    stack: List[Tuple[Optional[int], int]] = []
+
+    for position, (opcode, arg) in enumerate(code):
+        for _ in range(joins.pop(position, 0)):
+            stack[-1] = (None, stack[-1][1])
+        target = _jump_target(position, opcode, arg)
+        if target is not None:
+            branches.append((position + 1, target))
+            if opcode != _POP_JUMP_IF_FALSE:
+                joins[target] = joins.get(target, 0) + 1
+            if opcode == _COMPARE:
+                _, start = stack.pop()
+                stack[-1] = (None, start)
+            else:
+                stack.pop()
+            continue
+        if opcode == _STORE:
+            stack.pop()
+            versions[arg] = versions.get(arg, 0) + 1
+            continue
+
+        operands: List[Tuple[Optional[int], int]] = []
+        if opcode == _CONST:
+            key: Optional[Tuple[Any, ...]] = (
+                opcode,
+                type(arg),
+                arg if type(arg) is int else repr(arg),
+            )
+        elif opcode == _NAME:
+            key = (opcode, arg, versions.get(arg, 0))
+        else:
+            count = 1 if opcode == _UNARY else 2 if opcode == _BINARY else arg[1]
+            operands = stack[len(stack) - count :]
+            del stack[len(stack) - count :]
+            func = arg if opcode != _CALL else arg[0]
+            key = (opcode, func, *(number for number, _ in operands))
+            if None in key or (opcode == _CALL and _unwrap(func) not in _PURE_FUNCTIONS):
+                key = None
+        start = operands[0][1] if operands else position
+        number = None if key is None else numbers.setdefault(key, len(numbers))
+        value_numbers[position] = number
+        starts[position] = start
+        stack.append((number, start))
+
+    occurrences: Dict[int, List[int]] = {}
+    for position, number in enumerate(value_numbers):
+        if number is not None and position > starts[position]:
+            occurrences.setdefault(number, []).append(position)
+    if all(len(positions) < 2 for positions in occurrences.values()):
+        return code, 0, 0
+
+    #: innermost branch of each instruction and the branch enclosing each branch
+    innermost: List[Optional[Tuple[int, int]]] = [None] * size
+    parents: Dict[Tuple[int, int], Optional[Tuple[int, int]]] = {}
+    enclosing: List[Tuple[int, int]] = []
+    pending = iter(sorted(set(branches), key=lambda branch: (branch[0], -branch[1])))
+    branch = next(pending, None)
+    for position in range(size):
+        while enclosing and enclosing[-1][1] <= position:
+            enclosing.pop()
+        while branch is not None and branch[0] <= position:
+            if branch[1] > position:
+                parents[branch] = enclosing[-1] if enclosing else None
+                enclosing.append(branch)
+            branch = next(pending, None)
+        innermost[position] = enclosing[-1] if enclosing else None
+
+    def _dominates(first: int, later: int) -> bool:
+        """Return if the instruction is always evaluated before the later one."""
+        branch, target = innermost[later], innermost[first]
+        while branch is not target:
+            if branch is None:
+                return False
+            branch = parents[branch]
+        return True
+
+    removed = [False] * size
+    stores: Dict[int, int] = {}
+    loads: Dict[int, Tuple[int, int]] = {}
+    slot = first_slot
+    eliminated = 0
+    #: longer subexpressions first, so repeated parts of them are not counted twice
+    for positions in sorted(occurrences.values(), key=lambda ends: starts[ends[0]] - ends[0]):
+        ends = [end for end in positions if not removed[end]]
+        if len(ends) < 2:
+            continue
+        first = ends[0]
+        later = [end for end in ends[1:] if _dominates(first, end)]
+        length = first - starts[first] + 1
+        #: one instruction is added to keep the value and one per load
+        if len(later) * (length - 1) <= 1:
+            continue
+        stores[first] = slot
+        for end in later:
+            start = starts[end]
+            removed[start : end + 1] = [True] * (end + 1 - start)
+            loads[start] = (end, slot)
+            eliminated += length
+        slot += 1
+    if not stores:
+        return code, 0, 0
+
+    result: List[_Instruction] = []
+    new_positions = [0] * (size + 1)
+    position = 0
+    while position < size:
+        if position in loads:
+            end, load_slot = loads[position]
+            new_positions[position : end + 1] = [len(result)] * (end + 1 - position)
+            result.append((_NAME, load_slot))
+            position = end + 1
+            continue
+        new_positions[position] = len(result)
+        result.append(code[position])
+        if position in stores:
+            result.append((_SET, stores[position]))
+        position += 1
+    new_positions[size] = len(result)
+
+    for position, (opcode, arg) in enumerate(code):
+        target = _jump_target(position, opcode, arg)
+        if target is not None:
+            new_position = new_positions[position]
+            skip = new_positions[target] - new_position - 1
+            result[new_position] = (opcode, (arg[0], skip) if opcode == _COMPARE else skip)
+    return result, slot - first_slot, eliminated
+
+
+def _estimate_bits(
+    code: Sequence[_Instruction], variable_count: int, max_bits: Optional[int]
+) -> float:
+    """Estimate the largest bit length of an integer result of the program.
+
+    Variables and inexact constants count as :data:`_COST_VALUE_BITS` bits. The bounds
+    are propagated through nested and chained operations, values stored in slots and
+    all branches of conditions. ``**`` and ``<<`` without a constant right operand and
+    ``round`` without constant digits are unbounded unless ``max_bits`` limits their
+    result.
+
+    :param code: Postfix program.
+    :param variable_count: Number of variables, the slots of scripts follow them.
+    :param max_bits: Limit of the bit length of results of growing operators.
+    :return: Bit length or infinity
+    """
+    limit = math.inf if max_bits is None else max_bits
+    slots: Dict[int, float] = {}
+    #: stacks of bounds of the jumps to their target, merged by maximum
+    branches: Dict[int, List[float]] = {}
+    stack: List[float] = []
+    largest = 0.0
+
+    def branch(target: int, bounds: List[float]) -> None:
+        other = branches.get(target)
+        branches[target] = bounds[:] if other is None else list(map(max, other, bounds))
+
+    for position, (opcode, arg) in enumerate(code):
+        #: the stack after an unconditional jump is replaced by the one of its target
+        target_stack = branches.pop(position, None)
+        if target_stack is not None:
+            stack = (
+                target_stack
+                if code[position - 1][0] == _JUMP
+                else list(map(max, stack, target_stack))
+            )
+        if opcode == _CONST:
+            stack.append(_bits(arg) if type(arg) in _EXACT_TYPES else _COST_VALUE_BITS)
+        elif opcode == _NAME:
+            stack.append(slots[arg] if arg >= variable_count else _COST_VALUE_BITS)
+        elif opcode == _UNARY:
+            stack[-1] += 1
+        elif opcode == _BINARY:
+            right = stack.pop()
+            left = stack[-1]
+            func = _unwrap(arg)
+            #: the right operand is a constant if no branch ends before the operator
+            exponent = code[position - 1][1]
+            if code[position - 1][0] != _CONST or target_stack is not None:
+                exponent = None
+            if func is operator.pow:
+                if type(exponent) not in _EXACT_TYPES:
+                    bits = math.inf if exponent is None else _COST_VALUE_BITS
+                elif exponent.denominator == 1:
+                    bits = left * max(abs(int(exponent)), 1)
+                else:
+                    bits = _COST_VALUE_BITS
+            elif func is operator.lshift:
+                bits = math.inf if type(exponent) is not int else left + max(exponent, 0)
+            elif func in (operator.add, operator.sub, operator.and_, operator.or_, operator.xor):
+                bits = max(left, right) + 1
+            elif func in _BOOL_OPERATORS:
+                bits = 1
+            else:
+                bits = left + right
+            if func in _GROWING_OPERATORS:
+                bits = min(bits, limit)
+            stack[-1] = bits
+        elif opcode == _CALL:
+            count = arg[1]
+            bits = max(stack[len(stack) - count :], default=0)
+            if _unwrap(arg[0]) is round and count == 2:
+                #: ``round`` of exact numbers computes ten to the power of the digits
+                ndigits = code[position - 1][1]
+                if code[position - 1][0] != _CONST or target_stack is not None:
+                    digit_bits = math.inf
+                elif type(ndigits) in _EXACT_TYPES:
+                    digit_bits = math.log2(10) * min(abs(ndigits), limit, _CHEAP_BITS + 1)
+                else:
+                    digit_bits = 0
+                bits = max(bits, min(digit_bits, limit))
+            del stack[len(stack) - count :]
+            stack.append(max(bits, _COST_VALUE_BITS))
+        elif opcode == _STORE:
+            slots[arg] = stack.pop()
+        elif opcode == _SET:
+            slots[arg] = stack[-1]
+        elif opcode == _COMPARE:
+            stack[-1] = stack.pop()
+            branch(position + 1 + arg[1], stack)
+        elif opcode == _POP_JUMP_IF_FALSE:
+            stack.pop()
+            branch(position + 1 + arg, stack)
+        elif opcode == _JUMP:
+            branch(position + 1 + arg, stack)
+        else:
+            branch(position + 1 + arg, stack)
+            stack.pop()
+        if stack:
+            largest = max(largest, stack[-1])
+    return largest
+
+
+def _deadline_code(code: Sequence[_Instruction], timeout: float) -> Tuple[_Instruction, ...]:
+    """Return the program with the deadline checked before each operation.
+
+    The operations are wrapped like with the ``timeout`` limit, so the evaluation is
+    aborted after the deadline set in :data:`_DEADLINE`.
+    """
+    limits = Limits(timeout=timeout)
+    result = []
+    for opcode, arg in code:
+        if opcode in (_UNARY, _BINARY):
+            arg = _guard_operator(arg, limits)
+        elif opcode in (_CALL, _COMPARE):
+            arg = (_guard_operator(arg[0], limits), *arg[1:])
+        result.append((opcode, arg))
+    return tuple(result)
+
+
+def _numpy_code(
+    numpy: Any, code: Sequence[_Instruction]  # noqa: ANN401
+) -> Optional[Tuple[_Instruction, ...]]:
+    """Rewrite the program to run over whole arrays.
+
+    Operators and functions are replaced by ufuncs. Returns ``None`` for programs with
+    jumps, as their skipped operands would be evaluated for all rows.
+    """
+    result: List[_Instruction] = []
+    for position, (opcode, arg) in enumerate(code):
+        if _jump_target(position, opcode, arg) is not None:
+            return None
+        if opcode in (_UNARY, _BINARY):
+            func = _unwrap(arg)
+            result.append((opcode, getattr(numpy, _NUMPY_UFUNCS.get(func, ""), func)))
+        elif opcode == _CALL:
+            result.append((opcode, (_numpy_function(numpy, arg[0], arg[1]), arg[1], arg[2])))
+        else:
+            result.append((opcode, arg))
+    return tuple(result)
+
+
+class Interval:
+    """Closed interval of real numbers to calculate bounds of expressions in one pass.
+
+    The arithmetic operators result in an interval containing the results for all
+    values of the operands. Bounds are calculated with the arithmetic of their number
+    type and are not rounded outwards, so float bounds can be off by rounding errors.
+
+    ``==`` and ``!=`` compare the bounds. Ordering comparisons and the truth value
+    raise :exc:`ValueError` unless they are the same for all values of the intervals,
+    like ``==`` and ``!=`` do in :meth:`CompiledExpression.evaluate_interval`.
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import Interval
+
+    .. doctest::
+
+        >>> Interval(1, 2) * Interval(-3, 4) + 1
+        Interval(-5, 9)
+        >>> Interval.from_uncertainty(10, 0.5) ** 2
+        Interval(90.25, 110.25)
+    """
+
+    __slots__ = ("low", "high")
+
+    def __init__(self, low: Any, high: Any = None) -> None:  # noqa: ANN401
+        """Initialize the interval.
+
+        :param low: Lower bound.
+        :param high: Upper bound.
+
+            Default: ``low`` for an interval of a single value
+        :raises ValueError: if the lower bound exceeds the upper bound.
+        """
+        if high is None:
+            high = low
+        if not low <= high:
+            raise ValueError(f"Lower bound {low!r} exceeds upper bound {high!r}.")
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def from_uncertainty(cls, value: Any, uncertainty: Any) -> "Interval":  # noqa: ANN401
+        """Create the interval of ``value ± uncertainty``."""
+        return cls(value - abs(uncertainty), value + abs(uncertainty))
+
+    @property
+    def midpoint(self) -> Any:  # noqa: ANN401
+        """Value in the middle of the interval."""
+        return (self.low + self.high) / 2
+
+    @property
+    def uncertainty(self) -> Any:  # noqa: ANN401
+        """Distance of the bounds from the :attr:`midpoint`."""
+        return (self.high - self.low) / 2
+
+    def __repr__(self) -> str:
+        """Representation with the bounds."""
+        return f"{self.__class__.__name__}({self.low!r}, {self.high!r})"
+
+    def __eq__(self, other: object) -> bool:
+        """Check if the bounds are equal; numbers equal intervals of only them."""
+        other = _as_interval(other)
+        if other is None:
+            return NotImplemented
+        return bool(self.low == other.low and self.high == other.high)
+
+    def __hash__(self) -> int:
+        """Hash the bounds; intervals of a single value like the value."""
+        if self.low == self.high:
+            return hash(self.low)
+        return hash((self.low, self.high))
+
+    def __contains__(self, value: Any) -> bool:  # noqa: ANN401
+        """Check if the value or interval lies within the interval."""
+        value = _as_interval(value)
+        return value is not None and bool(self.low <= value.low and value.high <= self.high)
+
+    def __bool__(self) -> bool:
+        """Return the truth value of all values of the interval."""
+        if self.low == 0 and self.high == 0:
+            return False
+        if self.low > 0 or self.high < 0:
+            return True
+        raise ValueError(f"Truth value of {self!r} is undecided.")
+
+    def __lt__(self, other: Any) -> bool:  # noqa: ANN401
+        """Compare the interval as a whole."""
+        return _compare_intervals(self, other, "<")
+
+    def __le__(self, other: Any) -> bool:  # noqa: ANN401
+        """Compare the interval as a whole."""
+        return _compare_intervals(self, other, "<=")
+
+    def __gt__(self, other: Any) -> bool:  # noqa: ANN401
+        """Compare the interval as a whole."""
+        return _compare_intervals(self, other, ">")
+
+    def __ge__(self, other: Any) -> bool:  # noqa: ANN401
+        """Compare the interval as a whole."""
+        return _compare_intervals(self, other, ">=")
+
+    def __pos__(self) -> "Interval":
+        """Return the interval itself."""
+        return self
+
+    def __neg__(self) -> "Interval":
+        """Negate the interval."""
+        return Interval(-self.high, -self.low)
+
+    def __abs__(self) -> "Interval":
+        """Return the interval of the absolute values."""
+        if self.low >= 0:
+            return self
+        if self.high <= 0:
+            return -self
+        return Interval(0, max(-self.low, self.high))
+
+    def __add__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Add the intervals."""
+        other = _as_interval(other)
+        if other is None:
+            return NotImplemented
+        return Interval(self.low + other.low, self.high + other.high)
+
+    def __radd__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Add the intervals."""
+        return self.__add__(other)
+
+    def __sub__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Subtract the intervals."""
+        other = _as_interval(other)
+        if other is None:
+            return NotImplemented
+        return Interval(self.low - other.high, self.high - other.low)
+
+    def __rsub__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Subtract the intervals."""
+        return (-self).__add__(other)
+
+    def __mul__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Multiply the intervals."""
+        other = _as_interval(other)
+        if other is None:
+            return NotImplemented
+        return _interval_corners(operator.mul, self, other)
+
+    def __rmul__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Multiply the intervals."""
+        return self.__mul__(other)
+
+    def __truediv__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Divide the intervals."""
+        return _binary_interval_operation(operator.truediv, self, other)
+
+    def __rtruediv__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Divide the intervals."""
+        return _binary_interval_operation(operator.truediv, other, self)
+
+    def __floordiv__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Divide the intervals with floor."""
+        return _binary_interval_operation(operator.floordiv, self, other)
+
+    def __rfloordiv__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Divide the intervals with floor."""
+        return _binary_interval_operation(operator.floordiv, other, self)
+
+    def __mod__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Return the interval of the remainders."""
+        return _binary_interval_operation(operator.mod, self, other)
+
+    def __rmod__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Return the interval of the remainders."""
+        return _binary_interval_operation(operator.mod, other, self)
+
+    def __pow__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Raise the interval to the power."""
+        return _binary_interval_operation(operator.pow, self, other)
+
+    def __rpow__(self, other: Any) -> "Interval":  # noqa: ANN401
+        """Raise to the power of the interval."""
+        return _binary_interval_operation(operator.pow, other, self)
+
+
+def _as_interval(value: Any) -> Optional[Interval]:  # noqa: ANN401
+    """Convert real numbers to an interval of only them."""
+    if isinstance(value, Interval):
+        return value
+    if isinstance(value, (int, float, decimal.Decimal, fractions.Fraction)):
+        return Interval(value)
+    return None
+
+
+def _compare_intervals(left: Interval, right: Any, symbol: str) -> bool:  # noqa: ANN401
+    """Compare the intervals if the result is the same for all their values."""
+    interval = _as_interval(right)
+    if interval is None:
+        return NotImplemented  # type: ignore[no-any-return]
+    if symbol in (">", ">="):
+        left, interval, symbol = interval, left, symbol.replace(">", "<")
+    if left.high < interval.low or (symbol == "<=" and left.high <= interval.low):
+        return True
+    if left.low > interval.high or (symbol == "<" and left.low >= interval.high):
+        return False
+    raise ValueError(f"Comparison {left!r} {symbol} {interval!r} is undecided.")
+
+
+def _equal_intervals(left: Any, right: Any, symbol: str) -> bool:  # noqa: ANN401
+    """Check if the values are equal if the result is the same for all their values."""
+    left_interval, right_interval = _as_interval(left), _as_interval(right)
+    if left_interval is None or right_interval is None:
+        return bool(left == right)
+    if left_interval.high < right_interval.low or right_interval.high < left_interval.low:
+        return False
+    if left_interval.low == left_interval.high == right_interval.low == right_interval.high:
+        return True
+    raise ValueError(f"Comparison {left!r} {symbol} {right!r} is undecided.")
+
+
+def _interval_eq(left: Any, right: Any) -> bool:  # noqa: ANN401
+    """Check if the values are equal for all values of the intervals."""
+    return _equal_intervals(left, right, "==")
+
+
+def _interval_ne(left: Any, right: Any) -> bool:  # noqa: ANN401
+    """Check if the values are not equal for all values of the intervals."""
+    return not _equal_intervals(left, right, "!=")
+
+
+def _interval_corners(func: Callable[..., Any], left: Interval, right: Interval) -> Interval:
+    """Apply the function monotonic in each argument to the bounds."""
+    values = [
+        func(first, second) for first in (left.low, left.high) for second in (right.low, right.high)
+    ]
+    return Interval(min(values), max(values))
+
+
+def _binary_interval_operation(
+    func: Callable[..., Any], left: Any, right: Any  # noqa: ANN401
+) -> Interval:
+    """Apply a division, modulo or power operator to the intervals."""
+    left_interval, right_interval = _as_interval(left), _as_interval(right)
+    if left_interval is None or right_interval is None:
+        return NotImplemented  # type: ignore[no-any-return]
+    if func is operator.pow:
+        return _interval_power(left_interval, right_interval)
+    if right_interval.low <= 0 <= right_interval.high:
+        raise ZeroDivisionError(f"division by interval {right_interval!r} containing zero")
+    if func is not operator.mod:
+        return _interval_corners(func, left_interval, right_interval)
+    low, high = left_interval.low, left_interval.high
+    divisor_low, divisor_high = right_interval.low, right_interval.high
+    if divisor_low == divisor_high and low // divisor_low == high // divisor_low:
+        return Interval(low % divisor_low, high % divisor_low)
+    if divisor_low > 0:
+        return left_interval if 0 <= low and high < divisor_low else Interval(0, divisor_high)
+    return left_interval if divisor_high < low and high <= 0 else Interval(divisor_low, 0)
+
+
+def _interval_power(base: Interval, exponent: Interval) -> Interval:
+    """Raise the interval to the power of the other one."""
+    if base.low >= 0:
+        return _interval_corners(operator.pow, base, exponent)
+    power = exponent.low
+    if power != exponent.high or power % 1 != 0:
+        raise ValueError(f"Power of {base!r} with negative values needs an integer exponent.")
+    if power < 0:
+        return 1 / _interval_power(base, Interval(-power))
+    if power == 0:
+        return Interval(base.low**power)
+    low, high = base.low**power, base.high**power
+    if power % 2 == 1:
+        return Interval(low, high)
+    if base.high <= 0:
+        return Interval(high, low)
+    return Interval(0, max(low, high))
+
+
+def _interval_monotonic(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Extend the function monotonic in its first argument to intervals."""
+
+    @functools.wraps(func)
+    def extended(value: Any, *args: Any) -> Any:  # noqa: ANN401
+        if any(isinstance(arg, Interval) for arg in args):
+            raise ValueError(f"Function `{func.__name__}` supports only a first interval.")
+        if not isinstance(value, Interval):
+            return func(value, *args)
+        low, high = func(value.low, *args), func(value.high, *args)
+        return Interval(min(low, high), max(low, high))
+
+    return extended
+
+
+def _interval_even(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Extend the function decreasing up to zero and increasing afterwards to intervals."""
+
+    @functools.wraps(func)
+    def extended(value: Any) -> Any:  # noqa: ANN401
+        if not isinstance(value, Interval):
+            return func(value)
+        low, high = func(value.low), func(value.high)
+        if value.low <= 0 <= value.high:
+            return Interval(func(0), max(low, high))
+        return Interval(min(low, high), max(low, high))
+
+    return extended
+
+
+def _interval_periodic(func: Callable[..., Any], peak: float) -> Callable[..., Any]:
+    """Extend ``sin`` or ``cos`` with their maximum at ``peak`` to intervals."""
+
+    @functools.wraps(func)
+    def extended(value: Any) -> Any:  # noqa: ANN401
+        if not isinstance(value, Interval):
+            return func(value)
+        low, high = float(value.low), float(value.high)
+        if not (math.isfinite(low) and math.isfinite(high)):
+            return Interval(-1.0, 1.0)
+        values = [func(low), func(high)]
+        for offset, extreme in ((peak, 1.0), (peak + math.pi, -1.0)):
+            if math.floor((high - offset) / math.tau) >= math.ceil((low - offset) / math.tau):
+                values.append(extreme)
+        return Interval(min(values), max(values))
+
+    return extended
+
+
+def _interval_tan(value: Any) -> Any:  # noqa: ANN401
+    """Extend :func:`math.tan` to intervals without a pole."""
+    if not isinstance(value, Interval):
+        return math.tan(value)
+    low, high = float(value.low), float(value.high)
+    if not (math.isfinite(low) and math.isfinite(high)) or math.floor(
+        (high - math.pi / 2) / math.pi
+    ) >= math.ceil((low - math.pi / 2) / math.pi):
+        raise ValueError(f"Tangent of {value!r} is unbounded.")
+    return Interval(math.tan(low), math.tan(high))
+
+
+def _interval_hypot(*args: Any) -> Any:  # noqa: ANN401
+    """Extend :func:`math.hypot` to intervals."""
+    if not any(isinstance(arg, Interval) for arg in args):
+        return math.hypot(*args)
+    intervals = [abs(_as_interval(arg)) for arg in args]  # type: ignore[arg-type]
+    return Interval(
+        math.hypot(*(interval.low for interval in intervals)),
+        math.hypot(*(interval.high for interval in intervals)),
+    )
+
+
+def _interval_extreme(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Extend :func:`min` or :func:`max` to intervals."""
+
+    @functools.wraps(func)
+    def extended(*args: Any) -> Any:  # noqa: ANN401
+        if not any(isinstance(arg, Interval) for arg in args):
+            return func(*args)
+        intervals = [_as_interval(arg) for arg in args]
+        return Interval(
+            func(interval.low for interval in intervals),  # type: ignore[union-attr]
+            func(interval.high for interval in intervals),  # type: ignore[union-attr]
+        )
+
+    return extended
+
+
+def _interval_unsupported(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Reject intervals as arguments of the function."""
+
+    @functools.wraps(func)
+    def extended(*args: Any) -> Any:  # noqa: ANN401
+        if any(isinstance(arg, Interval) for arg in args):
+            raise ValueError(f"Function `{func.__name__}` does not support intervals.")
+        return func(*args)
+
+    return extended
+
+
+#: Versions of the :data:`DEFAULT_FUNCTIONS` for intervals.
+_INTERVAL_FUNCTIONS: Dict[Callable[..., Any], Callable[..., Any]] = {
+    abs: abs,
+    max: _interval_extreme(max),
+    min: _interval_extreme(min),
+    math.cos: _interval_periodic(math.cos, 0.0),
+    math.sin: _interval_periodic(math.sin, math.pi / 2),
+    math.tan: _interval_tan,
+    math.cosh: _interval_even(math.cosh),
+    math.fabs: _interval_even(math.fabs),
+    math.hypot: _interval_hypot,
+    **{
+        func: _interval_monotonic(func)
+        for func in (
+            round,
+            math.acos,
+            math.acosh,
+            math.asin,
+            math.asinh,
+            math.atan,
+            math.atanh,
+            math.ceil,
+            math.degrees,
+            math.exp,
+            math.floor,
+            math.log,
+            math.log10,
+            math.log2,
+            math.radians,
+            math.sinh,
+            math.sqrt,
+            math.tanh,
+            math.trunc,
+        )
+    },
+}
+
+
+#: Equality comparisons deciding for all values of intervals.
+_INTERVAL_COMPARISONS: Dict[Callable[..., Any], Callable[..., Any]] = {
+    operator.eq: _interval_eq,
+    operator.ne: _interval_ne,
+}
+
+
+def _interval_code(code: Sequence[_Instruction], limits: Limits) -> Tuple[_Instruction, ...]:
+    """Replace the calls of default functions and equality comparisons for intervals."""
+    result = []
+    for opcode, arg in code:
+        if opcode == _CALL and _unwrap(arg[0]) in _PURE_FUNCTIONS:
+            func = _unwrap(arg[0])
+            func = _INTERVAL_FUNCTIONS.get(func) or _interval_unsupported(func)
+            arg = (_guard_operator(func, limits), *arg[1:])
+        elif opcode == _BINARY and _unwrap(arg) in _INTERVAL_COMPARISONS:
+            arg = _guard_operator(_INTERVAL_COMPARISONS[_unwrap(arg)], limits)
+        elif opcode == _COMPARE and _unwrap(arg[0]) in _INTERVAL_COMPARISONS:
+            arg = (_guard_operator(_INTERVAL_COMPARISONS[_unwrap(arg[0])], limits), arg[1])
+        result.append((opcode, arg))
+    return tuple(result)
+
+
+class _OperatorTables(NamedTuple):
+    """Enabled operators by `ast` node and functions by name of a :class:`StringCalculator`.
+
+    All are bound to the limits of the calculator.
+    """
+
+    binary: Dict[type, Callable[..., Any]]
+    unary: Dict[type, Callable[..., Any]]
+    compare: Dict[type, Callable[..., Any]]
+    functions: Dict[str, Callable[..., Any]]
+
+
+class _Compiler(ast.NodeVisitor):
+    """Lower an arithmetic expression :mod:`ast` into a flat postfix program.
+
+    Every node type without a ``visit_`` method is rejected, so the compiled program
+    only consists of whitelisted operators, number constants and variables.
+
+    The tree is walked without recursion: ``visit_`` methods of nodes with children
+    are generators which yield each child to get it compiled before they continue.
+    So the nesting depth of expressions is only bounded by memory.
+    """
+
+    def __init__(
+        self, calculator: "StringCalculator", tables: _OperatorTables, expression: str = ""
+    ) -> None:
+        """Initialize an empty program.
+
+        :param calculator: Calculator providing the configuration.
+        :param tables: Operators and functions of the calculator to compile to.
+        :param expression: Source of the compiled :mod:`ast` to read literals from.
+        """
+        self.calculator = calculator
+        self.tables = tables
+        self.limits = calculator.limits
+        self.number_type = calculator.number_type
+        self.expression = expression
+        self.code: List[_Instruction] = []
+        self.names: Dict[str, int] = {}
+        self.node_count = 0
+        #: Slots of the names assigned so far in a script and the values of the ones
+        #: assigned a constant. Local slots are numbered negative until all variable
+        #: names are known.
+        self.local_names: Dict[str, int] = {}
+        self.local_constants: Dict[str, Any] = {}
+        self.temp_count = 0
+        self.deduplicated_nodes = 0
+        #: Last `UnaryOp` node (or its number in :meth:`_Compiler.compile_simple`) whose
+        #: instruction was added, as the last instruction can also be the end of a branch.
+        self.last_unary: Optional[Any] = None
+
+    def visit(self, node: ast.AST) -> None:
+        """Visit the node and all its children with an explicit stack."""
+        max_nodes = self.limits.max_nodes
+        stack: List[Iterator[ast.AST]] = []
+        pending: Optional[ast.AST] = node
+        while True:
+            if pending is not None:
+                self.node_count += 1
+                if max_nodes is not None and self.node_count > max_nodes:
+                    raise ValueError(f"Number of nodes exceeds the limit of {max_nodes}.")
+                visitor = getattr(self, f"visit_{pending.__class__.__name__}", self.generic_visit)
+                children = visitor(pending)
+                if children is not None:
+                    stack.append(children)
+            if not stack:
+                return
+            pending = next(stack[-1], None)
+            if pending is None:
+                stack.pop()
+
+    def generic_visit(self, node: ast.AST) -> None:
+        """Reject unsupported nodes."""
+        raise KeyError(type(node))
+
+    def _fold(self, func: Any, *args: Any) -> bool:  # noqa: ANN401
+        """Replace the constant operands at the end of the program by their result.
+
+        Operations which raise an exception, are too expensive or would result in a
+        non-finite number are not folded and therefore fail or run on evaluation.
+        """
+        base_func = _unwrap(func)
+        if base_func is operator.pow and all(type(arg) in _EXACT_TYPES for arg in args):
+            base, exponent = args
+            if exponent.denominator == 1 and abs(exponent) * max(_bits(base), 1) > _FOLD_MAX_BITS:
+                return False
+        if base_func is operator.lshift and all(type(arg) is int for arg in args):
+            if args[0].bit_length() + args[1] > _FOLD_MAX_BITS:
+                return False
+        try:
+            value = func(*args)
+        except Exception:  # pylint: disable=broad-except
+            return False
+        if isinstance(value, bool):
+            #: booleans cannot be written as constants in expressions
+            return False
+        if isinstance(value, decimal.Decimal):
+            if not value.is_finite():
+                return False
+        elif isinstance(value, (float, complex)) and not cmath.isfinite(value):
+            return False
+        del self.code[-len(args) :]
+        self.code.append((_CONST, value))
+        return True
+
+    def visit_BinOp(self, node: ast.BinOp) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `BinOp` nodes.
+
+        Constant operands are folded and the identities ``x * 1``, ``1 * x`` and
+        ``x - 0`` are simplified to ``x`` unless ``x`` can be a :class:`bool`, which the
+        operators convert to :class:`int`. ``x + 0`` is kept because it turns ``-0.0``
+        into ``0.0``.
+        """
+        func = self.tables.binary[type(node.op)]
+        start = len(self.code)
+        yield node.left
+        split = len(self.code)
+        yield node.right
+        self._binary(func, start, split)
+
+    def _binary(self, func: Callable[..., Any], start: int, split: int) -> None:
+        """Add the binary operator for the operands starting at ``start`` and ``split``."""
+        code = self.code
+        left = code[start] if split - start == 1 and code[start][0] == _CONST else None
+        right = code[-1] if len(code) - split == 1 and code[-1][0] == _CONST else None
+        if not left and not right:
+            code.append((_BINARY, func))
+            return
+        if left and right and self._fold(func, left[1], right[1]):
+            return
+        base_func = _unwrap(func)
+        if (
+            right
+            and type(right[1]) is int
+            and (
+                (base_func is operator.mul and right[1] == 1)
+                or (base_func is operator.sub and right[1] == 0)
+            )
+            and not self._may_be_bool(start, split)
+        ):
+            del code[-1]
+            return
+        if (
+            left
+            and type(left[1]) is int
+            and base_func is operator.mul
+            and left[1] == 1
+            and not self._may_be_bool(split, len(code))
+        ):
+            del code[start]
+            return
+        code.append((_BINARY, func))
+
+    def _may_be_bool(self, start: int, end: int) -> bool:
+        """Check if the operand compiled to the instructions from ``start`` to ``end``
+        can result in a :class:`bool`.
+
+        Variables are expected to be numbers. Operands ending in a jump target, like
+        conditions, and calls of functions are assumed to possibly result in one.
+        """
+        code = self.code
+        for position in range(start, end):
+            opcode, arg = code[position]
+            if _JUMP <= opcode <= _COMPARE and _jump_target(position, opcode, arg) == end:
+                return True
+        opcode, arg = code[end - 1]
+        if opcode == _NAME:
+            return False
+        if opcode == _CONST:
+            return type(arg) is bool
+        if opcode in (_UNARY, _BINARY):
+            return _unwrap(arg) in _BOOL_OPERATORS
+        return True
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `UnaryOp` nodes.
+
+        Constant operands are folded and ``--x`` is simplified to ``x`` unless
+        :class:`decimal.Decimal` is used, which rounds on negation.
+        """
+        func = self.tables.unary[type(node.op)]
+        start = len(self.code)
+        yield node.operand
+        self._unary(func, start, node, node.operand)
+
+    def _unary(self, func: Callable[..., Any], start: int, node: Any, operand: Any) -> None:
+        """Add the unary operator for the operand starting at ``start``.
+
+        ``node`` and ``operand`` identify the nodes to recognize ``--x``.
+        """
+        code = self.code
+        last = code[-1]
+        if len(code) - start == 1 and last[0] == _CONST and self._fold(func, last[1]):
+            return
+        if (
+            _unwrap(func) is operator.neg
+            and self.last_unary == operand
+            and last == (_UNARY, func)
+            and self.number_type is not decimal.Decimal
+            and not self._may_be_bool(start, len(code) - 1)
+        ):
+            del code[-1]
+            return
+        code.append((_UNARY, func))
+        self.last_unary = node
+
+    def visit_Compare(self, node: ast.Compare) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `Compare` nodes.
+
+        Each operand of a chained comparison is evaluated once and the chain stops at
+        the first false comparison.
+        """
+        operators = self.tables.compare
+        code = self.code
+        chain = []
+        yield node.left
+        for index, (op, comparator) in enumerate(zip(node.ops, node.comparators), 1):
+            func = operators[type(op)]
+            yield comparator
+            if index < len(node.ops):
+                chain.append(len(code))
+                code.append((_COMPARE, (func, 0)))
+            else:
+                code.append((_BINARY, func))
+        for position in chain:
+            code[position] = (_COMPARE, (code[position][1][0], len(code) - position - 1))
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `BoolOp` nodes.
+
+        Later operands are skipped on evaluation once the result is known. Constant
+        operands which do not decide the result are removed and the operands after a
+        deciding one are only validated.
+        """
+        is_or = isinstance(node.op, ast.Or)
+        jump = _JUMP_IF_TRUE_OR_POP if is_or else _JUMP_IF_FALSE_OR_POP
+        code = self.code
+        jumps = []
+        decided = False
+        for index, value in enumerate(node.values, 1):
+            start = len(code)
+            yield value
+            if decided:
+                del code[start:]
+            elif index == len(node.values):
+                break
+            elif len(code) - start == 1 and code[-1][0] == _CONST:
+                if bool(code[-1][1]) is is_or:
+                    decided = True
+                else:
+                    del code[-1]
+            else:
+                jumps.append(len(code))
+                code.append((jump, 0))
+        for position in jumps:
+            code[position] = (jump, len(code) - position - 1)
+
+    def visit_IfExp(self, node: ast.IfExp) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `IfExp` nodes.
+
+        Only the chosen branch is evaluated. With a constant condition the other branch
+        is only validated.
+        """
+        code = self.code
+        start = len(code)
+        yield node.test
+        test = code[-1] if len(code) - start == 1 and code[-1][0] == _CONST else None
+        #: Positions of the jumps to patch, only used without a constant condition.
+        condition_jump = else_jump = -1
+        if test:
+            del code[start:]
+        else:
+            condition_jump = len(code)
+            code.append((_POP_JUMP_IF_FALSE, 0))
+
+        start = len(code)
+        yield node.body
+        if test and not test[1]:
+            del code[start:]
+        elif not test:
+            else_jump = len(code)
+            code.append((_JUMP, 0))
+            code[condition_jump] = (_POP_JUMP_IF_FALSE, len(code) - condition_jump - 1)
+
+        start = len(code)
+        yield node.orelse
+        if test and test[1]:
+            del code[start:]
+        elif not test:
+            code[else_jump] = (_JUMP, len(code) - else_jump - 1)
+
+    def visit_Constant(self, node: ast.Constant) -> None:  # noqa: N802
+        """Handle `Constant` nodes.
+
+        With a ``number_type`` configured the literal is converted to it. Float
+        literals are converted from their source text, so no float rounding applies.
+        """
+        value = node.value
+        text = None
+        if isinstance(value, float) and self.number_type is not None:
+            text = ast.get_source_segment(self.expression, node)
+        self._constant(value, text)
+
+    def _constant(self, value: Any, text: Optional[str] = None) -> None:  # noqa: ANN401
+        """Add the literal value with its source text."""
+        if not isinstance(value, NUMBERTYPES) or isinstance(value, bool):
+            raise ValueError(f"Extracted `Constant` is not of type {NumberType}.")
+        max_bits = self.limits.max_bits
+        number_type = self.number_type
+        if number_type is not None:
+            if isinstance(value, complex):
+                raise ValueError(f"Complex numbers are not supported by `{number_type.__name__}`.")
+            if isinstance(value, float):
+                text = text or repr(value)
+                value = decimal.Decimal(text.replace("_", ""))
+                if (
+                    max_bits is not None
+                    and number_type is fractions.Fraction
+                    and abs(value.adjusted()) * math.log2(10) > max_bits
+                ):
+                    raise ValueError(f"Constant exceeds the limit of {max_bits} bits.")
+            value = number_type(value)
+        if max_bits is not None and type(value) in _EXACT_TYPES and _bits(value) > max_bits:
+            raise ValueError(f"Constant exceeds the limit of {max_bits} bits.")
+        self.code.append((_CONST, value))
+
+    def visit_Name(self, node: ast.Name) -> None:  # noqa: N802
+        """Handle `Name` nodes.
+
+        Names assigned before in a script refer to the assigned value and all other
+        names to variables.
+        """
+        if not isinstance(node.ctx, ast.Load):
+            raise KeyError(type(node.ctx))
+        self._name(node.id)
+
+    def _name(self, name: str) -> None:
+        """Add the value of the name."""
+        if name in self.local_constants:
+            self.code.append((_CONST, self.local_constants[name]))
+        elif name in self.local_names:
+            self.code.append((_NAME, ~self.local_names[name]))
+        else:
+            self.code.append((_NAME, self.names.setdefault(name, len(self.names))))
+
+    def visit_Module(self, node: ast.Module) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `Module` nodes.
+
+        A script's statements before the final expression must be assignments. Once
+        all statements are compiled the slots of assigned names are placed after the
+        variables.
+        """
+        for index, statement in enumerate(node.body, 1):
+            if index < len(node.body) and isinstance(statement, ast.Expr):
+                raise ValueError("Only assignments can precede the final expression.")
+            if index == len(node.body) and isinstance(statement, ast.Assign):
+                raise ValueError("Script must end with an expression.")
+            yield statement
+        self._finish()
+
+    def _finish(self) -> None:
+        """Place the slots of assigned names after the variables and deduplicate."""
+        offset = len(self.names)
+        if self.local_names:
+            self.code = [
+                (opcode, offset + ~arg) if opcode in (_NAME, _STORE) and arg < 0 else (opcode, arg)
+                for opcode, arg in self.code
+            ]
+        self.code, self.temp_count, self.deduplicated_nodes = _eliminate_common_subexpressions(
+            self.code, offset + len(self.local_names)
+        )
+
+    def visit_Assign(self, node: ast.Assign) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `Assign` nodes.
+
+        The value is evaluated once and stored in a slot. Constant values are inserted
+        directly where the name is used.
+        """
+        if len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            raise ValueError("Assignments must have a single name as target.")
+        name = node.targets[0].id
+        code = self.code
+        start = len(code)
+        yield node.value
+
+        if len(code) - start == 1 and code[-1][0] == _CONST:
+            self.local_constants[name] = code.pop()[1]
+            return
+        self.local_constants.pop(name, None)
+        slot = self.local_names.setdefault(name, len(self.local_names))
+        code.append((_STORE, ~slot))
+
+    def visit_Call(self, node: ast.Call) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `Call` nodes.
+
+        The function is looked up by name in the calculator's registry and bound to
+        the program, so no lookup happens on evaluation. Calls of default functions
+        with constant arguments are folded.
+        """
+        if not isinstance(node.func, ast.Name):
+            raise KeyError(type(node.func))
+        if node.keywords:
+            raise KeyError(ast.keyword)
+        name = node.func.id
+        func = self.tables.functions.get(name)
+        if func is None:
+            raise ValueError(f"Unknown function `{name}`.")
+        code = self.code
+        start = len(code)
+        for arg in node.args:
+            yield arg
+
+        args = code[start:]
+        if (
+            args
+            and _unwrap(func) in _PURE_FUNCTIONS
+            and len(args) == len(node.args)
+            and all(opcode == _CONST for opcode, _ in args)
+            and self._fold(func, *(arg for _, arg in args))
+        ):
+            return
+        code.append((_CALL, (func, len(node.args), name)))
+
+    def visit_Expr(self, node: ast.Expr) -> Iterator[ast.AST]:  # noqa: N802
+        """Handle `Expr` nodes."""
+        yield node.value
+
+    def compile_simple(  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+        self,
+    ) -> bool:
+        """Compile the expression without :mod:`ast` if it only uses the simple grammar.
+
+        The simple grammar consists of number literals, names, parentheses, the unary
+        operators ``+`` and ``-`` and the binary operators ``+ - * / // % **``. The
+        tokens are converted by operator precedence into the same program as from the
+        :mod:`ast`, including folding and node counting.
+
+        :return: If the expression was compiled; if not, the compiler must be discarded
+            and the expression compiled from its :mod:`ast`, which also raises the
+            errors.
+        """
+        expression = self.expression
+        tokens = _SIMPLE_TOKEN.findall(expression)
+        #: characters not part of a token or blank were skipped
+        if (
+            expression[0] in " \t"
+            or len(tokens) > _SIMPLE_MAX_TOKENS
+            or sum(map(len, tokens)) + expression.count(" ") + expression.count("\t")
+            != len(expression)
+        ):
+            return False
+        binary_operators = self.tables.binary
+        unary_operators = self.tables.unary
+        code = self.code
+        names = self.names
+        #: code start and node number of the compiled operands and precedence,
+        #: function and node number of the pending operators and parentheses
+        operands: List[Tuple[int, int]] = []
+        pending: List[Tuple[int, Any, int]] = [(-1, None, 0)]
+        nodes = 0
+        expect_operand = True
+        try:
+            #: the added parenthesis closes the one around the expression
+            for text in tokens + [")"]:
+                if expect_operand:
+                    if text == "(":
+                        pending.append((-1, None, 0))
+                        continue
+                    nodes += 1
+                    if text in _SIMPLE_UNARY:
+                        func = unary_operators[_SIMPLE_UNARY[text]]
+                        pending.append((_SIMPLE_UNARY_PRECEDENCE, func, nodes))
+                        continue
+                    operands.append((len(code), nodes))
+                    if text.isdigit():
+                        if text[0] == "0" and len(text) > 1:
+                            return False
+                        self._constant(int(text))
+                    elif text[0] in "0123456789.":
+                        if text[-1] in "jJ":
+                            self._constant(complex(0.0, float(text[:-1])))
+                        else:
+                            self._constant(float(text), text)
+                    elif text in _SIMPLE_BINARY or text == ")" or keyword.iskeyword(text):
+                        return False
+                    else:
+                        #: no names are assigned in the simple grammar
+                        code.append((_NAME, names.setdefault(text, len(names))))
+                    expect_operand = False
+                    continue
+
+                if text == ")":
+                    threshold = 0
+                elif text in _SIMPLE_BINARY:
+                    op, precedence = _SIMPLE_BINARY[text]
+                    #: ``**`` is right associative
+                    threshold = precedence + 1 if op is ast.Pow else precedence
+                else:
+                    return False
+                while pending[-1][0] >= threshold:
+                    pending_precedence, func, node = pending.pop()
+                    if pending_precedence == _SIMPLE_UNARY_PRECEDENCE:
+                        start, operand = operands.pop()
+                        self._unary(func, start, node, operand)
+                    else:
+                        split = operands.pop()[0]
+                        start = operands.pop()[0]
+                        self._binary(func, start, split)
+                    operands.append((start, node))
+                if text == ")":
+                    pending.pop()
+                else:
+                    nodes += 1
+                    pending.append((precedence, binary_operators[op], nodes))
+                    expect_operand = True
+        except (IndexError, KeyError, ValueError, ArithmeticError):
+            #: unmatched closing parenthesis or errors the ast path raises again
+            return False
+        if pending:
+            return False
+        max_nodes = self.limits.max_nodes
+        self.node_count = nodes + 2  # Module and Expr
+        if max_nodes is not None and self.node_count > max_nodes:
+            return False
+        self._finish()
+        return True
+
+
+def _parse_number(text: str) -> NumberType:
+    """Convert a number literal token like the Python parser."""
+    if text[-1] in "jJ":
+        return complex(0.0, float(text[:-1]))
+    if text[:2].lower() in ("0x", "0o", "0b") or not any(char in text for char in ".eE"):
+        return int(text, 0)
+    return float(text)
+
+
+def _parse_deep(  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+    expression: str,
+) -> ast.Module:
+    """Parse an expression too deep for :func:`ast.parse` into the same :mod:`ast`.
+
+    The operators are reduced by precedence with explicit stacks instead of recursion,
+    so the nesting depth is only bounded by memory. The syntax is the one the compiler
+    supports: number literals, names, calls of functions by name, parentheses, all
+    operators, comparison chains, conditional expressions and scripts of assignments.
+
+    :raises ValueError: if the expression uses other syntax or is invalid.
+    """
+    statements: List[ast.stmt] = []
+    operands: List[ast.expr] = []
+    #: precedence, kind and argument of pending operators, parentheses and calls;
+    #: parentheses, calls and conditions waiting for ``else`` have precedence -1
+    pending: List[List[Any]] = []
+    target: Optional[str] = None
+    expect_operand = True
+    after_name = False
+    depth = 0
+    line, line_start = 1, 0
+    is_ascii = expression.isascii()
+
+    def reduce(precedence: int) -> None:
+        """Apply the pending operators of at least the given precedence."""
+        while pending and pending[-1][0] >= precedence:
+            _, kind, arg = pending.pop()
+            if kind == "binary":
+                right = operands.pop()
+                operands[-1] = ast.BinOp(operands[-1], arg(), right)
+            elif kind == "unary":
+                operands[-1] = ast.UnaryOp(arg(), operands[-1])
+            elif kind == "compare":
+                comparators = operands[len(operands) - len(arg) :]
+                del operands[len(operands) - len(arg) :]
+                operands[-1] = ast.Compare(operands[-1], [op() for op in arg], comparators)
+            elif kind == "bool":
+                values = operands[len(operands) - arg[1] :]
+                del operands[len(operands) - arg[1] :]
+                operands.append(ast.BoolOp(arg[0](), values))
+            else:
+                body, test, orelse = operands[-3:]
+                del operands[-2:]
+                operands[-1] = ast.IfExp(test, body, orelse)
+
+    position = 0
+    while True:
+        match = _DEEP_TOKEN.match(expression, position)
+        if match is None:
+            if expression[position:].strip(" \t\f\r"):
+                raise ValueError(f"Unsupported syntax at position {position}.")
+            symbol, name, number, start = "\n", None, None, len(expression)
+        else:
+            symbol, name, number = match.groups()
+            start, position = match.start(match.lastindex or 0), match.end()
+        if symbol == "\n" and match is not None:
+            line, line_start = line + 1, position
+            if depth:
+                continue
+        is_name, after_name = after_name, False
+        if (
+            match is not None
+            and start > match.start() == line_start
+            and symbol != "\n"
+            and not (pending or operands or target)
+        ):
+            raise ValueError(f"Unexpected indent at position {match.start()}.")
+
+        if expect_operand:
+            if number is not None:
+                operand: ast.expr = ast.Constant(_parse_number(number))
+                column = start - line_start
+                if not is_ascii:
+                    column = len(expression[line_start:start].encode("utf-8"))
+                operand.lineno = operand.end_lineno = line
+                operand.col_offset, operand.end_col_offset = column, column + len(number)
+                operands.append(operand)
+                expect_operand = False
+            elif name is not None and name in ("True", "False", "None"):
+                operands.append(ast.Constant({"True": True, "False": False}.get(name)))
+                expect_operand = False
+            elif name == "not":
+                if pending and pending[-1][0] >= _COMPARE_PRECEDENCE:
+                    raise ValueError("`not` must be the operand of a boolean operator.")
+                pending.append([_DEEP_UNARY[name][1], "unary", _DEEP_UNARY[name][0]])
+            elif name is not None and not keyword.iskeyword(name):
+                if not name.isascii():
+                    import unicodedata  # pylint: disable=import-outside-toplevel
+
+                    name = unicodedata.normalize("NFKC", name)
+                operands.append(ast.Name(name, ast.Load()))
+                expect_operand = False
+                after_name = True
+            elif symbol == "(":
+                pending.append([-1, "paren", len(operands)])
+                depth += 1
+            elif symbol in ("+", "-", "~"):
+                pending.append([_DEEP_UNARY[symbol][1], "unary", _DEEP_UNARY[symbol][0]])
+            elif symbol == ")" and pending and pending[-1][1] == "call":
+                #: call without arguments or with a trailing comma
+                func, count = pending.pop()[2]
+                args = operands[count:]
+                del operands[count:]
+                operands.append(ast.Call(func, args, []))
+                depth -= 1
+                expect_operand = False
+            elif symbol == "\n" and not pending and not operands and target is None:
+                if match is None:
+                    break
+            else:
+                raise ValueError(f"Unexpected `{symbol or name or number}` at position {start}.")
+            continue
+
+        if symbol in _DEEP_BINARY:
+            node, precedence = _DEEP_BINARY[symbol]
+            #: ``**`` is right associative
+            reduce(precedence + 1 if node is ast.Pow else precedence)
+            pending.append([precedence, "binary", node])
+        elif symbol in _DEEP_COMPARE:
+            reduce(_COMPARE_PRECEDENCE + 1)
+            if pending and pending[-1][1] == "compare":
+                pending[-1][2].append(_DEEP_COMPARE[symbol])
+            else:
+                pending.append([_COMPARE_PRECEDENCE, "compare", [_DEEP_COMPARE[symbol]]])
+        elif name in _DEEP_BOOL:
+            node, precedence = _DEEP_BOOL[name]
+            reduce(precedence + 1)
+            if pending and pending[-1][1] == "bool" and pending[-1][2][0] is node:
+                pending[-1][2][1] += 1
+            else:
+                pending.append([precedence, "bool", [node, 2]])
+        elif name == "if":
+            reduce(_IF_PRECEDENCE + 1)
+            if pending and pending[-1][1] == "if":
+                raise ValueError("Conditions must be parenthesized.")
+            pending.append([-1, "if", None])
+        elif name == "else":
+            reduce(_IF_PRECEDENCE)
+            if not pending or pending[-1][1] != "if":
+                raise ValueError("`else` without `if`.")
+            pending[-1] = [_IF_PRECEDENCE, "else", None]
+        elif symbol == "(" and is_name:
+            pending.append([-1, "call", (operands.pop(), len(operands))])
+            depth += 1
+        elif symbol in (")", ","):
+            reduce(_IF_PRECEDENCE)
+            if not pending or pending[-1][1] not in ("paren", "call"):
+                raise ValueError(f"Unexpected `{symbol}` at position {start}.")
+            if pending[-1][1] == "call" and symbol == ",":
+                expect_operand = True
+                continue
+            _, kind, arg = pending.pop()
+            depth -= 1
+            if kind == "call":
+                func, count = arg
+                args = operands[count:]
+                del operands[count:]
+                operands.append(ast.Call(func, args, []))
+            elif len(operands) != arg + 1:
+                raise ValueError("Tuples are not supported.")
+            continue
+        elif symbol == "=" and not pending and target is None and is_name:
+            target = operands.pop().id  # type: ignore[attr-defined]
+        elif symbol in (";", "\n"):
+            reduce(_IF_PRECEDENCE)
+            if pending:
+                raise ValueError("Parenthesis or condition is not closed.")
+            value = operands.pop()
+            statements.append(
+                ast.Expr(value)
+                if target is None
+                else ast.Assign([ast.Name(target, ast.Store())], value, None)
+            )
+            target = None
+            if match is None:
+                break
+        else:
+            raise ValueError(f"Unexpected `{symbol or name or number}` at position {start}.")
+        expect_operand = True
+    return ast.Module(statements, [])
+
+
+def _is_small_int(value: Any) -> bool:  # noqa: ANN401
+    """Check if the value is an integer shared by the interpreter."""
+    return type(value) is int and -5 <= value <= 256
+
+
+class CompiledExpression:
+    """Arithmetic expression which was parsed and validated once.
+
+    Create instances with :func:`compile_expression`. The expression is stored as a
+    flat postfix program so repeated evaluation needs neither :func:`ast.parse` nor a
+    tree walk. The program is kept as a byte string of opcodes and a tuple of their
+    arguments, see :attr:`memory_size`, and evaluated directly from them.
+
+    Variables used in the expression are listed in :attr:`names` and their values are
+    looked up once per evaluation from the given mapping or columns.
+
+    Expressions compiled in :class:`decimal.Decimal` mode are evaluated in a copy of
+    their :attr:`decimal_context`.
+    """
+
+    __slots__ = (
+        "expression",
+        "names",
+        "limits",
+        "decimal_context",
+        "local_names",
+        "deduplicated_nodes",
+        "_empty_slots",
+        "_opcodes",
+        "_args",
+        "_function",
+        "_cost",
+        "_deadline_program",
+        "_interval_program",
+    )
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        expression: str,
+        code: List[_Instruction],
+        names: Iterable[str] = (),
+        limits: Limits = Limits(),
+        decimal_context: Optional[decimal.Context] = None,
+        local_names: Iterable[str] = (),
+        temp_count: int = 0,
+        deduplicated_nodes: int = 0,
+    ) -> None:
+        """Initialize the compiled expression.
+
+        :param expression: The source expression string.
+        :param code: Postfix program created by the compiler.
+        :param names: Variable names in the order of their index in the program.
+        :param limits: Limits the program was compiled with.
+        :param decimal_context: Context for :class:`decimal.Decimal` arithmetic.
+        :param local_names: Names assigned in a script in the order of their slots
+            after the variables.
+        :param temp_count: Number of slots after the assigned names for values of
+            common subexpressions.
+        :param deduplicated_nodes: Number of instructions not evaluated due to common
+            subexpression elimination.
+        """
+        self.expression = expression
+        self.names: Tuple[str, ...] = tuple(names)
+        self.limits = limits
+        self.decimal_context = decimal_context
+        self.local_names: Tuple[str, ...] = tuple(local_names)
+        self.deduplicated_nodes = deduplicated_nodes
+        self._empty_slots = (None,) * (len(self.local_names) + temp_count)
+        self._opcodes = bytes(map(operator.itemgetter(0), code))
+        self._args: Tuple[Any, ...] = tuple(map(operator.itemgetter(1), code))
+        self._function: Optional[Callable[..., Any]] = None
+        self._cost: Optional[float] = None
+        #: variants of the program created on first use, see :meth:`_run`
+        self._deadline_program: Optional[Tuple[float, Tuple[_Instruction, ...]]] = None
+        self._interval_program: Optional[Tuple[_Instruction, ...]] = None
+
+    def __repr__(self) -> str:
+        """Representation with the source expression."""
+        return f"{self.__class__.__name__}({self.expression!r})"
+
+    @property
+    def _code(self) -> Tuple[_Instruction, ...]:
+        """Instructions of the program as pairs of opcode and argument."""
+        return tuple(zip(self._opcodes, self._args))
+
+    @property
+    def memory_size(self) -> int:
+        """Approximate number of bytes used by the compiled expression.
+
+        Counted are the object, the expression string, the names and the program with
+        the constants and call arguments it holds. Objects shared with other compiled
+        expressions like operators, functions, :attr:`limits` and small integers are
+        not counted.
+        """
+        owned: Dict[int, Any] = {}
+        for value in (
+            self.expression,
+            self.names,
+            self.local_names,
+            self._empty_slots,
+            self._opcodes,
+            self._args,
+            *self.names,
+            *self.local_names,
+        ):
+            owned[id(value)] = value
+        for opcode, arg in zip(self._opcodes, self._args):
+            if opcode not in (_UNARY, _BINARY) and not _is_small_int(arg):
+                owned[id(arg)] = arg
+        return sys.getsizeof(self) + sum(map(sys.getsizeof, owned.values()))
+
+    @property
+    def simplified_expression(self) -> str:
+        """Expression string of the compiled program after simplification.
+
+        Constant subexpressions are folded and identities removed, so the string shows
+        what is actually calculated on evaluation. Assignments of scripts are separated
+        by ``;``.
+        """
+        statements, expression, _ = self._decompile()
+        return "; ".join([*statements, expression]) if expression else ""
+
+    @property
+    def cost(self) -> float:
+        """Estimated cost of an evaluation as number of instructions.
+
+        The cost is infinite if an instruction can take arbitrarily long: calls of
+        functions not in :data:`DEFAULT_FUNCTIONS` and operations whose integer result
+        can exceed 4096 bits. The bit lengths are estimated through nested and chained
+        operations from the constants, taking 64 bits for variables. So ``**`` and
+        ``<<`` without a constant right operand and ``round`` without constant digits
+        are only cheap if the ``max_bits`` limit bounds their result. The values of the variables are not taken into
+        account.
+        """
+        if self._cost is not None:
+            return self._cost
+        code = self._code
+        cost: float = len(code)
+        if any(
+            opcode == _CALL and _unwrap(arg[0]) not in _PURE_FUNCTIONS for opcode, arg in code
+        ) or (_estimate_bits(code, len(self.names), self.limits.max_bits) > _CHEAP_BITS):
+            cost = math.inf
+        self._cost = cost
+        return cost
+
+    def _decompile(  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+        self, prefix: Optional[str] = None
+    ) -> Tuple[List[str], str, Dict[str, Any]]:
+        """Convert the program back to assignment statements and the final expression.
+
+        Without ``prefix`` common subexpressions are repeated where they are loaded.
+        With ``prefix`` the result is Python source for :meth:`to_function`: common
+        subexpressions are kept with ``:=`` and guarded operators, functions and
+        constants without exact literal are referred to by names starting with the
+        prefix, which are returned with the objects to bind to them.
+        """
+        python = prefix is not None
+        names = [*self.names, *self.local_names]
+        if python:
+            temp_count = len(self._empty_slots) - len(self.local_names)
+            names += [f"{prefix}t{index}" for index in range(temp_count)]
+        bound: Dict[str, Any] = {}
+        bound_ids: Dict[int, str] = {}
+
+        def bind(value: Any) -> str:  # noqa: ANN401
+            name = bound_ids.get(id(value))
+            if name is None:
+                name = bound_ids[id(value)] = f"{prefix}b{len(bound)}"
+                bound[name] = value
+            return name
+
+        #: texts of common subexpressions by slot to repeat them where they are loaded
+        temps: Dict[int, Tuple[str, int]] = {}
+        statements: List[str] = []
+        stack: List[Tuple[str, int]] = []
+        #: Texts left of the top of the stack with their precedence which are joined
+        #: with it when the target of their jump is reached.
+        joins: Dict[int, List[Tuple[str, int]]] = {}
+        conditions: Dict[int, str] = {}
+        for position, (opcode, arg) in enumerate(itertools.chain(self._code, [(None, None)])):
+            for left, precedence in reversed(joins.pop(position, ())):
+                right, right_precedence = stack.pop()
+                if right_precedence < precedence:
+                    right = f"({right})"
+                stack.append((f"{left} {right}", precedence))
+            if opcode is None:
+                break
+            if opcode == _CONST:
+                if python and not (
+                    type(arg) is int
+                    and arg.bit_length() < 64
+                    or type(arg) is float
+                    and math.isfinite(arg)
+                ):
+                    stack.append((bind(arg), _ATOM_PRECEDENCE))
+                else:
+                    stack.append(_constant_text(arg))
+            elif opcode == _NAME:
+                stack.append(temps[arg] if arg in temps else (names[arg], _ATOM_PRECEDENCE))
+            elif opcode == _SET:
+                if python:
+                    stack[-1] = (f"({names[arg]} := {stack[-1][0]})", _ATOM_PRECEDENCE)
+                else:
+                    temps[arg] = stack[-1]
+            elif opcode == _STORE:
+                statements.append(f"{names[arg]} = {stack.pop()[0]}")
+            elif opcode == _CALL:
+                func, count, name = arg
+                args = [text for text, _ in stack[len(stack) - count :]]
+                del stack[len(stack) - count :]
+                if python:
+                    name = bind(func)
+                stack.append((f"{name}({', '.join(args)})", _ATOM_PRECEDENCE))
+            elif python and opcode in (_UNARY, _BINARY) and arg is not _unwrap(arg):
+                count = 1 if opcode == _UNARY else 2
+                args = [text for text, _ in stack[len(stack) - count :]]
+                del stack[len(stack) - count :]
+                stack.append((f"{bind(arg)}({', '.join(args)})", _ATOM_PRECEDENCE))
+            elif opcode == _UNARY:
+                symbol, precedence = _OPERATOR_SYMBOLS[_unwrap(arg)]
+                text, operand_precedence = stack.pop()
+                if operand_precedence < precedence:
+                    text = f"({text})"
+                stack.append((f"{symbol}{text}", precedence))
+            elif opcode == _BINARY:
+                symbol, precedence = _OPERATOR_SYMBOLS[_unwrap(arg)]
+                right, right_precedence = stack.pop()
+                left, left_precedence = stack.pop()
+                #: ``**`` is right associative, comparisons are chained and all other
+                #: operators are left associative
+                right_assoc = _unwrap(arg) is operator.pow
+                chained = precedence == _COMPARE_PRECEDENCE
+                if left_precedence < precedence + right_assoc + chained:
+                    left = f"({left})"
+                if right_precedence < precedence + (not right_assoc):
+                    right = f"({right})"
+                stack.append((f"{left} {symbol} {right}", precedence))
+            elif python and opcode == _COMPARE and arg[0] is not _unwrap(arg[0]):
+                #: guarded comparisons cannot be chained, so the middle operand is kept
+                #: for the next comparison
+                right, _ = stack.pop()
+                left, _ = stack.pop()
+                middle = f"{prefix}m{position}"
+                _, precedence = _BOOL_SYMBOLS[_JUMP_IF_FALSE_OR_POP]
+                joins.setdefault(position + 1 + arg[1], []).append(
+                    (f"{bind(arg[0])}({left}, ({middle} := {right})) and", precedence)
+                )
+                stack.append((middle, _ATOM_PRECEDENCE))
+            elif opcode == _COMPARE:
+                symbol, precedence = _OPERATOR_SYMBOLS[_unwrap(arg[0])]
+                right_operand = stack.pop()
+                left, left_precedence = stack.pop()
+                if left_precedence <= precedence:
+                    left = f"({left})"
+                joins.setdefault(position + 1 + arg[1], []).append((f"{left} {symbol}", precedence))
+                stack.append(right_operand)
+            elif opcode == _POP_JUMP_IF_FALSE:
+                text, precedence = stack.pop()
+                conditions[position + arg] = text if precedence > _IF_PRECEDENCE else f"({text})"
+            elif opcode == _JUMP:
+                text, precedence = stack.pop()
+                if precedence <= _IF_PRECEDENCE:
+                    text = f"({text})"
+                joins.setdefault(position + 1 + arg, []).append(
+                    (f"{text} if {conditions.pop(position)} else", _IF_PRECEDENCE)
+                )
+            else:
+                symbol, precedence = _BOOL_SYMBOLS[opcode]
+                text, left_precedence = stack.pop()
+                if left_precedence < precedence:
+                    text = f"({text})"
+                joins.setdefault(position + 1 + arg, []).append((f"{text} {symbol}", precedence))
+        return statements, stack[-1][0] if stack else "", bound
+
+    def _bind(self, variables: Optional[Mapping[str, Any]]) -> List[Any]:
+        """Look up the values of all used variables in order of their index."""
+        if not self.names:
+            return []
+        if variables is None:
+            variables = {}
+        try:
+            return [variables[name] for name in self.names]
+        except KeyError as exc:
+            raise StringCalculatorError(
+                f"Expression `{self.expression}` has no value for variable: `{exc.args[0]}`."
+            ) from exc
+
+    def _run(
+        self, values: Sequence[Any], code: Optional[Tuple[_Instruction, ...]] = None
+    ) -> Optional[NumberType]:
+        """Run the program or the given variant of it with the given variable values."""
+        if not self._opcodes:
+            return None
+        if self._empty_slots:
+            values = [*values, *self._empty_slots]
+
+        stack: List[Any] = []
+        push = stack.append
+        pop = stack.pop
+        instructions = iter(code) if code is not None else zip(self._opcodes, self._args)
+        islice = itertools.islice
+        deadline = None
+        if self.limits.timeout is not None:
+            deadline = _DEADLINE.set(min(_DEADLINE.get(), time.monotonic() + self.limits.timeout))
+        outer_context = None
+        if self.decimal_context is not None:
+            outer_context = decimal.getcontext()
+            decimal.setcontext(self.decimal_context.copy())
+        try:
+            for opcode, arg in instructions:
+                if opcode == _BINARY:
+                    right = pop()
+                    stack[-1] = arg(stack[-1], right)
+                elif opcode == _NAME:
+                    push(values[arg])
+                elif opcode == _CONST:
+                    push(arg)
+                elif opcode == _UNARY:
+                    stack[-1] = arg(stack[-1])
+                elif opcode == _CALL:
+                    func, count, _ = arg
+                    position = len(stack) - count
+                    args = stack[position:]
+                    del stack[position:]
+                    push(func(*args))
+                elif opcode == _STORE:
+                    values[arg] = pop()  # type: ignore[index]
+                elif opcode == _SET:
+                    values[arg] = stack[-1]  # type: ignore[index]
+                elif opcode == _COMPARE:
+                    func, skip = arg
+                    right = pop()
+                    result = func(stack[-1], right)
+                    if result:
+                        stack[-1] = right
+                    else:
+                        stack[-1] = result
+                        next(islice(instructions, skip, skip), None)
+                elif opcode == _POP_JUMP_IF_FALSE:
+                    if not pop():
+                        next(islice(instructions, arg, arg), None)
+                elif opcode == _JUMP:
+                    next(islice(instructions, arg, arg), None)
+                elif bool(stack[-1]) is (opcode == _JUMP_IF_TRUE_OR_POP):
+                    next(islice(instructions, arg, arg), None)
+                else:
+                    pop()
+        except ValueError as exc:
+            raise self._error(exc) from exc
+        finally:
+            if deadline is not None:
+                _DEADLINE.reset(deadline)
+            if outer_context is not None:
+                decimal.setcontext(outer_context)
+        return stack[-1]  # type: ignore[no-any-return]
+
+    def evaluate(self, variables: Optional[Mapping[str, Any]] = None) -> Optional[NumberType]:
+        """Evaluate the compiled expression.
+
+        Python exceptions are risen like with normal arithmetic expression e.g.
+        :class:`ZeroDivisionError`.
+
+        :param variables: Mapping of variable names to their values.
+        :raises StringCalculatorError: if the expression cannot be calculated or a
+            variable has no value.
+        :return: Result or None for an empty expression.
+        """
+        return self._run(self._bind(variables))
+
+    __call__ = evaluate
+
+    def _evaluate_until(
+        self, variables: Optional[Mapping[str, Any]], timeout: Optional[float]
+    ) -> Optional[NumberType]:
+        """Evaluate the compiled expression, aborted before an operation after the timeout.
+
+        The deadline is checked like with the ``timeout`` limit, whichever ends first.
+        The program checking it is kept for further calls with the same timeout.
+        """
+        if timeout is None:
+            return self.evaluate(variables)
+        if self._deadline_program is None or self._deadline_program[0] != timeout:
+            self._deadline_program = (timeout, _deadline_code(self._code, timeout))
+        code = self._deadline_program[1]
+        deadline = _DEADLINE.set(min(_DEADLINE.get(), time.monotonic() + timeout))
+        try:
+            return self._run(self._bind(variables), code)
+        finally:
+            _DEADLINE.reset(deadline)
+
+    def evaluate_many(self, rows: Iterable[Mapping[str, Any]]) -> List[Optional[NumberType]]:
+        """Evaluate the compiled expression for each mapping of variables.
+
+        :param rows: Mappings of variable names to their values.
+        :raises StringCalculatorError: if the expression cannot be calculated or a
+            variable has no value.
+        :return: List of results in order of the given rows.
+        """
+        run = self._run
+        bind = self._bind
+        return [run(bind(row)) for row in rows]
+
+    def evaluate_columns(
+        self, columns: Mapping[str, Sequence[Any]], engine: str = "python"
+    ) -> Any:  # noqa: ANN401
+        """Evaluate the compiled expression for each row of the given columns.
+
+        Available engines:
+
+            - ``python`` runs the program once per row and returns a :class:`list`.
+            - ``numpy`` runs the program once over whole arrays with NumPy ufuncs like
+              :data:`numpy.add` and returns a :class:`numpy.ndarray`. NumPy's semantics
+              apply, e.g. fixed width integers can overflow and division by zero
+              results in ``inf`` instead of raising :class:`ZeroDivisionError`.
+              :class:`Limits` are not enforced. Programs with conditions, ``and``,
+              ``or`` or chained comparisons are run once per row, so operands are
+              only evaluated for the rows they are reached in. Requires the ``numpy``
+              extra.
+            - ``auto`` returns the results of ``python``, but calculates them like
+              ``numpy`` if NumPy is installed and calculates them the same: for columns
+              of floats and programs of only ``+``, ``-``, ``*``, ``/``, comparisons,
+              ``not``, :func:`abs`, :func:`math.fabs` and :func:`math.sqrt`, if no
+              floating point error occurs.
+
+        :param columns: Mapping of variable names to equally long sequences of values.
+        :param engine: Evaluation engine to use.
+
+            Default: ``python``
+        :raises StringCalculatorError: if the expression cannot be calculated, a
+            variable has no column or the columns differ in length.
+        :raises ModuleNotFoundError: if the ``numpy`` engine is used but NumPy is not
+            installed.
+        :raises ValueError: if the engine is unknown.
+        :return: Results in order of the rows.
+        """
+        if engine not in ("python", "numpy", "auto"):
+            raise ValueError(f"Unknown engine `{engine}`.")
+        lengths = {len(column) for column in columns.values()}
+        if len(lengths) > 1:
+            raise StringCalculatorError(
+                f"Columns for expression `{self.expression}` differ in length."
+            )
+        size = lengths.pop() if lengths else 0
+
+        numpy = _import_numpy() if engine != "python" else None
+        if engine == "numpy":
+            if numpy is None:
+                raise ModuleNotFoundError("The `numpy` engine requires NumPy to be installed.")
+            return self._evaluate_numpy(numpy, columns, size)
+        if numpy is not None and self.names:
+            results = self._evaluate_numpy_exact(numpy, columns, size)
+            if results is not None:
+                return results
+
+        data = self._bind(columns)
+        run = self._run
+        if not data:
+            return [run(data) for _ in range(size)]
+        return [run(values) for values in zip(*data)]
+
+    def _evaluate_numpy(
+        self, numpy: Any, columns: Mapping[str, Sequence[Any]], size: int  # noqa: ANN401
+    ) -> Any:  # noqa: ANN401
+        """Run the program once over the columns as arrays using NumPy ufuncs.
+
+        Programs which cannot be run over whole arrays are run once per row instead.
+        """
+        code = _numpy_code(numpy, self._code)
+        if code is None:
+            return numpy.asarray(self.evaluate_columns(columns))
+        result = self._run([numpy.asarray(column) for column in self._bind(columns)], code)
+        if numpy.ndim(result) == 0:
+            return numpy.full(size, result)
+        return result
+
+    def _evaluate_numpy_exact(
+        self, numpy: Any, columns: Mapping[str, Sequence[Any]], size: int  # noqa: ANN401
+    ) -> Optional[List[Any]]:
+        """Run the program over the columns like :meth:`_evaluate_numpy` if exact.
+
+        Returns ``None`` if the program, the columns or a floating point error could
+        make the results differ from the ones of the ``python`` engine.
+        """
+        for opcode, arg in zip(self._opcodes, self._args):
+            func = arg[0] if opcode == _CALL else arg
+            if opcode in (_UNARY, _BINARY, _CALL) and _unwrap(func) not in _NUMPY_EXACT:
+                return None
+        code = _numpy_code(numpy, self._code)
+        if code is None:
+            return None
+        arrays = []
+        for column in self._bind(columns):
+            array = numpy.asarray(column)
+            if array.dtype != numpy.float64 or not (
+                isinstance(column, numpy.ndarray) or all(isinstance(x, float) for x in column)
+            ):
+                return None
+            arrays.append(array)
+        try:
+            with numpy.errstate(all="raise", under="ignore"):
+                result = self._run(arrays, code)
+        except (ArithmeticError, StringCalculatorError):
+            return None
+        if numpy.ndim(result) == 0:
+            result = numpy.full(size, result)
+        return result.tolist()  # type: ignore[no-any-return,union-attr]
+
+    def evaluate_interval(
+        self, variables: Optional[Mapping[str, Any]] = None
+    ) -> Any:  # noqa: ANN401
+        """Evaluate the compiled expression for variables with uncertain values.
+
+        Variables can be given as :class:`Interval`, e.g. created with
+        :meth:`Interval.from_uncertainty`, or as numbers. The operators of the program
+        are applied to the intervals and the :data:`DEFAULT_FUNCTIONS` are replaced by
+        versions for intervals, so the result contains the results for all values of
+        the variables. Other functions get the intervals as arguments.
+
+        The bounds can be wider than the actual results if a variable is used more than
+        once, e.g. ``x - x`` results in ``Interval(-1, 1)`` for ``x`` in
+        ``Interval(0, 1)``. The ``max_bits`` limit is not checked for bounds.
+
+        .. testsetup::
+
+            from formelsammlung.strcalc import Interval, compile_expression
+
+        .. doctest::
+
+            >>> compiled = compile_expression("load / capacity * 100")
+            >>> compiled.evaluate_interval(
+            ...     {"load": Interval(30, 45), "capacity": Interval.from_uncertainty(50, 10)}
+            ... )
+            Interval(50.0, 112.5)
+
+        :param variables: Mapping of variable names to intervals or numbers.
+        :raises StringCalculatorError: if the expression cannot be calculated, e.g. a
+            comparison or condition is not decided for all values of the intervals.
+        :return: Interval of the results or number if no interval was used.
+        """
+        if self._interval_program is None:
+            self._interval_program = _interval_code(self._code, self.limits)
+        return self._run(self._bind(variables), self._interval_program)
+
+    def to_function(self) -> Callable[..., Any]:
+        """Translate the compiled program to a native Python function.
+
+        The function takes the variables in the order of :attr:`names` as positional
+        or keyword arguments and runs at the speed of CPython bytecode without the
+        program's evaluation loop. It is generated from the validated program only, so
+        it contains just the enabled operators, the bound functions and the variables.
+        Limits and the decimal context apply like with :meth:`evaluate`. The function
+        is created once and reused by later calls.
+
+        .. testsetup::
+
+            from formelsammlung.strcalc import compile_expression
+
+        .. doctest::
+
+            >>> function = compile_expression("a * (b + 1)").to_function()
+            >>> function(2, 3), function(a=2, b=4)
+            (8, 10)
+
+        :raises StringCalculatorError: if the program is nested too deeply for
+            :func:`compile`.
+        :return: Function calculating the expression
+        """
+        if self._function is not None:
+            return self._function
+        names = (*self.names, *self.local_names)
+        prefix = "_"
+        while any(name.startswith(prefix) for name in names):
+            prefix += "_"
+        statements, result, bound = self._decompile(prefix)
+        bound[f"{prefix}ValueError"] = ValueError
+        bound[f"{prefix}error"] = self._error
+        source = "\n".join(
+            [
+                f"def {prefix}make({', '.join(bound)}):",
+                f"    def {prefix}function({', '.join(self.names)}):",
+                "        try:",
+                *(f"            {statement}" for statement in statements),
+                f"            return {result or None}",
+                f"        except {prefix}ValueError as {prefix}exc:",
+                f"            raise {prefix}error({prefix}exc) from {prefix}exc",
+                f"    return {prefix}function",
+            ]
+        )
+        try:
+            code = compile(source, f"<strcalc {self.expression!r}>", "exec")
+        except (RecursionError, SyntaxError, MemoryError) as exc:
+            raise StringCalculatorError(
+                f"Expression `{self.expression}` is nested too deeply to be compiled."
+            ) from exc
+        #: the source only refers to the arguments and names bound below, no builtins
+        namespace: Dict[str, Any] = {"__builtins__": {}}
+        exec(code, namespace)  # noqa: S102  # pylint: disable=exec-used
+        function: Callable[..., Any] = namespace[f"{prefix}make"](*bound.values())
+
+        timeout, context = self.limits.timeout, self.decimal_context
+        if timeout is not None or context is not None:
+            native = function
+
+            @functools.wraps(native)
+            def function(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+                deadline = None
+                if timeout is not None:
+                    deadline = _DEADLINE.set(min(_DEADLINE.get(), time.monotonic() + timeout))
+                try:
+                    if context is None:
+                        return native(*args, **kwargs)
+                    with decimal.localcontext(context):
+                        return native(*args, **kwargs)
+                finally:
+                    if deadline is not None:
+                        _DEADLINE.reset(deadline)
+
+        self._function = function
+        return function
+
+    def _error(self, exc: ValueError) -> StringCalculatorError:
+        """Create the error for a failed calculation."""
+        return StringCalculatorError(
+            f"Expression `{self.expression}` could not be calculated due to: `{exc}`."
+        )
+
+    def to_bytes(self) -> bytes:
+        """Serialize the compiled program to a compact, versioned binary format.
+
+        Operators and functions are stored by name and bound again by
+        :meth:`StringCalculator.load`, so the expression is not parsed again. The data
+        is only readable with the same :data:`BYTECODE_VERSION` and
+        :data:`marshal.version`.
+
+        :raises ValueError: if the program contains a constant which cannot be
+            serialized.
+        :return: Serialized compiled expression
+        """
+        code = []
+        for opcode, arg in self._code:
+            if opcode == _CONST:
+                arg = _encode_constant(arg)
+            elif opcode in (_UNARY, _BINARY):
+                arg = _unwrap(arg).__name__
+            elif opcode == _COMPARE:
+                arg = (_unwrap(arg[0]).__name__, arg[1])
+            elif opcode == _CALL:
+                arg = (arg[2], arg[1])
+            code.append((opcode, arg))
+        payload = (
+            self.expression,
+            self.names,
+            self.local_names,
+            len(self._empty_slots) - len(self.local_names),
+            self.deduplicated_nodes,
+            self.decimal_context is not None,
+            tuple(code),
+        )
+        header = _BYTECODE_HEADER.pack(_BYTECODE_MAGIC, BYTECODE_VERSION, marshal.version)
+        return header + marshal.dumps(payload)
+
+
+def compile_expression(expression: str) -> CompiledExpression:
+    """Compile the given expression for repeated evaluation.
+
+    The expression is parsed and validated with the same rules as
+    :func:`calculate_string` but only once. The returned :class:`CompiledExpression`
+    can then be evaluated any number of times.
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import compile_expression
+
+    .. doctest::
+
+        >>> expr = compile_expression("(1+2)/3")
+        >>> expr.evaluate()
+        1.0
+
+    Variables can be used by name and their values are given on evaluation:
+
+    .. doctest::
+
+        >>> expr = compile_expression("price * (1 + tax)")
+        >>> expr.names
+        ('price', 'tax')
+        >>> expr.evaluate({"price": 10, "tax": 0.5})
+        15.0
+        >>> expr.evaluate_columns({"price": [10, 20], "tax": [0, 1]})
+        [10, 40]
+
+    Constant subexpressions are folded and the identities ``x * 1``, ``x - 0`` and
+    ``--x`` simplified on compilation:
+
+    .. doctest::
+
+        >>> compile_expression("(2**10) * x + 3*4 + --y * 1").simplified_expression
+        '1024 * x + 12 + y'
+
+    Structurally identical subexpressions are evaluated only once per evaluation:
+
+    .. doctest::
+
+        >>> compile_expression("(x+y) * (x+y) / (x+y)").deduplicated_nodes
+        6
+
+    :param expression: String with arithmetic expression.
+    :raises StringCalculatorError: if given expression contains unsupported elements
+        or is nested too deeply for :func:`ast.parse`.
+    :return: Compiled expression
+    """
+    return _DEFAULT_CALCULATOR.compile(expression)
+
+
+class CacheInfo(NamedTuple):
+    """Statistics of an :class:`ExpressionCache` or a :class:`DiskCache`."""
+
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    currsize: int
+
+
+class ExpressionCache:
+    """Thread-safe, size-bounded LRU cache of :class:`CompiledExpression` objects.
+
+    The cache is keyed by the expression string. When the cache is full the least
+    recently used expression is evicted. A ``maxsize`` of ``0`` disables the cache.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        compiler: Optional[Callable[[str], CompiledExpression]] = None,
+    ) -> None:
+        """Initialize an empty cache.
+
+        :param maxsize: Maximum number of cached expressions.
+
+            Default: ``1024``
+        :param compiler: Function to compile expressions on a cache miss.
+
+            Default: :func:`compile_expression`
+        """
+        self._compiler = compiler or compile_expression
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, CompiledExpression]" = OrderedDict()
+        self._maxsize = 0
+        self.maxsize = maxsize
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        """Return number of cached expressions."""
+        return len(self._data)
+
+    def __contains__(self, expression: object) -> bool:
+        """Check if the expression is cached without touching the LRU order."""
+        return expression in self._data
+
+    @property
+    def maxsize(self) -> int:
+        """Maximum number of cached expressions.
+
+        Lowering the value evicts the least recently used expressions; ``0`` disables
+        the cache.
+        """
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value: int) -> None:
+        """Set new value for ``maxsize`` and evict surplus entries."""
+        if value < 0:
+            raise ValueError("`maxsize` must not be negative.")
+        with self._lock:
+            self._maxsize = value
+            self._evict()
+
+    def _evict(self) -> None:
+        """Evict least recently used entries until ``maxsize`` is kept."""
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self._evictions += 1
+
+    def compile(self, expression: str) -> CompiledExpression:
+        """Return the cached compiled expression or compile and cache it.
+
+        :param expression: String with arithmetic expression.
+        :raises StringCalculatorError: if given expression contains unsupported
+            elements. Failed compilations are not cached.
+        :return: Compiled expression
+        """
+        with self._lock:
+            compiled = self._data.get(expression)
+            if compiled is not None:
+                self._hits += 1
+                self._data.move_to_end(expression)
+                return compiled
+            self._misses += 1
+
+        compiled = self._compiler(expression)
+
+        with self._lock:
+            if self._maxsize:
+                self._data[expression] = compiled
+                self._evict()
+        return compiled
+
+    def clear(self) -> None:
+        """Remove all cached expressions and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self) -> CacheInfo:
+        """Return the cache statistics."""
+        with self._lock:
+            return CacheInfo(
+                self._hits, self._misses, self._evictions, self._maxsize, len(self._data)
+            )
+
+    def memory_size(self) -> int:
+        """Return the approximate number of bytes used by the cached expressions.
+
+        This is the sum of :attr:`CompiledExpression.memory_size` of the cached
+        expressions and the size of the cache itself.
+        """
+        with self._lock:
+            compiled = list(self._data.values())
+            size = sys.getsizeof(self._data)
+        return size + sum(expression.memory_size for expression in compiled)
+
+
+class DiskCache:
+    """Persistent cache of serialized compiled expressions in a SQLite database.
+
+    The database file is shared by all processes using it and survives restarts, so
+    pre-forked workers parse each expression only once. Set it as ``disk_cache`` of a
+    :class:`StringCalculator` or with :func:`set_disk_cache`. Entries are keyed by a
+    hash of the expression and the calculator configuration, which identifies functions
+    by their name, module and qualified name. When the cache is full
+    the least recently used entries are evicted. All entries are dropped when the
+    library or :data:`BYTECODE_VERSION` changes.
+
+    Errors of the database like a locked or read-only file are ignored, so the cache
+    never makes a calculation fail.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, "os.PathLike[str]"],
+        max_entries: int = 100_000,
+        timeout: float = 5.0,
+    ) -> None:
+        """Initialize the cache; the database is opened on first use.
+
+        :param path: Path of the SQLite database file, which is created if missing.
+        :param max_entries: Maximum number of cached expressions.
+
+            Default: ``100_000``
+        :param timeout: Seconds to wait for other processes holding a database lock.
+
+            Default: ``5.0``
+        """
+        if max_entries < 1:
+            raise ValueError("`max_entries` must be positive.")
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connection: Optional["sqlite3.Connection"] = None
+        self._pid = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle only the configuration, e.g. for worker processes."""
+        return {"path": self.path, "max_entries": self.max_entries, "timeout": self.timeout}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Recreate the cache from the pickled configuration."""
+        self.__init__(**state)  # type: ignore[misc]  # pylint: disable=unnecessary-dunder-call
+
+    def __len__(self) -> int:
+        """Return number of cached expressions."""
+        import sqlite3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        with self._lock:
+            try:
+                row = self._connect().execute("SELECT COUNT(*) FROM programs").fetchone()
+            except sqlite3.DatabaseError:
+                return 0
+        return int(row[0])
+
+    def _connect(self) -> "sqlite3.Connection":
+        """Return the connection of this process and open it on first use.
+
+        Connections are not shared with forked processes as SQLite requires.
+
+        :raises sqlite3.DatabaseError: if the file is no usable database; the
+            connection is closed then.
+        """
+        import sqlite3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False
+        )
+        try:
+            connection.executescript(_DISK_CACHE_SCHEMA)
+            version = f"{__version__}/{BYTECODE_VERSION}/{marshal.version}"
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+                if row is None or row[0] != version:
+                    connection.execute("DELETE FROM programs")
+                    connection.execute(
+                        "INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)",
+                        (version,),
+                    )
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        self._connection, self._pid = connection, os.getpid()
+        return connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the serialized compiled expression for the key or ``None``.
+
+        :param key: Key of the expression, see :meth:`StringCalculator.compile`.
+        :return: Data for :meth:`StringCalculator.load` or ``None`` if not cached.
+        """
+        import sqlite3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        with self._lock:
+            try:
+                connection = self._connect()
+                row = connection.execute(
+                    "SELECT data FROM programs WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE programs SET used = ? WHERE key = ?", (time.time(), key)
+                    )
+            except sqlite3.DatabaseError:
+                row = None
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return row[0]  # type: ignore[no-any-return]
+
+    def set(self, key: str, data: bytes) -> None:
+        """Store the serialized compiled expression and evict surplus entries.
+
+        :param key: Key of the expression, see :meth:`StringCalculator.compile`.
+        :param data: Data created by :meth:`CompiledExpression.to_bytes`.
+        """
+        import sqlite3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        with self._lock:
+            try:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO programs (key, data, used) VALUES (?, ?, ?)",
+                    (key, data, time.time()),
+                )
+                surplus = (
+                    connection.execute("SELECT COUNT(*) FROM programs").fetchone()[0]
+                    - self.max_entries
+                )
+                if surplus > 0:
+                    self._evictions += connection.execute(
+                        "DELETE FROM programs WHERE key IN "
+                        "(SELECT key FROM programs ORDER BY used LIMIT ?)",
+                        (surplus,),
+                    ).rowcount
+            except sqlite3.DatabaseError:
+                pass
+
+    def clear(self) -> None:
+        """Remove all cached expressions and reset the statistics."""
+        import sqlite3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        with self._lock:
+            with contextlib.suppress(sqlite3.DatabaseError):
+                self._connect().execute("DELETE FROM programs")
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self) -> CacheInfo:
+        """Return the cache statistics of this process."""
+        size = len(self)
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self.max_entries, size)
+
+    def close(self) -> None:
+        """Close the database connection; it is opened again on next use."""
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+class _ProfileRecord:  # pylint: disable=too-few-public-methods
+    """Mutable statistics of a single expression."""
+
+    __slots__ = (
+        "compilations",
+        "compile_seconds",
+        "nodes",
+        "memory_hits",
+        "disk_hits",
+        "evaluations",
+        "evaluation_seconds",
+        "max_evaluation_seconds",
+        "errors",
+    )
+
+    def __init__(self) -> None:
+        """Initialize empty statistics."""
+        self.compilations = 0
+        self.compile_seconds = 0.0
+        self.nodes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evaluations = 0
+        self.evaluation_seconds = 0.0
+        self.max_evaluation_seconds = 0.0
+        self.errors: Dict[str, int] = {}
+
+
+#: Prometheus metrics exported by :meth:`ExpressionProfiler.to_prometheus`.
+_PROMETHEUS_METRICS = (
+    ("compilations_total", "counter", "Expressions parsed and compiled.", "compilations"),
+    ("compile_seconds_total", "counter", "Time spent parsing and compiling.", "compile_seconds"),
+    ("nodes", "gauge", "Number of ast nodes of the expression.", "nodes"),
+    ("evaluations_total", "counter", "Evaluations of the expression.", "evaluations"),
+    ("evaluation_seconds_total", "counter", "Time spent evaluating.", "evaluation_seconds"),
+    ("evaluation_seconds_max", "gauge", "Longest evaluation.", "max_evaluation_seconds"),
+)
+
+
+def _prometheus_label(value: str) -> str:
+    """Escape the value of a Prometheus label."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class ExpressionProfiler:
+    """Thread-safe recorder of per expression statistics of a :class:`StringCalculator`.
+
+    Set it as ``profiler`` of a calculator or with :func:`set_profiler` to find the
+    expressions costing the most time. :meth:`StringCalculator.calculate` records the
+    evaluation time, the cache hit state and the category of errors, i.e. the name of
+    the exception class. :meth:`StringCalculator.compile` records the parse time and
+    number of :mod:`ast` nodes. Evaluations of :class:`CompiledExpression` objects
+    are not recorded.
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import ExpressionProfiler, StringCalculator
+
+    .. doctest::
+
+        >>> profiler = ExpressionProfiler()
+        >>> calculator = StringCalculator(profiler=profiler)
+        >>> calculator.calculate("1 + x", {"x": 1}), calculator.calculate("1 + x", {"x": 2})
+        (2, 3)
+        >>> stats = profiler.as_dict()["1 + x"]
+        >>> stats["compilations"], stats["memory_hits"], stats["evaluations"], stats["nodes"]
+        (1, 1, 2, 5)
+    """
+
+    def __init__(self, max_expressions: int = 1000) -> None:
+        """Initialize empty statistics.
+
+        :param max_expressions: Maximum number of expressions with own statistics.
+            Further expressions are recorded together as ``<other>``.
+
+            Default: ``1000``
+        """
+        self.max_expressions = max_expressions
+        self._lock = threading.Lock()
+        self._records: Dict[str, _ProfileRecord] = {}
+
+    def _record(self, expression: str) -> _ProfileRecord:
+        """Return the statistics of the expression; call with the lock held."""
+        record = self._records.get(expression)
+        if record is None:
+            if len(self._records) >= self.max_expressions:
+                expression = "<other>"
+                record = self._records.get(expression)
+            if record is None:
+                record = self._records[expression] = _ProfileRecord()
+        return record
+
+    def record_compilation(self, expression: str, seconds: float, nodes: int) -> None:
+        """Record parsing and compiling the expression.
+
+        :param expression: The compiled expression string.
+        :param seconds: Time spent.
+        :param nodes: Number of :mod:`ast` nodes.
+        """
+        with self._lock:
+            record = self._record(expression)
+            record.compilations += 1
+            record.compile_seconds += seconds
+            record.nodes = nodes
+
+    def record_cache_hit(self, expression: str, cache: str = "memory") -> None:
+        """Record the expression was taken from a cache instead of parsing it.
+
+        :param expression: The expression string.
+        :param cache: ``memory`` for the :class:`ExpressionCache` or ``disk`` for the
+            :class:`DiskCache`.
+        """
+        with self._lock:
+            record = self._record(expression)
+            if cache == "disk":
+                record.disk_hits += 1
+            else:
+                record.memory_hits += 1
+
+    def record_evaluation(self, expression: str, seconds: float) -> None:
+        """Record a successful evaluation of the expression.
+
+        :param expression: The evaluated expression string.
+        :param seconds: Time spent.
+        """
+        with self._lock:
+            record = self._record(expression)
+            record.evaluations += 1
+            record.evaluation_seconds += seconds
+            if seconds > record.max_evaluation_seconds:
+                record.max_evaluation_seconds = seconds
+
+    def record_error(self, expression: str, error: BaseException) -> None:
+        """Record an error compiling or evaluating the expression.
+
+        :param expression: The expression string.
+        :param error: The risen exception whose class name is the category.
+        """
+        with self._lock:
+            errors = self._record(expression).errors
+            category = type(error).__name__
+            errors[category] = errors.get(category, 0) + 1
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Return the statistics by expression as plain dictionaries."""
+        with self._lock:
+            return {
+                expression: {
+                    **{name: getattr(record, name) for name in _ProfileRecord.__slots__},
+                    "errors": dict(record.errors),
+                }
+                for expression, record in self._records.items()
+            }
+
+    def most_expensive(self, count: int = 10) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return the expressions with the most time spent compiling and evaluating.
+
+        :param count: Maximum number of expressions to return.
+
+            Default: ``10``
+        :return: Pairs of expression and statistics, most expensive first
+        """
+        return sorted(
+            self.as_dict().items(),
+            key=lambda item: item[1]["compile_seconds"] + item[1]["evaluation_seconds"],
+            reverse=True,
+        )[:count]
+
+    def to_prometheus(self, prefix: str = "strcalc") -> str:
+        """Export the statistics in the Prometheus text exposition format.
+
+        Each expression is a value of the ``expression`` label.
+
+        :param prefix: Prefix of the metric names.
+
+            Default: ``strcalc``
+        :return: Metrics text
+        """
+        stats = self.as_dict()
+        labels = {expression: _prometheus_label(expression) for expression in stats}
+        lines = []
+        for name, kind, help_text, field in _PROMETHEUS_METRICS:
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} {kind}"]
+            lines += [
+                f'{prefix}_{name}{{expression="{labels[expression]}"}} {values[field]}'
+                for expression, values in stats.items()
+            ]
+        lines += [
+            f"# HELP {prefix}_cache_hits_total Expressions taken from a cache.",
+            f"# TYPE {prefix}_cache_hits_total counter",
+        ]
+        for cache in ("memory", "disk"):
+            lines += [
+                f'{prefix}_cache_hits_total{{expression="{labels[expression]}",cache="{cache}"}} '
+                f"{values[f'{cache}_hits']}"
+                for expression, values in stats.items()
+            ]
+        lines += [
+            f"# HELP {prefix}_errors_total Errors by exception class.",
+            f"# TYPE {prefix}_errors_total counter",
+        ]
+        lines += [
+            f'{prefix}_errors_total{{expression="{labels[expression]}",category="{category}"}} '
+            f"{number}"
+            for expression, values in stats.items()
+            for category, number in values["errors"].items()
+        ]
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        """Remove all statistics."""
+        with self._lock:
+            self._records.clear()
+
+
+class StringCalculator:
+    """Calculator for arithmetic expressions from strings with custom configuration.
+
+    :func:`compile_expression` and :func:`calculate_string` use a calculator with the
+    default configuration. Create an own instance once and reuse it to e.g. enforce
+    :class:`Limits` on untrusted input:
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import Limits, StringCalculator
+
+    .. doctest::
+
+        >>> calculator = StringCalculator(limits=Limits(max_exponent=100))
+        >>> calculator.calculate("2 ** 10")
+        1024
+        >>> calculator.calculate("9 ** 9 ** 9")
+        Traceback (most recent call last):
+        ...
+        formelsammlung.strcalc.StringCalculatorError: Expression `9 ** 9 ** 9` could not \
+be calculated due to: `Exponent exceeds the limit of 100.`.
+
+    With a ``number_type`` literals are parsed directly into :class:`decimal.Decimal`
+    or :class:`fractions.Fraction` for exact results:
+
+    .. doctest::
+
+        >>> from decimal import Decimal
+        >>> from fractions import Fraction
+        >>> StringCalculator(number_type=Decimal).calculate("0.1 + 0.2")
+        Decimal('0.3')
+        >>> StringCalculator(number_type=Fraction).calculate("1 / 3 + 0.5")
+        Fraction(5, 6)
+    """
+
+    def __init__(
+        self,
+        *,
+        limits: Optional[Limits] = None,
+        cache_size: int = 1024,
+        number_type: Optional[type] = None,
+        decimal_context: Optional[decimal.Context] = None,
+        functions: Optional[Mapping[str, Callable[..., Any]]] = None,
+        operators: Optional[Iterable[Callable[..., Any]]] = None,
+        disk_cache: Optional[DiskCache] = None,
+        profiler: Optional[ExpressionProfiler] = None,
+        parser: str = "auto",
+    ) -> None:
+        """Initialize :class:`StringCalculator` with config values.
+
+        .. Note:: Parameters below are all keyword only.
+
+        :param limits: Resource limits to enforce.
+
+            Default: no limits; ``Limits(max_bits=1_000_000)`` for ``number_type``
+            :class:`fractions.Fraction`
+        :param cache_size: Maximum number of compiled expressions kept in
+            :attr:`cache` for :meth:`StringCalculator.calculate`.
+
+            Default: ``1024``
+        :param number_type: :class:`decimal.Decimal` or :class:`fractions.Fraction` to
+            convert all number literals to; complex literals are rejected then. The
+            operators work on the converted numbers with the type's semantics, e.g.
+            :class:`decimal.Decimal` rounds results to the context precision and
+            :class:`fractions.Fraction` results in :class:`float` for non-integer
+            powers. Variable values are not converted.
+
+            Default: ``None`` (:class:`int`, :class:`float` and :class:`complex`)
+        :param decimal_context: Context for :class:`decimal.Decimal` arithmetic on
+            compilation and evaluation.
+
+            Default: new :class:`decimal.Context`
+        :param functions: Mapping of names to the functions callable in expressions.
+            Functions must be picklable for :func:`calculate_many` with processes.
+
+            Default: :data:`DEFAULT_FUNCTIONS`
+        :param operators: Functions from :mod:`operator` of the operators usable in
+            expressions, e.g. ``DEFAULT_OPERATORS - {operator.pow}`` for untrusted input
+            or ``DEFAULT_OPERATORS | BITWISE_OPERATORS``. See :data:`ALL_OPERATORS`.
+            Boolean and conditional expressions are always usable.
+
+            Default: :data:`DEFAULT_OPERATORS`
+        :param disk_cache: Persistent cache consulted by :meth:`StringCalculator.compile`
+            before parsing an expression.
+
+            Default: ``None``
+        :param profiler: Recorder of statistics of the compiled and calculated
+            expressions. It is not passed to worker processes.
+
+            Default: ``None``
+        :param parser: ``"auto"`` to compile expressions consisting only of numbers,
+            names, parentheses and the operators ``+ - * / // % **`` with a fast path
+            parser and all others from their :mod:`ast`; ``"ast"`` to always use
+            :func:`ast.parse`. Both result in the same program and errors.
+
+            Default: ``"auto"``
+        """
+        if parser not in ("auto", "ast"):
+            raise ValueError(f"Unknown parser `{parser}`.")
+        self.cache = ExpressionCache(cache_size, self.compile)
+        self.disk_cache = disk_cache
+        self.profiler = profiler
+        self.parser = parser
+        self._functions: Dict[str, Callable[..., Any]] = {}
+        self._operators = DEFAULT_OPERATORS
+        self._operator_tables = _OperatorTables({}, {}, {}, {})
+        self._operators_by_name: Dict[str, Callable[..., Any]] = {}
+        if limits is None and number_type is fractions.Fraction:
+            limits = Limits(max_bits=_FRACTION_MAX_BITS)
+        self.limits = limits or Limits()
+        self.number_type = number_type
+        self.decimal_context = decimal_context or decimal.Context()
+        self.functions = DEFAULT_FUNCTIONS if functions is None else functions
+        if operators is not None:
+            self.operators = operators
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle only the configuration, e.g. for worker processes."""
+        return {
+            "limits": self.limits,
+            "cache_size": self.cache.maxsize,
+            "number_type": self.number_type,
+            "decimal_context": self.decimal_context,
+            "functions": self._functions,
+            "operators": self._operators,
+            "disk_cache": self.disk_cache,
+            "parser": self.parser,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Recreate the calculator from the pickled configuration."""
+        self.__init__(**state)  # type: ignore[misc]  # pylint: disable=unnecessary-dunder-call
+
+    @property
+    def limits(self) -> Limits:
+        """Resource limits enforced on compilation and evaluation.
+
+        See parameters of :class:`StringCalculator`.
+        """
+        return self._limits
+
+    @limits.setter
+    def limits(self, value: Limits) -> None:
+        """Set new value for ``limits``, rebuild operators and clear the cache."""
+        self._limits = value
+        self._build_operator_tables()
+        self._build_function_table()
+
+    @property
+    def operators(self) -> FrozenSet[Callable[..., Any]]:
+        """Functions of the operators usable in expressions.
+
+        See parameters of :class:`StringCalculator`.
+        """
+        return self._operators
+
+    @operators.setter
+    def operators(self, value: Iterable[Callable[..., Any]]) -> None:
+        """Set new value for ``operators``, rebuild operators and clear the cache."""
+        value = frozenset(value)
+        unknown = value - ALL_OPERATORS
+        if unknown:
+            raise ValueError(f"Unsupported operators: {sorted(map(repr, unknown))}.")
+        self._operators = value
+        self._build_operator_tables()
+
+    def _build_operator_tables(self) -> None:
+        """Map the `ast` nodes to the enabled operators with limits and clear the cache.
+
+        The tables are only rebuilt on configuration changes, so the compiler gets the
+        operator of a node with a single lookup.
+        """
+        limits, operators = self._limits, self._operators
+        binary, unary, compare = (
+            {
+                node: _guard_operator(func, limits)
+                for node, func in table.items()
+                if func in operators
+            }
+            for table in (_BINARY_OPERATORS, _UNARY_OPERATORS, _COMPARE_OPERATORS)
+        )
+        self._operator_tables = self._operator_tables._replace(
+            binary=binary, unary=unary, compare=compare
+        )
+        self._operators_by_name = {
+            _unwrap(func).__name__: func
+            for table in (binary, unary, compare)
+            for func in table.values()
+        }
+        self.cache.clear()
+
+    @property
+    def functions(self) -> Mapping[str, Callable[..., Any]]:
+        """Read-only mapping of names to the functions callable in expressions.
+
+        See parameters of :class:`StringCalculator`.
+        """
+        return MappingProxyType(self._functions)
+
+    @functions.setter
+    def functions(self, value: Mapping[str, Callable[..., Any]]) -> None:
+        """Set new value for ``functions`` and clear the cache."""
+        for name, func in value.items():
+            _check_function(name, func)
+        self._functions = dict(value)
+        self._build_function_table()
+
+    def register_function(self, name: str, func: Callable[..., Any]) -> None:
+        """Make the function callable by name in expressions and clear the cache.
+
+        An already registered function with the same name is replaced.
+
+        :param name: Name to call the function with.
+        :param func: Function to call.
+        :raises ValueError: if the name is no valid identifier.
+        :raises TypeError: if the function is not callable.
+        """
+        _check_function(name, func)
+        self._functions[name] = func
+        self._build_function_table()
+
+    def unregister_function(self, name: str) -> None:
+        """Remove the function from the callable functions and clear the cache.
+
+        :param name: Name of the function.
+        :raises KeyError: if no function is registered with the name.
+        """
+        del self._functions[name]
+        self._build_function_table()
+
+    def _build_function_table(self) -> None:
+        """Bind the limits to the registered functions and clear the cache."""
+        self._operator_tables = self._operator_tables._replace(
+            functions={
+                name: _guard_operator(func, self._limits) for name, func in self._functions.items()
+            }
+        )
+        self.cache.clear()
+
+    @property
+    def number_type(self) -> Optional[type]:
+        """Type number literals are converted to.
+
+        See parameters of :class:`StringCalculator`.
+        """
+        return self._number_type
+
+    @number_type.setter
+    def number_type(self, value: Optional[type]) -> None:
+        """Set new value for ``number_type`` and clear the cache."""
+        if value not in (None, decimal.Decimal, fractions.Fraction):
+            raise ValueError(f"Unsupported number type `{value}`.")
+        self._number_type = value
+        self.cache.clear()
+
+    @property
+    def decimal_context(self) -> decimal.Context:
+        """Context for :class:`decimal.Decimal` arithmetic.
+
+        See parameters of :class:`StringCalculator`.
+        """
+        return self._decimal_context
+
+    @decimal_context.setter
+    def decimal_context(self, value: decimal.Context) -> None:
+        """Set new value for ``decimal_context`` and clear the cache."""
+        self._decimal_context = value
+        self.cache.clear()
+
+    def compile(self, expression: str) -> CompiledExpression:
+        """Compile the given expression for repeated evaluation.
+
+        See :func:`compile_expression`.
+
+        With a :attr:`disk_cache` the expression is loaded from it if it was compiled
+        with the same configuration before and otherwise stored in it after compiling.
+
+        :param expression: String with arithmetic expression.
+        :raises StringCalculatorError: if given expression contains unsupported elements,
+            is nested too deeply for :func:`ast.parse` or violates the limits.
+        :return: Compiled expression
+        """
+        max_length = self.limits.max_length
+        if max_length is not None and len(expression) > max_length:
+            raise StringCalculatorError(
+                f"Expression exceeds the length limit of {max_length} characters."
+            )
+
+        disk_cache = self.disk_cache
+        if disk_cache is None:
+            return self._compile(expression)
+        key = self._disk_cache_key(expression)
+        data = disk_cache.get(key)
+        if data is not None:
+            try:
+                compiled = self.load(data)
+            except (ValueError, StringCalculatorError):
+                pass
+            else:
+                if self.profiler is not None:
+                    self.profiler.record_cache_hit(expression, "disk")
+                return compiled
+        compiled = self._compile(expression)
+        try:
+            data = compiled.to_bytes()
+        except ValueError:
+            return compiled
+        disk_cache.set(key, data)
+        return compiled
+
+    def _disk_cache_key(self, expression: str) -> str:
+        """Hash the expression together with the configuration affecting compilation."""
+        import hashlib  # pylint: disable=import-outside-toplevel
 
-class StringCalculatorError(Exception):
-    """Exception for the StringCalculator."""
+        context = self.decimal_context
+        config = (
+            self.limits,
+            getattr(self.number_type, "__name__", None),
+            (
+                (context.prec, context.rounding, context.Emin, context.Emax, context.clamp)
+                if self.number_type is decimal.Decimal
+                else None
+            ),
+            sorted(_unwrap(func).__name__ for func in self.operators),
+            sorted(
+                (name, getattr(func, "__module__", None), getattr(func, "__qualname__", None))
+                for name, func in self._functions.items()
+            ),
+        )
+        text = f"{config!r}\0{expression}"
+        return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def _compile(self, expression: str) -> CompiledExpression:
+        """Parse and compile the expression."""
+        start = time.perf_counter()
+        decimal_context = self.decimal_context if self.number_type is decimal.Decimal else None
+        if decimal_context is not None:
+            with decimal.localcontext(decimal_context):
+                compiler = self._parse(expression)
+        else:
+            compiler = self._parse(expression)
+        if self.profiler is not None:
+            self.profiler.record_compilation(
+                expression, time.perf_counter() - start, compiler.node_count
+            )
+        return CompiledExpression(
+            expression,
+            compiler.code,
+            compiler.names,
+            self.limits,
+            decimal_context,
+            compiler.local_names,
+            compiler.temp_count,
+            compiler.deduplicated_nodes,
+        )
+
+    def _parse(self, expression: str) -> _Compiler:
+        """Compile the expression with the fast path parser or from its :mod:`ast`.
+
+        Expressions too deep for :func:`ast.parse`, like long chains of operators or
+        deeply nested parentheses, are parsed by :func:`_parse_deep` if they only use
+        the syntax supported by the compiler. Depending on the Python version
+        :func:`ast.parse` fails on them with :class:`RecursionError`,
+        :class:`MemoryError` or :class:`SyntaxError`.
+        """
+        compiler = _Compiler(self, self._operator_tables, expression)
+        if expression == "" or (self.parser == "auto" and compiler.compile_simple()):
+            return compiler
+        compiler = _Compiler(self, self._operator_tables, expression)
+        try:
+            tree = ast.parse(expression)
+        except (RecursionError, MemoryError, SyntaxError) as exc:
+            if isinstance(exc, SyntaxError) and exc.msg != "too many nested parentheses":
+                raise
+            try:
+                tree = _parse_deep(expression)
+            except ValueError:
+                raise StringCalculatorError(
+                    f"Expression `{expression}` is nested too deeply to be parsed."
+                ) from exc
+        try:
+            compiler.visit(tree)
+        except KeyError as exc:
+            raise StringCalculatorError(
+                f"Expression `{expression}` has unsupported node: `{exc}`."
+            ) from exc
+        except ValueError as exc:
+            raise StringCalculatorError(
+                f"Expression `{expression}` could not be calculated due to: `{exc}`."
+            ) from exc
+        return compiler
+
+    def load(self, data: bytes) -> CompiledExpression:
+        """Load a compiled expression serialized by :meth:`CompiledExpression.to_bytes`.
+
+        The expression is not parsed again. Operators and functions are bound by name
+        to the ones of this calculator, which should be configured like the one which
+        compiled the expression.
 
+        :param data: Serialized compiled expression, e.g. a slice of a memory map.
+        :raises ValueError: if the data is no serialized compiled expression of this
+            format version, is corrupt, e.g. contains unknown opcodes, slots or jump
+            targets, or was compiled for another number type.
+        :raises StringCalculatorError: if the expression uses an operator or function
+            not available in this calculator.
+        :return: Compiled expression
+        """
+        _check_header(_BYTECODE_HEADER, _BYTECODE_MAGIC, data)
+        try:
+            payload = marshal.loads(memoryview(data)[_BYTECODE_HEADER.size :])
+            expression, names, local_names, temp_count, deduplicated_nodes, is_decimal, code = (
+                payload
+            )
+        except (EOFError, TypeError, ValueError) as exc:
+            raise ValueError("Serialized compiled expression is corrupt.") from exc
+
+        decimal_context = self.decimal_context if self.number_type is decimal.Decimal else None
+        if is_decimal is not (decimal_context is not None):
+            raise ValueError(
+                f"Expression `{expression}` was compiled for another number type than "
+                f"`{self.number_type}`."
+            )
+        operators = self._operators_by_name
+        functions = self._operator_tables.functions
+        program: List[_Instruction] = []
+        try:
+            slot_count = len(names) + len(local_names) + temp_count
+            for position, (opcode, arg) in enumerate(code):
+                if opcode == _CONST:
+                    arg = _decode_constant(arg)
+                elif opcode == _NAME:
+                    _check_index(arg, slot_count)
+                elif opcode in (_STORE, _SET):
+                    _check_index(arg, slot_count, len(names))
+                elif opcode in (_UNARY, _BINARY):
+                    arg = operators[arg]
+                elif opcode == _COMPARE:
+                    #: jumps go forward to an instruction or the end of the program
+                    _check_index(arg[1], len(code) - position)
+                    arg = (operators[arg[0]], arg[1])
+                elif opcode == _CALL:
+                    _check_index(arg[1], position + 1)
+                    arg = (functions[arg[0]], arg[1], arg[0])
+                elif opcode in (
+                    _JUMP,
+                    _JUMP_IF_FALSE_OR_POP,
+                    _JUMP_IF_TRUE_OR_POP,
+                    _POP_JUMP_IF_FALSE,
+                ):
+                    _check_index(arg, len(code) - position)
+                else:
+                    raise ValueError(f"Unknown opcode `{opcode!r}`.")
+                program.append((opcode, arg))
+        except KeyError as exc:
+            raise StringCalculatorError(
+                f"Expression `{expression}` uses unavailable operator or function: `{exc}`."
+            ) from exc
+        except (IndexError, TypeError, ValueError) as exc:
+            raise ValueError(f"Serialized compiled expression is corrupt: {exc}") from exc
+        return CompiledExpression(
+            expression,
+            program,
+            names,
+            self.limits,
+            decimal_context,
+            local_names,
+            temp_count,
+            deduplicated_nodes,
+        )
+
+    def calculate(
+        self, expression: str, variables: Optional[Mapping[str, NumberType]] = None
+    ) -> Optional[NumberType]:
+        """Calculate the given expression using the :attr:`cache`.
+
+        See :func:`calculate_string`.
 
-class _StringCalculator(ast.NodeVisitor):
-    """Calculate an arithmetic expression from a string using :mod:`ast`."""
-
-    def visit_BinOp(self, node: ast.BinOp) -> NumberType:  # noqa: N802
-        """Handle `BinOp` nodes."""
-        return {  # type: ignore[no-any-return]
-            ast.Add: operator.add,  #: a + b
-            ast.Sub: operator.sub,  #: a - b
-            ast.Mult: operator.mul,  #: a * b
-            ast.Pow: operator.pow,  #: a ** b
-            ast.Div: operator.truediv,  #: a / b
-            ast.FloorDiv: operator.floordiv,  #: a // b
-            ast.Mod: operator.mod,  #: a % b
-        }[type(node.op)](self.visit(node.left), self.visit(node.right))
-
-    # fmt: off
-    def visit_UnaryOp(self, node: ast.UnaryOp) -> NumberType:  # noqa: N802
-        """Handle `UnaryOp` nodes."""
-        return {  # type: ignore[no-any-return, operator]
-            ast.UAdd: operator.pos,  #: + a
-            ast.USub: operator.neg,  #: - a
-        }[type(node.op)](self.visit(node.operand))
-    # fmt: on
-
-    def visit_Constant(  # noqa: N802
+        :param expression: String with arithmetic expression.
+        :param variables: Mapping of variable names to their values.
+        :raises StringCalculatorError: if given expression cannot be calculated.
+        :return: Result or None
+        """
+        if self.profiler is None:
+            return self.cache.compile(expression).evaluate(variables)
+        return self._evaluate(self._compile_cached(expression), variables)
+
+    def _compile_cached(self, expression: str) -> CompiledExpression:
+        """Compile the expression using the :attr:`cache` and record it with the profiler."""
+        profiler = self.profiler
+        if profiler is None:
+            return self.cache.compile(expression)
+        if expression in self.cache:
+            profiler.record_cache_hit(expression)
+        try:
+            return self.cache.compile(expression)
+        except Exception as exc:
+            profiler.record_error(expression, exc)
+            raise
+
+    def _evaluate(
         self,
-        node: ast.Constant,
-    ) -> NumberType:  # pragma: py-lt-38
-        """Handle `Constant` nodes."""
-        ret_val = node.value
-        if not isinstance(ret_val, NUMBERTYPES) or isinstance(ret_val, bool):
-            raise ValueError(f"Extracted `Constant` is not of type {NumberType}.")
-        return ret_val
+        compiled: CompiledExpression,
+        variables: Optional[Mapping[str, NumberType]],
+        timeout: Optional[float] = None,
+    ) -> Optional[NumberType]:
+        """Evaluate the compiled expression and record it with the profiler.
 
-    @staticmethod
-    def visit_Num(node: ast.Num) -> NumberType:  # noqa: N802
-        """Handle `Num` nodes.
+        With a ``timeout`` the evaluation is aborted before an operation after it.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            return compiled._evaluate_until(variables, timeout)
+        try:
+            start = time.perf_counter()
+            result = compiled._evaluate_until(variables, timeout)
+        except Exception as exc:
+            profiler.record_error(compiled.expression, exc)
+            raise
+        profiler.record_evaluation(compiled.expression, time.perf_counter() - start)
+        return result
+
+    async def calculate_async(
+        self,
+        expression: str,
+        variables: Optional[Mapping[str, NumberType]] = None,
+        *,
+        timeout: Optional[float] = None,
+        executor: Optional["Executor"] = None,
+        max_inline_length: int = 200,
+        max_inline_cost: float = 200,
+    ) -> Optional[NumberType]:
+        """Calculate the given expression without blocking the running event loop.
+
+        See :func:`calculate_string_async`.
+
+        :param expression: String with arithmetic expression.
+        :param variables: Mapping of variable names to their values.
+        :param timeout: Seconds after which the calculation is aborted.
+
+            Default: no timeout
+        :param executor: Executor to offload expensive calculations to.
+
+            Default: a worker process for expressions of unknown or infinite cost if
+            the calculator and variables can be pickled, else the default executor of
+            the event loop
+        :param max_inline_length: Maximum length of an uncached expression to compile in
+            the event loop.
+
+            Default: ``200``
+        :param max_inline_cost: Maximum :attr:`CompiledExpression.cost` of an expression
+            to evaluate in the event loop.
 
-        For backwards compatibility <3.8. Since 3.8 ``visit_Constant`` is used.
+            Default: ``200``
+        :raises StringCalculatorError: if given expression cannot be calculated or the
+            timeout expired.
+        :return: Result or None
         """
-        return node.n  # pragma: py-gte-38
+        import asyncio  # pylint: disable=import-outside-toplevel
 
-    def visit_Expr(self, node: ast.Expr) -> NumberType:  # noqa: N802
-        """Handle `Expr` nodes."""
-        # safety hurdle from visist_Constant for backwards compatibility
-        if sys.version_info[0:2] < (3, 8):  # pragma: py-gte-38
-            ret_val = self.visit(node.value)
-            if not isinstance(ret_val, NUMBERTYPES) or isinstance(ret_val, bool):
-                raise ValueError(f"`Expr` did not return a {NumberType}.")
-            return ret_val
+        compiled = None
+        if expression in self.cache or len(expression) <= max_inline_length:
+            compiled = self._compile_cached(expression)
+            if compiled.cost <= max_inline_cost:
+                return self._evaluate(compiled, variables, timeout)
+
+        if executor is None and (compiled is None or compiled.cost == math.inf):
+            #: big integer operations hold the GIL, so a thread would block the event loop
+            request = self._calculation_request(compiled, expression, variables, timeout)
+            if request is not None:
+                return await _calculate_in_process(request, expression, timeout)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            executor, self._calculate_until, compiled, expression, variables, timeout
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as exc:
+            raise _timeout_error(expression, timeout) from exc
+
+    def _calculation_request(
+        self,
+        compiled: Optional[CompiledExpression],
+        expression: str,
+        variables: Optional[Mapping[str, NumberType]],
+        timeout: Optional[float],
+    ) -> Optional[bytes]:
+        """Pickle the calculation for a worker process or return ``None`` if impossible.
+
+        The compiled program is sent serialized, so the worker does not parse the
+        expression again.
+        """
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        data = None
+        if compiled is not None:
+            with contextlib.suppress(ValueError):
+                data = compiled.to_bytes()
+        try:
+            return pickle.dumps((pickle.dumps(self), data, expression, variables, timeout))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def _calculate_until(
+        self,
+        compiled: Optional[CompiledExpression],
+        expression: str,
+        variables: Optional[Mapping[str, NumberType]],
+        timeout: Optional[float],
+    ) -> Optional[NumberType]:
+        """Calculate the expression in a worker, aborted before an operation after the timeout.
+
+        The expression is only compiled if no compiled program is given.
+        """
+        if compiled is None:
+            compiled = self._compile_cached(expression)
+        return self._evaluate(compiled, variables, timeout)
+
+
+def _timeout_error(expression: str, timeout: Optional[float]) -> StringCalculatorError:
+    """Create the error for an offloaded calculation which exceeded the timeout."""
+    return StringCalculatorError(
+        f"Expression `{expression}` could not be calculated due to: "
+        f"`Evaluation exceeded the time limit of {timeout} seconds.`."
+    )
+
+
+def _serve_calculations(connection: "multiprocessing.connection.Connection") -> None:
+    """Send the results of the calculations received until the connection is closed.
+
+    The calculator of the last request is kept with its cache for the next ones.
+    """
+    import pickle  # pylint: disable=import-outside-toplevel
+
+    calculators: Dict[bytes, StringCalculator] = {}
+    while True:
+        try:
+            request = connection.recv_bytes()
+        except EOFError:
+            return
+        try:
+            state, data, expression, variables, timeout = pickle.loads(request)
+            if state not in calculators:
+                calculators = {state: pickle.loads(state)}
+            calculator = calculators[state]
+            compiled = None if data is None else calculator.load(data)
+            outcome: Tuple[Optional[NumberType], Optional[Exception]] = (
+                calculator._calculate_until(  # pylint: disable=protected-access
+                    compiled, expression, variables, timeout
+                ),
+                None,
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            outcome = (None, exc)
+        try:
+            connection.send(outcome)
+        except Exception as exc:  # pylint: disable=broad-except
+            connection.send((None, StringCalculatorError(f"Result cannot be sent: {exc}")))
+
+
+class _Worker(NamedTuple):
+    """Process calculating offloaded expressions received by :func:`_serve_calculations`."""
+
+    process: "multiprocessing.process.BaseProcess"
+    connection: "multiprocessing.connection.Connection"
+
+    @classmethod
+    def start(cls) -> "_Worker":
+        """Start a worker by the ``forkserver`` or ``spawn`` method.
+
+        Forking a process with threads, e.g. of the executor of an event loop, can
+        deadlock.
+        """
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+
+        context: Union[
+            "multiprocessing.context.ForkServerContext", "multiprocessing.context.SpawnContext"
+        ] = multiprocessing.get_context("spawn")
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        connection, child_connection = context.Pipe()
+        process = context.Process(target=_serve_calculations, args=(child_connection,), daemon=True)
+        process.start()
+        child_connection.close()
+        return cls(process, connection)
+
+    def stop(self) -> None:
+        """Kill the process and close the connection."""
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class _WorkerPool:
+    """Worker processes reused for calculations offloaded from event loops.
+
+    Each worker calculates one expression at a time. Up to the number of CPUs idle
+    workers are kept.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the pool without workers."""
+        self._idle: List[_Worker] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> _Worker:
+        """Return an idle worker or a new one."""
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.process.is_alive():
+                    return worker
+                worker.stop()
+        return _Worker.start()
+
+    def release(self, worker: _Worker, *, replace: bool = False) -> None:
+        """Keep the worker for reuse or, e.g. if its calculation exceeded the timeout,
+        kill it and keep a new one instead.
+        """
+        if replace or not worker.process.is_alive():
+            worker.stop()
+            worker = _Worker.start()
+        with self._lock:
+            if len(self._idle) < (os.cpu_count() or 1):
+                self._idle.append(worker)
+                return
+        worker.stop()
+
+
+_WORKER_POOL = _WorkerPool()
+
+
+async def _calculate_in_process(
+    request: bytes, expression: str, timeout: Optional[float]
+) -> Optional[NumberType]:
+    """Calculate the pickled request by a worker process, which is killed after the timeout."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    worker = _WORKER_POOL.acquire()
+    process, connection = worker
+    #: a worker which did not send its result may still be calculating
+    replace = True
+    try:
+        connection.send_bytes(request)
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, connection.poll, timeout):
+            raise _timeout_error(expression, timeout)
+        result, error = connection.recv()
+        replace = False
+    except (EOFError, OSError) as exc:
+        process.join(1)
+        raise StringCalculatorError(
+            f"Expression `{expression}` could not be calculated due to: "
+            f"`Process exited with code {process.exitcode}.`."
+        ) from exc
+    finally:
+        _WORKER_POOL.release(worker, replace=replace)
+    if error is not None:
+        raise error
+    return result  # type: ignore[no-any-return]
+
+
+_DEFAULT_CALCULATOR = StringCalculator()
 
-        return self.visit(node.value)  # type: ignore[no-any-return]  # pragma: py-lt-38
+#: Process-wide cache used by :func:`calculate_string`.
+expression_cache = _DEFAULT_CALCULATOR.cache
 
 
-def calculate_string(expression: str) -> Optional[NumberType]:
+def calculate_string(
+    expression: str, variables: Optional[Mapping[str, NumberType]] = None
+) -> Optional[NumberType]:
     """Calculate the given expression.
 
-    The given arithmetic expression string is parsed as an :mod:`ast` and then
-    handled by the :class:`ast.NodeVisitor`.
+    The given arithmetic expression string is parsed as an :mod:`ast`, compiled by
+    :func:`compile_expression` and then evaluated. Use :func:`compile_expression`
+    directly to evaluate the same expression repeatedly without parsing it again.
+
+    Compiled expressions are kept in the process-wide LRU :data:`expression_cache`, so
+    repeated expressions are only parsed once. Set its
+    :attr:`ExpressionCache.maxsize` to configure the capacity or to ``0`` to disable
+    the cache.
 
     Python exceptions are risen like with normal arithmetic expression e.g.
     :class:`ZeroDivisionError`.
@@ -101,6 +4056,28 @@ def calculate_string(expression: str) -> Optional[NumberType]:
         - Division (:func:`operator.truediv`) ``a / b``
         - FloorDivision (:func:`operator.floordiv`) ``a // b``
         - Modulo (:func:`operator.mod`) ``a % b``
+        - Comparisons (:func:`operator.lt` etc.) ``a < b``, ``a <= b``, ``a == b``,
+          ``a != b``, ``a >= b``, ``a > b`` also chained like ``a < b < c``
+        - Negation (:func:`operator.not_`) ``not a``
+        - Boolean operators ``a and b``, ``a or b``
+        - Conditional expression ``a if condition else b``
+
+    Boolean and conditional expressions short-circuit like in Python, so operands
+    which do not affect the result are not evaluated.
+
+    Scripts can assign intermediate results to names with statements separated by
+    ``;`` or newlines before the final expression. Each assigned value is computed
+    once per evaluation.
+
+    Bitwise operators ``<<``, ``>>``, ``&``, ``|``, ``^``, ``~`` and matrix
+    multiplication ``@`` can be enabled and other operators disabled with the
+    ``operators`` of a :class:`StringCalculator`.
+
+    Variables are supported by name and their values are taken from ``variables``.
+
+    Functions from :data:`DEFAULT_FUNCTIONS` like ``sqrt(a)`` or ``max(a, b)`` can be
+    called with positional arguments. Use a :class:`StringCalculator` to call other
+    functions.
 
     How to use:
 
@@ -113,21 +4090,797 @@ def calculate_string(expression: str) -> Optional[NumberType]:
         >>> calculate_string("(1+2)/3")
         1.0
 
+    Variables are looked up by name in the given ``variables`` mapping:
+
+    .. doctest::
+
+        >>> calculate_string("a * (b + 1)", {"a": 2, "b": 3})
+        8
+        >>> calculate_string("max(sqrt(a), 1.5)", {"a": 4})
+        2.0
+        >>> calculate_string("a / b if b != 0 and a > 0 else 0", {"a": 1, "b": 0})
+        0
+        >>> calculate_string("base = a * b; base + base ** 2", {"a": 2, "b": 3})
+        42
+
     :param expression: String with arithmetic expression.
+    :param variables: Mapping of variable names to their values.
     :raises StringCalculatorError: if given expression cannot be calculated.
     :return: Result or None
     """
-    if expression == "":
-        return None
+    return _DEFAULT_CALCULATOR.calculate(expression, variables)
+
+
+async def calculate_string_async(
+    expression: str,
+    variables: Optional[Mapping[str, NumberType]] = None,
+    *,
+    timeout: Optional[float] = None,
+    executor: Optional["Executor"] = None,
+    max_inline_length: int = 200,
+    max_inline_cost: float = 200,
+) -> Optional[NumberType]:
+    """Calculate the given expression like :func:`calculate_string` in an event loop.
+
+    Cheap expressions are calculated directly in the event loop: cached ones and ones
+    not longer than ``max_inline_length`` are compiled there and evaluated there if
+    their :attr:`CompiledExpression.cost` does not exceed ``max_inline_cost``. All
+    others, e.g. with a power of a variable exponent, are calculated by the
+    ``executor``, so the event loop is not blocked. Without ``executor`` expressions of
+    unknown or infinite cost are calculated by a worker process, because a single
+    operation on big integers holds the GIL and would block a thread's event loop too.
+    The worker processes are reused and started with the ``forkserver`` or ``spawn``
+    method, so like for :func:`calculate_many` the main module must be importable
+    without side effects.
+
+    Waiting for an offloaded calculation is stopped after ``timeout`` seconds. A
+    worker process is then killed and replaced, a calculation by the ``executor`` or
+    in the event loop is stopped before its next operation.
+
+    .. testsetup::
+
+        import asyncio
+        from formelsammlung.strcalc import calculate_string_async
+
+    .. doctest::
+
+        >>> asyncio.run(calculate_string_async("a ** b", {"a": 2, "b": 10}, timeout=1))
+        1024
+
+    :param expression: String with arithmetic expression.
+    :param variables: Mapping of variable names to their values.
+    :param timeout: Seconds after which the calculation is aborted.
+
+        Default: no timeout
+    :param executor: Executor to offload expensive calculations to.
+
+        Default: a worker process for expressions of unknown or infinite cost if the
+        calculator and variables can be pickled, else the default executor of the
+        event loop
+    :param max_inline_length: Maximum length of an uncached expression to compile in the
+        event loop.
+
+        Default: ``200``
+    :param max_inline_cost: Maximum cost of an expression to evaluate in the event loop.
+
+        Default: ``200``
+    :raises StringCalculatorError: if given expression cannot be calculated or the
+        timeout expired.
+    :return: Result or None
+    """
+    return await _DEFAULT_CALCULATOR.calculate_async(
+        expression,
+        variables,
+        timeout=timeout,
+        executor=executor,
+        max_inline_length=max_inline_length,
+        max_inline_cost=max_inline_cost,
+    )
+
+
+def set_disk_cache(disk_cache: Optional[DiskCache]) -> None:
+    """Share compiled expressions of :func:`calculate_string` across processes.
+
+    Sets the persistent cache consulted by :func:`calculate_string` and
+    :func:`compile_expression` on a miss of the :data:`expression_cache`.
+
+    :param disk_cache: Cache to use or ``None`` to not use one.
+    """
+    _DEFAULT_CALCULATOR.disk_cache = disk_cache
+
+
+def set_profiler(profiler: Optional[ExpressionProfiler]) -> None:
+    """Record statistics of the expressions of :func:`calculate_string`.
+
+    :param profiler: Profiler to use or ``None`` to not record statistics.
+    """
+    _DEFAULT_CALCULATOR.profiler = profiler
+
+
+def save_catalogue(
+    path: Union[str, "os.PathLike[str]"], expressions: Iterable[CompiledExpression]
+) -> None:
+    """Serialize compiled expressions to a catalogue file for :class:`ExpressionCatalogue`.
+
+    Use it to precompile a known set of expressions e.g. at deploy time, so workers
+    can load them without parsing.
+
+    :param path: Path of the catalogue file to write.
+    :param expressions: Compiled expressions to store by their expression string.
+    :raises ValueError: if an expression contains a constant which cannot be
+        serialized.
+    """
+    index: Dict[str, Tuple[int, int]] = {}
+    with open(path, "wb") as file:
+        file.write(bytes(_CATALOGUE_HEADER.size))
+        for compiled in expressions:
+            data = compiled.to_bytes()
+            index[compiled.expression] = (file.tell(), len(data))
+            file.write(data)
+        index_offset = file.tell()
+        file.write(marshal.dumps(index))
+        file.seek(0)
+        file.write(
+            _CATALOGUE_HEADER.pack(
+                _CATALOGUE_MAGIC, BYTECODE_VERSION, marshal.version, index_offset
+            )
+        )
+
+
+class ExpressionCatalogue(Mapping[str, CompiledExpression]):
+    """Read-only mapping of expression strings to compiled expressions from a file.
+
+    The catalogue file written by :func:`save_catalogue` is memory-mapped, so its
+    pages are shared by all processes reading it. Compiled expressions are loaded
+    with :meth:`StringCalculator.load` on first access without parsing them.
+
+    .. doctest::
+
+        >>> import os, tempfile
+        >>> from formelsammlung.strcalc import (
+        ...     compile_expression, ExpressionCatalogue, save_catalogue
+        ... )
+        >>> path = os.path.join(tempfile.mkdtemp(), "formulas.bin")
+        >>> save_catalogue(path, [compile_expression("a * (b + 1)")])
+        >>> with ExpressionCatalogue(path) as catalogue:
+        ...     catalogue["a * (b + 1)"].evaluate({"a": 2, "b": 3})
+        8
+    """
+
+    def __init__(
+        self,
+        path: Union[str, "os.PathLike[str]"],
+        calculator: Optional[StringCalculator] = None,
+    ) -> None:
+        """Map the catalogue file and read its index.
+
+        :param path: Path of the catalogue file.
+        :param calculator: Calculator to bind operators and functions with, which
+            should be configured like the one which compiled the expressions.
+
+            Default: calculator of :func:`calculate_string`
+        :raises ValueError: if the file is no catalogue of this format version.
+        """
+        import mmap  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        self.calculator = calculator or _DEFAULT_CALCULATOR
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index_offset = _check_header(_CATALOGUE_HEADER, _CATALOGUE_MAGIC, self._map)[3]
+            self._index: Dict[str, Tuple[int, int]] = marshal.loads(self._map[index_offset:])
+        except (EOFError, TypeError, ValueError):
+            self._map.close()
+            raise
+        self._loaded: Dict[str, CompiledExpression] = {}
+
+    def __getitem__(self, expression: str) -> CompiledExpression:
+        """Return the compiled expression and load it on first access."""
+        compiled = self._loaded.get(expression)
+        if compiled is None:
+            offset, length = self._index[expression]
+            compiled = self.calculator.load(self._map[offset : offset + length])
+            self._loaded[expression] = compiled
+        return compiled
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the expression strings."""
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        """Return the number of expressions."""
+        return len(self._index)
+
+    def __enter__(self) -> "ExpressionCatalogue":
+        """Return the catalogue itself."""
+        return self
 
+    def __exit__(self, *_: Any) -> None:
+        """Close the catalogue."""
+        self.close()
+
+    def compile(self, expression: str) -> CompiledExpression:
+        """Return the expression from the catalogue or compile it with the calculator.
+
+        :param expression: String with arithmetic expression.
+        :raises StringCalculatorError: if an expression not in the catalogue contains
+            unsupported elements.
+        :return: Compiled expression
+        """
+        if expression in self._index:
+            return self[expression]
+        return self.calculator.cache.compile(expression)
+
+    def close(self) -> None:
+        """Unmap the file; already loaded expressions stay usable."""
+        self._map.close()
+
+
+class CalculationResult(NamedTuple):
+    """Result of a single calculated expression, e.g. by :func:`calculate_many`."""
+
+    #: The calculated expression.
+    expression: str
+    #: Result of the expression or ``None`` if an error occurred.
+    result: Optional[NumberType]
+    #: Exception risen by the calculation or ``None`` on success.
+    error: Optional[Exception]
+
+
+#: Calculator of worker processes started by :func:`calculate_many`.
+_WORKER_CALCULATOR: Optional[StringCalculator] = None
+
+
+def _init_worker(calculator: StringCalculator) -> None:
+    """Set the calculator of the worker process."""
+    global _WORKER_CALCULATOR  # pylint: disable=global-statement
+    _WORKER_CALCULATOR = calculator
+
+
+_ChunkResults = List[Tuple[Optional[NumberType], Optional[Exception]]]
+
+
+def _calculate_chunk(
+    expressions: List[str], calculator: Optional[StringCalculator] = None
+) -> _ChunkResults:
+    """Calculate the expressions and catch errors per expression."""
+    calculate = (calculator or _WORKER_CALCULATOR or _DEFAULT_CALCULATOR).calculate
+    results: _ChunkResults = []
+    for expression in expressions:
+        try:
+            results.append((calculate(expression), None))
+        except Exception as exc:  # pylint: disable=broad-except
+            results.append((None, exc))
+    return results
+
+
+def _calculate_chunks(
+    create_pool: Callable[[], "Executor"],
+    calculator: Optional[StringCalculator],
+    expressions: Iterable[str],
+    chunksize: int,
+    max_pending: int,
+) -> Iterator[CalculationResult]:
+    """Submit chunks of expressions and yield their results in order.
+
+    The pool is created when the iteration starts and shut down when it ends, so no
+    workers are left behind if the results are never iterated. ``calculator`` is
+    passed to :func:`_calculate_chunk`; it is ``None`` for workers initialized with a
+    calculator by :func:`_init_worker`.
+    """
+    pending: "deque[Tuple[List[str], Future[_ChunkResults]]]" = deque()
+    iterator = iter(expressions)
+    pool = create_pool()
     try:
-        ret_val = _StringCalculator().visit(ast.parse(expression).body[0])
-    except KeyError as exc:
-        raise StringCalculatorError(
-            f"Expression `{expression}` has unsupported node: `{exc}`."
-        ) from exc
-    except ValueError as exc:
-        raise StringCalculatorError(
-            f"Expression `{expression}` could not be calculated due to: `{exc}`."
-        ) from exc
-    return ret_val  # type: ignore[no-any-return]
+        while True:
+            chunk = list(itertools.islice(iterator, chunksize))
+            if chunk:
+                pending.append((chunk, pool.submit(_calculate_chunk, chunk, calculator)))
+            if pending and (not chunk or len(pending) >= max_pending):
+                done_chunk, future = pending.popleft()
+                for expression, (result, error) in zip(done_chunk, future.result()):
+                    yield CalculationResult(expression, result, error)
+            if not chunk and not pending:
+                return
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def calculate_many(
+    expressions: Iterable[str],
+    *,
+    workers: Optional[int] = None,
+    executor: str = "process",
+    chunksize: int = 1000,
+    calculator: Optional[StringCalculator] = None,
+) -> Iterator[CalculationResult]:
+    """Calculate many independent expressions in parallel.
+
+    The expressions are consumed lazily in chunks which are calculated by a pool of
+    workers. The results are yielded in order of the given expressions as soon as
+    they are available. Errors do not abort the batch but are returned per expression.
+    Only a limited number of chunks is processed at once, so memory usage does not
+    grow with the number of expressions.
+
+    Available executors:
+
+        - ``process`` uses a :class:`concurrent.futures.ProcessPoolExecutor`. The
+          calculator is sent to each worker process once, so it must be picklable.
+        - ``thread`` uses a :class:`concurrent.futures.ThreadPoolExecutor` and shares
+          the calculator and its cache between the threads. Because of the GIL this
+          only speeds up the calculation on free-threaded Python builds.
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import calculate_many
+
+    .. doctest::
+
+        >>> for item in calculate_many(["1+1", "1/0"], executor="thread"):
+        ...     print(item.result, repr(item.error))
+        2 None
+        None ZeroDivisionError('division by zero')
+
+    :param expressions: Strings with arithmetic expressions.
+    :param workers: Number of worker processes or threads.
+
+        Default: number of CPUs
+    :param executor: Kind of worker pool to use.
+
+        Default: ``process``
+    :param chunksize: Number of expressions calculated by a worker at once.
+
+        Default: ``1000``
+    :param calculator: Calculator to use.
+
+        Default: calculator used by :func:`calculate_string`
+    :raises ValueError: if the executor is unknown or a number is not positive.
+    :return: Iterator over the results in order of the expressions.
+    """
+    if executor not in ("process", "thread"):
+        raise ValueError(f"Unknown executor `{executor}`.")
+    workers = workers or os.cpu_count() or 1
+    if workers < 1 or chunksize < 1:
+        raise ValueError("`workers` and `chunksize` must be positive.")
+    calculator = calculator or _DEFAULT_CALCULATOR
+    #: imported here as only the parallel calculation needs them
+    from concurrent.futures import (  # pylint: disable=import-outside-toplevel
+        ProcessPoolExecutor,
+        ThreadPoolExecutor,
+    )
+
+    if executor == "process":
+        create_pool: Callable[[], "Executor"] = functools.partial(
+            ProcessPoolExecutor, workers, initializer=_init_worker, initargs=(calculator,)
+        )
+        return _calculate_chunks(create_pool, None, expressions, chunksize, 2 * workers)
+    create_pool = functools.partial(ThreadPoolExecutor, workers)
+    return _calculate_chunks(create_pool, calculator, expressions, chunksize, 2 * workers)
+
+
+def _calculate_serially(
+    expressions: Iterable[str], calculator: StringCalculator
+) -> Iterator[CalculationResult]:
+    """Calculate the expressions one by one and catch errors per expression."""
+    calculate = calculator.calculate
+    for expression in expressions:
+        try:
+            yield CalculationResult(expression, calculate(expression), None)
+        except Exception as exc:  # pylint: disable=broad-except
+            yield CalculationResult(expression, None, exc)
+
+
+def _result_changed(old: Optional[CalculationResult], new: CalculationResult) -> bool:
+    """Check if a formula's result changed, so formulas using it must be recalculated."""
+    if old is None or old.error is not None or new.error is not None:
+        return True
+    return type(old.result) is not type(new.result) or bool(old.result != new.result)
+
+
+class FormulaSheet:
+    """Named formulas referring to variables and the results of other formulas by name.
+
+    The formulas form a dependency graph and are calculated in topological order. When
+    variables change only the formulas depending on them directly or indirectly are
+    recalculated, skipping formulas whose used results did not change.
+
+    .. testsetup::
+
+        from formelsammlung.strcalc import FormulaSheet
+
+    .. doctest::
+
+        >>> sheet = FormulaSheet({"area": "width * height", "cost": "area * price"})
+        >>> sheet.update({"width": 2, "height": 3, "price": 5})
+        ['area', 'cost']
+        >>> sheet["cost"]
+        30
+        >>> sheet.update({"price": 4, "width": 2})
+        ['cost']
+        >>> sheet["cost"]
+        24
+
+    Errors are kept per formula and risen on access. Formulas using a failed formula
+    fail with a missing value for it.
+    """
+
+    def __init__(
+        self,
+        formulas: Optional[Mapping[str, str]] = None,
+        variables: Optional[Mapping[str, Any]] = None,
+        *,
+        calculator: Optional[StringCalculator] = None,
+    ) -> None:
+        """Initialize the sheet and calculate the given formulas.
+
+        :param formulas: Mapping of names to the formulas' expressions.
+        :param variables: Mapping of variable names to their values.
+        :param calculator: Calculator to compile the formulas with.
+
+            Default: calculator used by :func:`calculate_string`
+        :raises StringCalculatorError: if a formula cannot be compiled or formulas
+            refer to each other in a cycle.
+        :raises ValueError: if a name is used for a formula and a variable.
+        """
+        self.calculator = calculator or _DEFAULT_CALCULATOR
+        self._formulas: Dict[str, CompiledExpression] = {}
+        self._variables: Dict[str, Any] = {}
+        #: values of the variables and results of the successfully calculated formulas
+        self._values: Dict[str, Any] = {}
+        self._results: Dict[str, CalculationResult] = {}
+        #: formulas using each name and position of each formula in topological order
+        self._dependents: Dict[str, Set[str]] = {}
+        self._order: Dict[str, int] = {}
+        self.update(variables or {})
+        self.set_formulas(formulas or {})
+
+    def __len__(self) -> int:
+        """Return number of formulas."""
+        return len(self._formulas)
+
+    def __contains__(self, name: object) -> bool:
+        """Check if a formula of the name exists."""
+        return name in self._formulas
+
+    def __getitem__(self, name: str) -> Optional[NumberType]:
+        """Return the result of the formula.
+
+        :param name: Name of the formula.
+        :raises KeyError: if no formula of the name exists.
+        :raises Exception: the error risen by calculating the formula.
+        :return: Result or None
+        """
+        result = self._results[name]
+        if result.error is not None:
+            raise result.error
+        return result.result
+
+    @property
+    def formulas(self) -> Mapping[str, str]:
+        """Read-only mapping of the formulas' names to their expressions in topological order."""
+        return MappingProxyType({name: self._formulas[name].expression for name in self._order})
+
+    @property
+    def variables(self) -> Mapping[str, Any]:
+        """Read-only mapping of the variables' names to their values."""
+        return MappingProxyType(self._variables)
+
+    def result(self, name: str) -> CalculationResult:
+        """Return the result or error of the formula.
+
+        :param name: Name of the formula.
+        :raises KeyError: if no formula of the name exists.
+        :return: Result of the formula
+        """
+        return self._results[name]
+
+    def dependencies(self, name: str) -> FrozenSet[str]:
+        """Return the names of the variables and formulas used by the formula.
+
+        :param name: Name of the formula.
+        :raises KeyError: if no formula of the name exists.
+        :return: Used names
+        """
+        return frozenset(self._formulas[name].names)
+
+    def dependents(self, name: str) -> FrozenSet[str]:
+        """Return the names of the formulas using the variable or formula.
+
+        :param name: Name of the variable or formula.
+        :return: Names of formulas
+        """
+        return frozenset(self._dependents.get(name, ()))
+
+    def set_formula(self, name: str, expression: str) -> List[str]:
+        """Add or replace the formula and recalculate it and the formulas using it.
+
+        See :meth:`FormulaSheet.set_formulas`.
+
+        :param name: Name of the formula.
+        :param expression: String with arithmetic expression.
+        :return: Names of the recalculated formulas in order of calculation.
+        """
+        return self.set_formulas({name: expression})
+
+    def set_formulas(self, formulas: Mapping[str, str]) -> List[str]:
+        """Add or replace the formulas and recalculate them and the formulas using them.
+
+        The sheet is not changed if any formula is invalid.
+
+        :param formulas: Mapping of names to the formulas' expressions.
+        :raises StringCalculatorError: if an expression cannot be compiled or formulas
+            would refer to each other in a cycle.
+        :raises ValueError: if a name is used for a variable.
+        :return: Names of the recalculated formulas in order of calculation.
+        """
+        for name in formulas:
+            if name in self._variables:
+                raise ValueError(f"Name `{name}` is used for a variable.")
+        compiled = {
+            name: self.calculator.cache.compile(expression) for name, expression in formulas.items()
+        }
+        previous = {name: self._formulas.get(name) for name in compiled}
+        for name, formula in compiled.items():
+            self._link(name, previous[name], formula)
+        try:
+            self._sort()
+        except StringCalculatorError:
+            for name, formula in compiled.items():
+                self._link(name, formula, previous[name])
+            raise
+        return self._recalculate((), compiled)
+
+    def remove_formula(self, name: str) -> List[str]:
+        """Remove the formula and recalculate the formulas using it, which fail then.
+
+        :param name: Name of the formula.
+        :raises KeyError: if no formula of the name exists.
+        :return: Names of the recalculated formulas in order of calculation.
+        """
+        self._link(name, self._formulas[name], None)
+        del self._order[name]
+        del self._results[name]
+        self._values.pop(name, None)
+        return self._recalculate({name})
+
+    def update(self, variables: Mapping[str, Any]) -> List[str]:
+        """Set values of variables and recalculate the formulas affected by changes.
+
+        :param variables: Mapping of variable names to their new values.
+        :raises ValueError: if a name is used for a formula.
+        :return: Names of the recalculated formulas in order of calculation.
+        """
+        for name in variables:
+            if name in self._formulas:
+                raise ValueError(f"Name `{name}` is used for a formula.")
+        changed = set()
+        for name, value in variables.items():
+            if (
+                name not in self._variables
+                or type(value) is not type(self._variables[name])
+                or bool(value != self._variables[name])
+            ):
+                changed.add(name)
+            self._variables[name] = self._values[name] = value
+        return self._recalculate(changed)
+
+    def _link(
+        self,
+        name: str,
+        previous: Optional[CompiledExpression],
+        compiled: Optional[CompiledExpression],
+    ) -> None:
+        """Replace the formula of the name in the dependency graph."""
+        if previous is not None:
+            for used in previous.names:
+                self._dependents[used].discard(name)
+                if not self._dependents[used]:
+                    del self._dependents[used]
+        if compiled is None:
+            self._formulas.pop(name, None)
+            return
+        self._formulas[name] = compiled
+        for used in compiled.names:
+            self._dependents.setdefault(used, set()).add(name)
+
+    def _sort(self) -> None:
+        """Number the formulas in topological order of their dependencies, ties by name."""
+        formulas = self._formulas
+        missing = {
+            name: sum(used in formulas for used in compiled.names)
+            for name, compiled in formulas.items()
+        }
+        ready = [name for name, count in missing.items() if count == 0]
+        heapq.heapify(ready)
+        order: Dict[str, int] = {}
+        while ready:
+            name = heapq.heappop(ready)
+            order[name] = len(order)
+            for dependent in self._dependents.get(name, ()):
+                missing[dependent] -= 1
+                if missing[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+        if len(order) < len(formulas):
+            cycle = sorted(name for name in formulas if name not in order)
+            raise StringCalculatorError(f"Formulas refer to each other in a cycle: {cycle}.")
+        self._order = order
+
+    def _recalculate(self, changed: Iterable[str], forced: Iterable[str] = ()) -> List[str]:
+        """Recalculate the formulas using changed names directly or indirectly.
+
+        :param changed: Names of variables and formulas whose values changed.
+        :param forced: Names of formulas to recalculate in any case.
+        :return: Names of the recalculated formulas in order of calculation.
+        """
+        changed = set(changed)
+        forced = set(forced)
+        affected = set(forced)
+        pending = [*changed, *forced]
+        while pending:
+            for dependent in self._dependents.get(pending.pop(), ()):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    pending.append(dependent)
+
+        recalculated = []
+        for name in sorted(affected, key=self._order.__getitem__):
+            compiled = self._formulas[name]
+            if name not in forced and changed.isdisjoint(compiled.names):
+                continue
+            try:
+                result = CalculationResult(
+                    compiled.expression, compiled.evaluate(self._values), None
+                )
+                self._values[name] = result.result
+            except Exception as exc:  # pylint: disable=broad-except
+                result = CalculationResult(compiled.expression, None, exc)
+                self._values.pop(name, None)
+            if _result_changed(self._results.get(name), result):
+                changed.add(name)
+            self._results[name] = result
+            recalculated.append(name)
+        return recalculated
+
+
+def _format_error(error: Optional[Exception]) -> str:
+    """Format an error as one line of text."""
+    return "" if error is None else f"{error.__class__.__name__}: {error}"
+
+
+def _json_result(result: Any) -> Any:  # noqa: ANN401
+    """Convert a result to a value JSON parsers read without loss.
+
+    Integers beyond the exact range of doubles, non-finite floats and other number
+    types are converted to strings.
+    """
+    if result is None or type(result) is bool:
+        return result
+    if type(result) is int and abs(result) <= _JSON_MAX_INT:
+        return result
+    if type(result) is float and math.isfinite(result):
+        return result
+    return str(result)
+
+
+def _csv_line(*fields: str) -> str:
+    """Format the fields as line of CSV."""
+    import csv  # pylint: disable=import-outside-toplevel
+
+    line = io.StringIO()
+    csv.writer(line).writerow(fields)
+    return line.getvalue()
+
+
+def _format_result(item: CalculationResult, output_format: str) -> str:
+    """Format the result as line of the output format; raise if it cannot be written.
+
+    :raises ValueError: if the result cannot be converted to a string, e.g. an integer
+        with more digits than allowed by :func:`sys.set_int_max_str_digits`.
+    """
+    import json  # pylint: disable=import-outside-toplevel
+
+    error = _format_error(item.error)
+    if output_format == "plain":
+        return f"{error or ('' if item.result is None else item.result)}\n"
+    if output_format == "csv":
+        return _csv_line(item.expression, "" if item.result is None else str(item.result), error)
+    record = {"expression": item.expression, "result": _json_result(item.result)}
+    record["error"] = error or None
+    return f"{json.dumps(record, allow_nan=False)}\n"
+
+
+def _write_results(results: Iterable[CalculationResult], output_format: str) -> bool:
+    """Write the results to stdout in the given format and report if any failed.
+
+    Results which cannot be written are reported like errors of the calculation.
+    """
+    failed = False
+    out = sys.stdout
+    if output_format == "csv":
+        out.write(_csv_line("expression", "result", "error"))
+    for item in results:
+        try:
+            line = _format_result(item, output_format)
+        except ValueError as exc:
+            item = CalculationResult(item.expression, None, exc)
+            line = _format_result(item, output_format)
+        failed = failed or item.error is not None
+        out.write(line)
+    out.flush()
+    return failed
+
+
+def cli_caller(argv: Optional[List[str]] = None) -> int:
+    """Calculate expressions read line by line from files or stdin.
+
+    Script to calculate huge amounts of expressions in a streaming fashion with
+    constant memory usage. Each input line is one expression and results in one
+    output line (plus a header for ``csv``) in the same order. Repeated expressions
+    are parsed only once thanks to the shared cache of :func:`calculate_string`.
+
+    .. code-block:: console
+
+        $ printf "1+2\\n2**10\\n1/0\\n" | strcalc --format jsonl
+        {"expression": "1+2", "result": 3, "error": null}
+        {"expression": "2**10", "result": 1024, "error": null}
+        {"expression": "1/0", "result": null, "error": "ZeroDivisionError: division by zero"}
+
+    :param argv: Command line arguments.
+
+        Default: :data:`sys.argv`
+    :return: Exit code 1 if any expression failed and 0 otherwise.
+    """
+    #: imported here as only the command line needs them
+    import argparse  # pylint: disable=import-outside-toplevel
+    import fileinput  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog="strcalc", description="Calculate arithmetic expressions line by line."
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="files with one expression per line; stdin is read if none or '-' is given",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("plain", "csv", "jsonl"),
+        default="plain",
+        help="output format (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes (default: calculate in this process)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1000,
+        help="expressions per chunk sent to a worker (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    with fileinput.input(args.files or ["-"]) as lines:
+        expressions = (line.strip() for line in lines)
+        if args.workers > 0:
+            results = calculate_many(expressions, workers=args.workers, chunksize=args.chunksize)
+        else:
+            results = _calculate_serially(expressions, _DEFAULT_CALCULATOR)
+        try:
+            failed = _write_results(results, args.format)
+        except BrokenPipeError:
+            #: the reader like ``head`` closed the pipe; silence the flush on exit
+            with contextlib.suppress(OSError, ValueError):
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli_caller())
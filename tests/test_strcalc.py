@@ -1,11 +1,53 @@
 """Tests for `strcalc` module."""
 
+import ast
+import asyncio
+import concurrent.futures
+import contextlib
+import decimal
+import io
+import itertools
+import json
+import marshal
+import math
+import multiprocessing
+import operator
+import pickle
 import random
-from typing import Union
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from fractions import Fraction
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Union
 
 import pytest
 
-from formelsammlung.strcalc import NumberType, StringCalculatorError, calculate_string
+from formelsammlung import strcalc
+from formelsammlung.strcalc import (
+    CalculationResult,
+    CompiledExpression,
+    DiskCache,
+    ExpressionCache,
+    ExpressionCatalogue,
+    ExpressionProfiler,
+    FormulaSheet,
+    Interval,
+    Limits,
+    NumberType,
+    StringCalculator,
+    StringCalculatorError,
+    calculate_many,
+    calculate_string,
+    calculate_string_async,
+    cli_caller,
+    compile_expression,
+    expression_cache,
+    save_catalogue,
+    set_disk_cache,
+    set_profiler,
+)
 
 
 def _rand_int_w_0() -> int:
@@ -742,3 +784,2328 @@ def test_error_unsupported_operator() -> None:
     """Test KeyError is risen when return type is not NumberType."""
     with pytest.raises(StringCalculatorError, match="has unsupported node"):
         calculate_string("1 @ 1")
+
+
+def test_error_unsupported_node() -> None:
+    """Test KeyError is risen for nodes without a handler."""
+    with pytest.raises(StringCalculatorError, match="has unsupported node"):
+        calculate_string("[1]")
+
+
+# Compiled expressions
+
+
+def test_compile_expression() -> None:
+    """Test compiled expression gives same result as calculate_string."""
+    expression = "(1+2)*-3-4/5**2%7//1"
+
+    result = compile_expression(expression)
+
+    assert isinstance(result, CompiledExpression)
+    assert result.evaluate() == calculate_string(expression)
+
+
+def test_compile_expression_reuse() -> None:
+    """Test compiled expression can be evaluated repeatedly."""
+    compiled = compile_expression("2**10 + 1")
+
+    assert [compiled() for _ in range(3)] == [1025, 1025, 1025]
+
+
+def test_compile_expression_empty_str() -> None:
+    """Test compiled empty string evaluates to None."""
+    result = compile_expression("").evaluate()
+
+    assert result is None
+
+
+def test_compile_expression_error_not_numbertype() -> None:
+    """Test compilation already fails for non number constants."""
+    with pytest.raises(StringCalculatorError, match="could not be calculated due to"):
+        compile_expression("'a' + 1")
+
+
+def test_compile_expression_error_unsupported_operator() -> None:
+    """Test compilation already fails for unsupported operators."""
+    with pytest.raises(StringCalculatorError, match="has unsupported node"):
+        compile_expression("1 @ 1")
+
+
+def test_compile_expression_python_error() -> None:
+    """Test python exceptions are risen on evaluation."""
+    compiled = compile_expression("1/0")
+
+    with pytest.raises(ZeroDivisionError):
+        compiled.evaluate()
+
+
+def test_compile_expression_memory_size() -> None:
+    """Test the memory size grows with the program but not with shared objects."""
+    small = compile_expression("a + b")
+    large = compile_expression("a + b * (c - 1) / sqrt(d) + 12345678901234567890")
+
+    assert 0 < small.memory_size < large.memory_size
+    assert compile_expression("max(a, b)").memory_size < small.memory_size + 200
+
+
+def test_compile_expression_memory_size_evaluated() -> None:
+    """Test the program stays compact when evaluated and loaded."""
+    compiled = compile_expression("a * 2 + 1")
+    compact = compiled.memory_size
+
+    assert compiled.evaluate({"a": 3}) == 7
+    assert compiled.memory_size == compact
+
+    loaded = StringCalculator().load(compiled.to_bytes())
+
+    assert loaded.evaluate({"a": 4}) == 9
+    assert loaded.memory_size == compact
+
+
+# Expression cache
+
+
+def test_expression_cache_hit_miss() -> None:
+    """Test cache counts hits and misses and returns the same object."""
+    cache = ExpressionCache()
+
+    first = cache.compile("1+1")
+    second = cache.compile("1+1")
+
+    assert first is second
+    assert cache.info() == (1, 1, 0, 1024, 1)
+
+
+def test_expression_cache_eviction() -> None:
+    """Test least recently used expression is evicted."""
+    cache = ExpressionCache(maxsize=2)
+    cache.compile("1")
+    cache.compile("2")
+    cache.compile("1")
+
+    cache.compile("3")
+
+    assert "1" in cache
+    assert "2" not in cache
+    assert cache.info().evictions == 1
+
+
+def test_expression_cache_lower_maxsize() -> None:
+    """Test lowering the maxsize evicts surplus entries."""
+    cache = ExpressionCache()
+    for num in range(5):
+        cache.compile(str(num))
+
+    cache.maxsize = 2
+
+    assert len(cache) == 2
+    assert cache.info().evictions == 3
+
+
+def test_expression_cache_disabled() -> None:
+    """Test maxsize of 0 disables caching."""
+    cache = ExpressionCache(maxsize=0)
+
+    first = cache.compile("1+1")
+    second = cache.compile("1+1")
+
+    assert first is not second
+    assert len(cache) == 0
+
+
+def test_expression_cache_negative_maxsize() -> None:
+    """Test negative maxsize is rejected."""
+    with pytest.raises(ValueError, match="must not be negative"):
+        ExpressionCache(maxsize=-1)
+
+
+def test_expression_cache_error_not_cached() -> None:
+    """Test failing expressions are not cached."""
+    cache = ExpressionCache()
+
+    with pytest.raises(StringCalculatorError):
+        cache.compile("1 @ 1")
+
+    assert len(cache) == 0
+    assert cache.info().misses == 1
+
+
+def test_expression_cache_clear() -> None:
+    """Test clear removes entries and resets statistics."""
+    cache = ExpressionCache()
+    cache.compile("1+1")
+
+    cache.clear()
+
+    assert cache.info() == (0, 0, 0, 1024, 0)
+
+
+def test_expression_cache_memory_size() -> None:
+    """Test the memory size of the cache sums the sizes of cached expressions."""
+    cache = ExpressionCache()
+    empty = cache.memory_size()
+
+    compiled = cache.compile("a * (b + 1)")
+
+    assert cache.memory_size() >= empty + compiled.memory_size
+
+
+def test_calculate_string_uses_cache() -> None:
+    """Test calculate_string reuses the process-wide cache."""
+    expression_cache.clear()
+
+    calculate_string("2*21")
+    result = calculate_string("2*21")
+
+    assert result == 42
+    assert expression_cache.info().hits == 1
+
+
+# Variables
+
+
+def test_variables() -> None:
+    """Test variables are looked up in given mapping."""
+    result = calculate_string("price * (1 + tax)", {"price": 10, "tax": 0.5})
+
+    assert result == 15.0
+
+
+def test_variables_names() -> None:
+    """Test compiled expression lists used variables once in order of occurrence."""
+    compiled = compile_expression("b * a + b")
+
+    assert compiled.names == ("b", "a")
+
+
+def test_variables_missing() -> None:
+    """Test missing variable raises error."""
+    with pytest.raises(StringCalculatorError, match="has no value for variable: `b`"):
+        calculate_string("a + b", {"a": 1})
+
+
+def test_variables_missing_mapping() -> None:
+    """Test missing mapping raises error."""
+    with pytest.raises(StringCalculatorError, match="has no value for variable: `a`"):
+        compile_expression("a + 1").evaluate()
+
+
+def test_variables_store_context() -> None:
+    """Test names cannot be assigned outside of assignments."""
+    with pytest.raises(StringCalculatorError, match="has unsupported node"):
+        calculate_string("(a := 1)")
+
+
+def test_evaluate_many() -> None:
+    """Test evaluation for list of mappings."""
+    compiled = compile_expression("a - b")
+
+    result = compiled.evaluate_many([{"a": 1, "b": 2}, {"a": 5, "b": 3, "c": 0}])
+
+    assert result == [-1, 2]
+
+
+def test_evaluate_columns() -> None:
+    """Test evaluation for columns."""
+    compiled = compile_expression("a * b")
+
+    result = compiled.evaluate_columns({"a": [1, 2, 3], "b": (4, 5, 6)})
+
+    assert result == [4, 10, 18]
+
+
+def test_evaluate_columns_without_variables() -> None:
+    """Test evaluation for columns without used variables returns one result per row."""
+    compiled = compile_expression("1 + 1")
+
+    result = compiled.evaluate_columns({"a": [1, 2, 3]})
+
+    assert result == [2, 2, 2]
+
+
+def test_evaluate_columns_different_length() -> None:
+    """Test columns with different length raise error."""
+    compiled = compile_expression("a * b")
+
+    with pytest.raises(StringCalculatorError, match="differ in length"):
+        compiled.evaluate_columns({"a": [1, 2, 3], "b": [4, 5]})
+
+
+# NumPy engine
+
+
+def test_evaluate_columns_numpy() -> None:
+    """Test numpy engine evaluates whole columns."""
+    numpy = pytest.importorskip("numpy")
+    compiled = compile_expression("-a ** 2 + b // 2 - a % 3 * (b / 4)")
+    columns = {"a": [1, 2, 3], "b": [4, 5, 6]}
+
+    result = compiled.evaluate_columns(columns, engine="numpy")
+
+    assert isinstance(result, numpy.ndarray)
+    assert result.tolist() == compiled.evaluate_columns(columns)
+
+
+def test_evaluate_columns_numpy_functions() -> None:
+    """Test numpy engine uses ufuncs or vectorizes the called functions."""
+    pytest.importorskip("numpy")
+    compiled = compile_expression("sqrt(a) + max(a, 2)")
+    columns = {"a": [1, 4, 9]}
+
+    result = compiled.evaluate_columns(columns, engine="numpy")
+
+    assert result.tolist() == compiled.evaluate_columns(columns)
+
+
+def test_evaluate_columns_numpy_conditions() -> None:
+    """Test numpy engine evaluates conditions per row."""
+    pytest.importorskip("numpy")
+    columns = {"a": [0, 1, 2], "b": [2, 1, 0]}
+
+    for expression in ["a if a < b else b and a", "not a or b", "a < b + 0 < 3"]:
+        compiled = compile_expression(expression)
+        result = compiled.evaluate_columns(columns, engine="numpy")
+
+        assert result.tolist() == compiled.evaluate_columns(columns)
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy", "auto"])
+@pytest.mark.parametrize("expression", ["x > 0 and log(x)", "log(x) if x > 0 else 0"])
+def test_evaluate_columns_short_circuit(engine: str, expression: str) -> None:
+    """Test skipped operands are not evaluated for the rows they would fail for."""
+    pytest.importorskip("numpy")
+    compiled = compile_expression(expression)
+
+    result = compiled.evaluate_columns({"x": [-1.0, 0.0, 1.0]}, engine=engine)
+
+    assert list(result) == [compiled.evaluate({"x": x}) for x in (-1.0, 0.0, 1.0)]
+
+
+def test_evaluate_columns_numpy_constant() -> None:
+    """Test numpy engine broadcasts constant result to all rows."""
+    pytest.importorskip("numpy")
+    compiled = compile_expression("2 * 3")
+
+    result = compiled.evaluate_columns({"a": [1, 2]}, engine="numpy")
+
+    assert result.tolist() == [6, 6]
+
+
+def test_evaluate_columns_numpy_missing(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test numpy engine without numpy installed raises error."""
+    monkeypatch.setattr(strcalc, "_import_numpy", lambda: None)
+    compiled = compile_expression("a + 1")
+
+    with pytest.raises(ModuleNotFoundError, match="requires NumPy"):
+        compiled.evaluate_columns({"a": [1]}, engine="numpy")
+
+
+def test_evaluate_columns_auto_fallback(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test auto engine without numpy installed falls back to python engine."""
+    monkeypatch.setattr(strcalc, "_import_numpy", lambda: None)
+    compiled = compile_expression("a + 1")
+
+    result = compiled.evaluate_columns({"a": [1, 2]}, engine="auto")
+
+    assert result == [2, 3]
+
+
+@pytest.mark.parametrize(
+    ("expression", "columns"),
+    [
+        ("a * b - sqrt(a) / (b + 0.5) < a", {"a": [1.0, 2.5, 9.0], "b": [0.5, -1.0, 3.0]}),
+        ("a * a", {"a": [2**40, 3]}),
+        ("a * a", {"a": [1.5, 2]}),
+        ("a * 1e308", {"a": [1.0, 10.0]}),
+        ("a ** 0.5 + sin(a)", {"a": [0.1, 0.2]}),
+    ],
+)
+def test_evaluate_columns_auto(expression: str, columns: Dict[str, List[Any]]) -> None:
+    """Test auto engine returns the results of the python engine."""
+    pytest.importorskip("numpy")
+    compiled = compile_expression(expression)
+
+    result = compiled.evaluate_columns(columns, engine="auto")
+
+    assert isinstance(result, list)
+    assert result == compiled.evaluate_columns(columns)
+    assert list(map(type, result)) == list(map(type, compiled.evaluate_columns(columns)))
+
+
+def test_evaluate_columns_auto_errors() -> None:
+    """Test auto engine raises the errors of the python engine."""
+    pytest.importorskip("numpy")
+
+    with pytest.raises(ZeroDivisionError):
+        compile_expression("1 / a").evaluate_columns({"a": [1.0, 0.0]}, engine="auto")
+    with pytest.raises(StringCalculatorError, match="math domain error"):
+        compile_expression("sqrt(a)").evaluate_columns({"a": [1.0, -1.0]}, engine="auto")
+
+
+def test_evaluate_columns_unknown_engine() -> None:
+    """Test unknown engine raises error."""
+    compiled = compile_expression("a + 1")
+
+    with pytest.raises(ValueError, match="Unknown engine"):
+        compiled.evaluate_columns({"a": [1]}, engine="fortran")
+
+
+# Simplification
+
+
+@pytest.mark.parametrize(
+    ("expression", "simplified"),
+    [
+        ("(2**10) * x + 3*4", "1024 * x + 12"),
+        ("x * 1 + 0", "x + 0"),
+        ("1 * x - 0", "x"),
+        ("0 + --x", "0 + x"),
+        ("-(-x)", "x"),
+        ("x * 1.0", "x * 1.0"),
+        ("0 - x", "0 - x"),
+        ("-2 ** 2 * x", "-4 * x"),
+        ("(-2) ** x", "(-2) ** x"),
+        ("a - (b - c) - d", "a - (b - c) - d"),
+        ("(a ** b) ** c ** d", "(a ** b) ** c ** d"),
+        ("-(a + b) ** -c", "-(a + b) ** (-c)"),
+        ("", ""),
+    ],
+)
+def test_simplified_expression(expression: str, simplified: str) -> None:
+    """Test constant folding and identities in simplified expression."""
+    result = compile_expression(expression).simplified_expression
+
+    assert result == simplified
+
+
+@pytest.mark.parametrize("expression", ["x + 0", "0 + x", "x - 0", "x * 1", "1 * x", "--x"])
+def test_simplified_expression_negative_zero(expression: str) -> None:
+    """Test identities keep the result of Python for negative zero."""
+    expected = eval(expression, {"x": -0.0})  # noqa: S307
+
+    assert str(calculate_string(expression, {"x": -0.0})) == str(expected)
+
+
+def test_simplified_expression_same_result() -> None:
+    """Test simplified expression calculates the same result."""
+    compiled = compile_expression("(2 ** -1 + a) * 1 / -(-(b - 0) - 7 % 4) + 1j")
+    variables = {"a": _rand_int_w_0(), "b": _rand_int_wo_0()}
+
+    result = calculate_string(compiled.simplified_expression, variables)
+
+    assert result == compiled.evaluate(variables)
+
+
+@pytest.mark.parametrize(
+    ("expression", "simplified"),
+    [("1 / 0", "1 / 0"), ("1e308 * 10", "1e+308 * 10"), ("9 ** 9 ** 9", "9 ** 387420489")],
+)
+def test_simplification_not_folded(expression: str, simplified: str) -> None:
+    """Test failing, non-finite and too expensive operations are not folded."""
+    result = compile_expression(expression).simplified_expression
+
+    assert result == simplified
+
+
+# Deep nesting
+
+
+def test_deeply_nested_sum() -> None:
+    """Test long sums are compiled and evaluated without recursion."""
+    expression = "+".join(["x"] * 2500)
+
+    result = calculate_string(expression, {"x": 1})
+
+    assert result == 2500
+
+
+def test_deeply_nested_power() -> None:
+    """Test long right associative chains are compiled and evaluated without recursion."""
+    expression = "x**" * 1500 + "x"
+
+    result = calculate_string(expression, {"x": 1})
+
+    assert result == 1
+
+
+def test_deeply_nested_unary() -> None:
+    """Test long chains of unary operators are simplified."""
+    compiled = compile_expression("-" * 2000 + "x")
+
+    assert compiled.simplified_expression == "x"
+
+
+def test_long_chain_too_deep_for_ast() -> None:
+    """Test chains of operators too long for ast.parse are parsed without recursion."""
+    expression = "+".join(["x", "2 * x", "-x", "(x - 1) ** 2"] * 5000)
+
+    for calculator in (StringCalculator(), StringCalculator(parser="ast")):
+        assert calculator.calculate(expression, {"x": 3}) == 5000 * 10
+
+
+def test_long_chain_too_deep_for_ast_max_nodes() -> None:
+    """Test the node limit applies to chains of operators too long for ast.parse."""
+    calculator = StringCalculator(limits=Limits(max_nodes=1000))
+
+    with pytest.raises(StringCalculatorError, match="Number of nodes exceeds the limit"):
+        calculator.compile("+".join(["1"] * 20_000))
+
+
+@pytest.mark.parametrize(
+    ("expression", "expected_result"),
+    [
+        ("-" * 100_000 + "1", 1),
+        ("1**" * 5000 + "1", 1),
+        ("(" * 300 + "1" + ")" * 300, 1),
+    ],
+)
+def test_too_deep_for_ast(expression: str, expected_result: int) -> None:
+    """Test expressions ast.parse fails on with any error are parsed without recursion."""
+    for calculator in (StringCalculator(), StringCalculator(parser="ast")):
+        assert calculator.calculate(expression) == expected_result
+
+
+@pytest.mark.parametrize(
+    ("expression", "variables", "expected_result"),
+    [
+        ("+".join(["abs(x)"] * 3000), {"x": -2}, 6000),
+        ("abs(" * 300 + "x" + ")" * 300, {"x": -2}, 2),
+        ("abs(x)**" * 5000 + "x", {"x": 1}, 1),
+        ("+".join(["x"] * 3000) + " >= 3000 > x", {"x": 1}, True),
+        ("+".join(["x"] * 3000) + " if x > 0 else -x", {"x": 1}, 3000),
+        ("not " * 3001 + "x or x and x", {"x": 0}, True),
+        ("y = " + "+".join(["x"] * 3000) + "\ny * 2", {"x": 1}, 6000),
+    ],
+)
+def test_too_deep_for_ast_syntax(
+    expression: str, variables: Dict[str, int], expected_result: Union[int, bool]
+) -> None:
+    """Test calls, comparisons, conditions and scripts too deep for ast.parse."""
+    for calculator in (StringCalculator(), StringCalculator(parser="ast")):
+        assert calculator.calculate(expression, variables) == expected_result
+
+
+def test_too_deep_for_ast_source_text() -> None:
+    """Test number literals too deep for ast.parse keep their source text."""
+    calculator = StringCalculator(number_type=Decimal)
+
+    result = calculator.calculate("+".join(["0.1"] * 3000) + " == 300")
+
+    assert result is True
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["[" * 300 + "1" + "]" * 300, "abs(1)**" * 5000 + "x.real"],
+)
+def test_nested_too_deeply_for_parser(expression: str) -> None:
+    """Test error is risen if the expression is too deep for ast.parse."""
+    with pytest.raises(StringCalculatorError, match="nested too deeply"):
+        compile_expression(expression)
+
+
+# Limits
+
+
+def test_limit_max_length() -> None:
+    """Test too long expressions are rejected before parsing."""
+    calculator = StringCalculator(limits=Limits(max_length=5))
+
+    assert calculator.calculate("1+2+3") == 6
+    with pytest.raises(StringCalculatorError, match="length limit of 5"):
+        calculator.calculate("1 + 2 + 3")
+
+
+def test_limit_max_nodes() -> None:
+    """Test expressions with too many nodes are rejected."""
+    calculator = StringCalculator(limits=Limits(max_nodes=5))
+
+    assert calculator.calculate("1+2") == 3
+    with pytest.raises(StringCalculatorError, match="nodes exceeds the limit of 5"):
+        calculator.calculate("1+2+3")
+
+
+@pytest.mark.parametrize("expression", ["9 ** 9 ** 9", "x ** 101", "2 ** -101.5"])
+def test_limit_max_exponent(expression: str) -> None:
+    """Test too big exponents are rejected."""
+    calculator = StringCalculator(limits=Limits(max_exponent=100))
+
+    with pytest.raises(StringCalculatorError, match="Exponent exceeds the limit of 100"):
+        calculator.calculate(expression, {"x": 2})
+
+
+@pytest.mark.parametrize(
+    "expression", ["2 ** 64", "x ** 64", "x * x * x", "x * x + x * x", str(2**64)]
+)
+def test_limit_max_bits(expression: str) -> None:
+    """Test integers with too many bits are rejected."""
+    calculator = StringCalculator(limits=Limits(max_bits=64))
+
+    with pytest.raises(StringCalculatorError, match="limit of 64 bits"):
+        calculator.calculate(expression, {"x": 2**32 - 1})
+
+
+@pytest.mark.parametrize(
+    ("limits", "expression", "message"),
+    [
+        (Limits(max_exponent=100), "round(1, -10 ** 7)", "Exponent exceeds the limit of 100"),
+        (Limits(max_bits=64), "round(x, -20)", "limit of 64 bits"),
+        (Limits(max_bits=64), "round(x / 3, 20)", "limit of 64 bits"),
+    ],
+)
+def test_limit_round_digits(limits: Limits, expression: str, message: str) -> None:
+    """Test rounding exact numbers to too many digits is rejected."""
+    calculator = StringCalculator(number_type=Fraction, limits=limits)
+
+    with pytest.raises(StringCalculatorError, match=message):
+        calculator.calculate(expression, {"x": 2})
+
+
+def test_limit_round_digits_within() -> None:
+    """Test rounding within the limits and of floats is calculated."""
+    calculator = StringCalculator(limits=Limits(max_exponent=2, max_bits=64))
+
+    assert calculator.calculate("round(x, -2) + round(0.5, 10000000)", {"x": 1234}) == 1200.5
+
+
+def test_limit_max_bits_within() -> None:
+    """Test integers within the bit limit and floats are calculated."""
+    calculator = StringCalculator(limits=Limits(max_bits=64))
+
+    result = calculator.calculate("2 ** 63 + x ** 64.0", {"x": 2})
+
+    assert result == 2**63 + 2.0**64
+
+
+def test_limit_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test evaluation is aborted after the time limit."""
+    calculator = StringCalculator(limits=Limits(timeout=2.5))
+    compiled = calculator.compile("x + x + x + x")
+    clock = iter(range(100))
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+
+    with pytest.raises(StringCalculatorError, match="time limit of 2.5 seconds"):
+        compiled.evaluate({"x": 1})
+
+
+def test_limit_not_folded() -> None:
+    """Test constant folding respects the limits and fails on evaluation."""
+    calculator = StringCalculator(limits=Limits(max_exponent=2))
+    compiled = calculator.compile("2 ** 3 * x")
+
+    assert compiled.simplified_expression == "2 ** 3 * x"
+    with pytest.raises(StringCalculatorError, match="Exponent exceeds the limit of 2"):
+        compiled.evaluate({"x": 1})
+
+
+def test_limit_change_clears_cache() -> None:
+    """Test changing the limits clears the calculator's cache."""
+    calculator = StringCalculator()
+    calculator.calculate("2 ** 3")
+
+    calculator.limits = Limits(max_exponent=2)
+
+    assert len(calculator.cache) == 0
+    with pytest.raises(StringCalculatorError, match="Exponent exceeds the limit of 2"):
+        calculator.calculate("2 ** 3")
+
+
+# Number types
+
+
+def test_decimal_exact_literals() -> None:
+    """Test float literals are parsed from their text into decimals."""
+    calculator = StringCalculator(number_type=Decimal)
+
+    assert calculator.calculate("0.1 + 0.2") == Decimal("0.3")
+    assert calculator.calculate("1_000.5e-3 * 2") == Decimal("2.0010")
+    assert calculator.calculate("1e999 - 1e999") == Decimal(0)
+
+
+def test_decimal_context() -> None:
+    """Test decimal context is used for folding and evaluation."""
+    calculator = StringCalculator(number_type=Decimal, decimal_context=decimal.Context(prec=5))
+    compiled = calculator.compile("1 / 3 + x / 3")
+
+    assert compiled.simplified_expression == "0.33333 + x / 3"
+    assert compiled.evaluate({"x": Decimal(2)}) == Decimal("1.0000")
+    assert decimal.getcontext().prec == 28
+
+
+def test_decimal_context_change_clears_cache() -> None:
+    """Test changing the decimal context clears the calculator's cache."""
+    calculator = StringCalculator(number_type=Decimal)
+    calculator.calculate("1 / 3")
+
+    calculator.decimal_context = decimal.Context(prec=2)
+
+    assert calculator.calculate("1 / 3") == Decimal("0.33")
+
+
+def test_decimal_no_double_negation_simplification() -> None:
+    """Test ``--x`` is kept as decimal negation rounds to the context."""
+    calculator = StringCalculator(number_type=Decimal, decimal_context=decimal.Context(prec=2))
+    compiled = calculator.compile("--x")
+
+    assert compiled.simplified_expression == "--x"
+    assert compiled.evaluate({"x": Decimal("1.234")}) == Decimal("1.2")
+
+
+def test_fraction_exact() -> None:
+    """Test fractions give exact results and are shown as divisions."""
+    calculator = StringCalculator(number_type=Fraction)
+    compiled = calculator.compile("1 / 3 * x + 0.25")
+
+    assert compiled.evaluate({"x": 2}) == Fraction(11, 12)
+    assert compiled.simplified_expression == "1/3 * x + 1/4"
+    assert calculator.calculate(compiled.simplified_expression, {"x": 2}) == Fraction(11, 12)
+
+
+@pytest.mark.parametrize(
+    ("expression", "simplified"),
+    [("-(1 / 3) ** 2", "-1/9"), ("x ** (1 / -3)", "x ** (-1/3)"), ("x - -(2/3)", "x - -2/3")],
+)
+def test_fraction_simplified_expression(expression: str, simplified: str) -> None:
+    """Test fraction constants are parenthesized by the precedence of a division."""
+    calculator = StringCalculator(number_type=Fraction)
+
+    assert calculator.compile(expression).simplified_expression == simplified
+
+
+def test_fraction_limit_max_bits() -> None:
+    """Test bit limit applies to fraction literals and results."""
+    calculator = StringCalculator(number_type=Fraction, limits=Limits(max_bits=64))
+
+    with pytest.raises(StringCalculatorError, match="Constant exceeds the limit of 64 bits"):
+        calculator.calculate("1e1000000000")
+    with pytest.raises(StringCalculatorError, match="exceeds the limit of 64 bits"):
+        calculator.calculate("(1 / 3) ** 100")
+
+
+def test_fraction_default_limit_max_bits() -> None:
+    """Test exact powers of fractions are limited unless other limits are given."""
+    calculator = StringCalculator(number_type=Fraction)
+
+    assert calculator.limits == Limits(max_bits=1_000_000)
+    assert calculator.calculate("1e3 ** 1e3") == 1000**1000
+    with pytest.raises(StringCalculatorError, match="exceeds the limit of 1000000 bits"):
+        calculator.calculate("1e3 ** 1e3 ** 1e3")
+    assert StringCalculator(number_type=Fraction, limits=Limits()).limits == Limits()
+
+
+@pytest.mark.parametrize("number_type", [Decimal, Fraction])
+def test_number_type_complex_rejected(number_type: type) -> None:
+    """Test complex literals cannot be converted."""
+    calculator = StringCalculator(number_type=number_type)
+
+    with pytest.raises(StringCalculatorError, match="Complex numbers are not supported"):
+        calculator.calculate("1 + 2j")
+
+
+def test_number_type_unsupported() -> None:
+    """Test only decimals and fractions are supported as number type."""
+    with pytest.raises(ValueError, match="Unsupported number type"):
+        StringCalculator(number_type=float)
+
+
+def test_number_type_pickle() -> None:
+    """Test number type and decimal context are pickled with the calculator."""
+    calculator = StringCalculator(number_type=Decimal, decimal_context=decimal.Context(prec=3))
+
+    result = pickle.loads(pickle.dumps(calculator))  # noqa: S301
+
+    assert result.number_type is Decimal
+    assert result.calculate("1 / 3") == Decimal("0.333")
+
+
+# Functions
+
+
+def test_function_call() -> None:
+    """Test default functions are called with the evaluated arguments."""
+    compiled = compile_expression("max(sqrt(x), abs(-y), 1) + round(x / 3, 2)")
+
+    assert compiled.evaluate({"x": 16, "y": 3}) == 4 + 5.33
+    assert compiled.simplified_expression == "max(sqrt(x), abs(-y), 1) + round(x / 3, 2)"
+
+
+def test_function_call_folded() -> None:
+    """Test calls of default functions with constant arguments are folded."""
+    assert compile_expression("sqrt(16) * x + min(2, 3)").simplified_expression == "4.0 * x + 2"
+
+
+def test_function_call_not_folded() -> None:
+    """Test calls of registered functions are not folded as they may have side effects."""
+    calls = []
+
+    def _count() -> int:
+        calls.append(1)
+        return len(calls)
+
+    calculator = StringCalculator(functions={"count": _count, "twice": lambda x: 2 * x})
+    compiled = calculator.compile("count() + twice(2)")
+
+    assert compiled.evaluate() == 5
+    assert compiled.evaluate() == 6
+    assert compiled.simplified_expression == "count() + twice(2)"
+
+
+def test_function_math_domain_error() -> None:
+    """Test math domain errors are raised as StringCalculatorError."""
+    with pytest.raises(StringCalculatorError, match="math domain error"):
+        calculate_string("sqrt(x)", {"x": -1})
+
+
+@pytest.mark.parametrize(
+    ("expression", "message"),
+    [
+        ("eval(1)", "Unknown function `eval`"),
+        ("round(x, ndigits=2)", "unsupported node"),
+        ("math.sqrt(4)", "unsupported node"),
+        ("(lambda: 1)()", "unsupported node"),
+    ],
+)
+def test_function_call_rejected(expression: str, message: str) -> None:
+    """Test only registered functions can be called by name and positional arguments."""
+    with pytest.raises(StringCalculatorError, match=message):
+        compile_expression(expression)
+
+
+def test_register_function() -> None:
+    """Test registering and unregistering functions clears the cache."""
+    calculator = StringCalculator()
+    calculator.calculate("1 + 1")
+
+    calculator.register_function("double", lambda x: 2 * x)
+
+    assert len(calculator.cache) == 0
+    assert calculator.calculate("double(21)") == 42
+    assert "double" not in strcalc.DEFAULT_FUNCTIONS
+    calculator.unregister_function("double")
+    with pytest.raises(StringCalculatorError, match="Unknown function `double`"):
+        calculator.calculate("double(21)")
+
+
+@pytest.mark.parametrize(
+    ("name", "func", "exception"), [("no name", abs, ValueError), ("f", 1, TypeError)]
+)
+def test_register_function_invalid(name: str, func: Any, exception: type) -> None:
+    """Test invalid names and functions are rejected."""
+    with pytest.raises(exception):
+        StringCalculator().register_function(name, func)
+
+
+def test_functions_read_only() -> None:
+    """Test the functions mapping cannot be changed directly."""
+    with pytest.raises(TypeError):
+        StringCalculator().functions["f"] = abs  # type: ignore[index]
+
+
+def test_function_limit_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the time limit is checked before function calls."""
+    calculator = StringCalculator(limits=Limits(timeout=0.5))
+    compiled = calculator.compile("sqrt(x)")
+    clock = iter(range(100))
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+
+    with pytest.raises(StringCalculatorError, match="time limit"):
+        compiled.evaluate({"x": 4})
+
+
+# Comparisons and conditions
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "a < b",
+        "a <= b < c",
+        "a == b != c",
+        "a > b >= c",
+        "not a",
+        "a and b",
+        "a or b and c",
+        "not a or b",
+        "a if b else c",
+        "a if b < c else -a if c else 2 * a",
+        "(a and b) + (a or c) * 2",
+        "max(a, b) == 2 and min(b, c) < 1",
+    ],
+)
+def test_comparisons_and_conditions(expression: str) -> None:
+    """Test results match Python for all combinations of values."""
+    compiled = compile_expression(expression)
+    for a in (-1, 0, 2):
+        for b in (0, 1, 2):
+            for c in (0, 2):
+                variables = {"a": a, "b": b, "c": c}
+                expected = eval(expression, {"max": max, "min": min}, variables)  # noqa: S307
+
+                assert compiled.evaluate(variables) == expected
+
+
+def test_short_circuit() -> None:
+    """Test operands not affecting the result are not evaluated."""
+    calls = []
+
+    def _call(value: int) -> int:
+        calls.append(value)
+        return value
+
+    calculator = StringCalculator(functions={"f": _call})
+
+    assert calculator.calculate("f(0) and f(1)") == 0
+    assert calculator.calculate("f(2) or f(3)") == 2
+    assert calculator.calculate("f(4) if f(0) else f(5)") == 5
+    assert calculator.calculate("f(6) < f(0) < f(7)") is False
+    assert calls == [0, 2, 0, 5, 6, 0]
+
+
+def test_short_circuit_errors_skipped() -> None:
+    """Test errors in skipped branches are not raised."""
+    assert calculate_string("x != 0 and 1 / x", {"x": 0}) is False
+    assert calculate_string("1 / x if x else 0", {"x": 0}) == 0
+
+
+@pytest.mark.parametrize(
+    ("expression", "simplified"),
+    [
+        ("1 and x", "x"),
+        ("0 and x", "0"),
+        ("x or 0 or y", "x or y"),
+        ("x if 1 else 1 / 0", "x"),
+        ("x if 0 else y - 0", "y"),
+        ("(a or b) and c", "(a or b) and c"),
+        ("(a < b) < c", "(a < b) < c"),
+        ("a < b < c", "a < b < c"),
+        ("-(a < b) + (x if a else y)", "-(a < b) + (x if a else y)"),
+        ("(a if b else c) if d else e", "(a if b else c) if d else e"),
+        ("not (a and b)", "not (a and b)"),
+        ("-(-(a or -b))", "--(a or -b)"),
+        ("-(-(-(a or -b)))", "-(a or -b)"),
+    ],
+)
+def test_conditions_simplified_expression(expression: str, simplified: str) -> None:
+    """Test constant conditions are removed and parentheses kept where needed."""
+    assert compile_expression(expression).simplified_expression == simplified
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "(a > 1) * 1",
+        "1 * (a > 1)",
+        "(a > 1) - 0",
+        "--(a > 1)",
+        "(not a) * 1",
+        "(a or a > 1) * 1",
+        "(1 < a < 3) * 1",
+    ],
+)
+def test_conditions_identities_convert_bool(expression: str) -> None:
+    """Test identities are kept for operands which can be booleans like in Python."""
+    for value in (0, 2):
+        expected = eval(expression, {"a": value})  # noqa: S307
+
+        result = calculate_string(expression, {"a": value})
+
+        assert (result, type(result)) == (expected, type(expected))
+
+
+def test_conditions_skipped_branch_validated() -> None:
+    """Test branches removed by constant conditions are still validated."""
+    with pytest.raises(StringCalculatorError, match="unsupported node"):
+        compile_expression("x if 1 else [1]")
+
+
+@pytest.mark.parametrize("expression", ["a in b", "a is b", "a not in b"])
+def test_comparisons_unsupported(expression: str) -> None:
+    """Test membership and identity comparisons are rejected."""
+    with pytest.raises(StringCalculatorError, match="unsupported node"):
+        compile_expression(expression)
+
+
+# Operator policy
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["a << 2 | b", "a & b ^ ~b", "a >> 1 + b", "-a & 7 == 3", "(a | b) * 2", "~a ** 2"],
+)
+def test_bitwise_operators(expression: str) -> None:
+    """Test enabled bitwise operators match Python and keep precedence when simplified."""
+    calculator = StringCalculator(operators=strcalc.DEFAULT_OPERATORS | strcalc.BITWISE_OPERATORS)
+    compiled = calculator.compile(expression)
+    variables = {"a": 6, "b": 3}
+    expected = eval(expression, {}, variables)  # noqa: S307
+
+    assert compiled.evaluate(variables) == expected
+    assert calculator.calculate(compiled.simplified_expression, variables) == expected
+
+
+def test_matmul_operator() -> None:
+    """Test matrix multiplication is passed to the operands."""
+
+    class _Matrix:  # pylint: disable=too-few-public-methods
+        def __matmul__(self, other: Any) -> int:  # noqa: ANN401
+            return 42
+
+    calculator = StringCalculator(operators=strcalc.ALL_OPERATORS)
+    variables: Dict[str, Any] = {"a": _Matrix(), "b": _Matrix()}
+
+    assert calculator.calculate("a @ b", variables) == 42
+
+
+@pytest.mark.parametrize("expression", ["1 << 2", "1 & 2", "~1", "a @ b"])
+def test_bitwise_operators_disabled_by_default(expression: str) -> None:
+    """Test bitwise and matrix operators are not enabled by default."""
+    with pytest.raises(StringCalculatorError, match="unsupported node"):
+        compile_expression(expression)
+
+
+def test_operator_disabled() -> None:
+    """Test disabled operators are rejected and the cache is cleared."""
+    calculator = StringCalculator()
+    calculator.calculate("2 ** 3")
+
+    calculator.operators = strcalc.DEFAULT_OPERATORS - {operator.pow}
+
+    assert len(calculator.cache) == 0
+    assert calculator.calculate("2 * 3") == 6
+    with pytest.raises(StringCalculatorError, match="unsupported node: `<class '.*Pow'>`"):
+        calculator.calculate("2 ** 3")
+
+
+def test_operator_unsupported() -> None:
+    """Test only known operators can be enabled."""
+    with pytest.raises(ValueError, match="Unsupported operators"):
+        StringCalculator(operators={operator.concat})
+
+
+def test_limit_max_bits_shift() -> None:
+    """Test left shifts are checked against the bit limit before they run."""
+    calculator = StringCalculator(
+        limits=Limits(max_bits=64), operators=strcalc.DEFAULT_OPERATORS | strcalc.BITWISE_OPERATORS
+    )
+
+    assert calculator.calculate("1 << 63") == 2**63
+    with pytest.raises(StringCalculatorError, match="exceeds the limit of 64 bits"):
+        calculator.calculate("1 << x", {"x": 10**12})
+
+
+# Scripts
+
+
+def test_script() -> None:
+    """Test assigned intermediate results are reused by later statements."""
+    compiled = compile_expression("base = a * b; base + base ** 2")
+
+    assert compiled.evaluate({"a": 2, "b": 3}) == 42
+    assert compiled.names == ("a", "b")
+    assert compiled.local_names == ("base",)
+
+
+def test_script_computed_once() -> None:
+    """Test assigned values are computed once per evaluation."""
+    calls = []
+
+    def _call(value: int) -> int:
+        calls.append(value)
+        return value
+
+    calculator = StringCalculator(functions={"f": _call})
+
+    assert calculator.calculate("x = f(3)\ny = x * x\nx + y") == 12
+    assert calls == [3]
+
+
+def test_script_reassignment() -> None:
+    """Test names refer to variables until assigned and then to the latest value."""
+    compiled = compile_expression("x = x + 1; x = x * x; x - 1")
+
+    assert compiled.evaluate({"x": 2}) == 8
+    assert compiled.names == ("x",)
+
+
+@pytest.mark.parametrize(
+    ("expression", "simplified"),
+    [
+        ("k = 2 * 3; y = k * x; y + k", "y = 6 * x; y + 6"),
+        ("t = -x if x < 0 else x; t < 2 and t", "t = -x if x < 0 else x; t < 2 and t"),
+        ("a = 1; a = a + x; a", "a = 1 + x; a"),
+    ],
+)
+def test_script_simplified_expression(expression: str, simplified: str) -> None:
+    """Test constant assignments are inserted where used."""
+    compiled = compile_expression(expression)
+
+    assert compiled.simplified_expression == simplified
+    assert compile_expression(simplified).evaluate({"x": -3}) == compiled.evaluate({"x": -3})
+
+
+@pytest.mark.parametrize(
+    ("expression", "message"),
+    [
+        ("a = 1", "Script must end with an expression"),
+        ("1; 2", "Only assignments can precede the final expression"),
+        ("a, b = 1, 2; a", "single name as target"),
+        ("a = b = 1; a", "single name as target"),
+        ("a += 1; a", "unsupported node"),
+        ("a = [1]; a", "unsupported node"),
+    ],
+)
+def test_script_invalid(expression: str, message: str) -> None:
+    """Test scripts consist of assignments followed by one expression."""
+    with pytest.raises(StringCalculatorError, match=message):
+        compile_expression(expression)
+
+
+# Common subexpression elimination
+
+
+def test_common_subexpressions_evaluated_once() -> None:
+    """Test identical subexpressions of default functions are evaluated once."""
+    calls = []
+
+    def _sqrt(value: float) -> float:
+        calls.append(value)
+        return math.sqrt(value)
+
+    calculator = StringCalculator()
+    calculator.register_function("sqrt", _sqrt)
+    impure = calculator.compile("sqrt(x * x) + sqrt(x * x)")
+    pure = compile_expression("(x * x + 1) * (x * x + 1) / (x * x + 1)")
+
+    assert impure.evaluate({"x": 3}) == 6
+    assert calls == [9, 9]
+    assert pure.evaluate({"x": 3}) == 10
+    assert pure.deduplicated_nodes == 10
+
+
+@pytest.mark.parametrize(
+    ("expression", "deduplicated"),
+    [
+        ("(x + y) * (x + y)", 3),
+        ("(x + 0.5) * (x + 0.5)", 3),
+        ("(x + 1) * (x + 1.0)", 0),
+        ("x * (y + 1) - x / (y - 2)", 0),
+        ("x * y + x * y + x * y", 6),
+        ("-x + -x", 0),
+        ("a * b > 1 and a * b", 3),
+        ("a * b if c else a * b", 0),
+        ("(a * b if c else 1) + a * b", 0),
+        ("a * b + (a * b if c else 1)", 3),
+        ("x = a * b; x = x + 1; x + a * b", 3),
+    ],
+)
+def test_common_subexpressions_deduplicated(expression: str, deduplicated: int) -> None:
+    """Test only subexpressions always evaluated after the first one are deduplicated."""
+    assert compile_expression(expression).deduplicated_nodes == deduplicated
+
+
+def test_common_subexpressions_short_circuit() -> None:
+    """Test deduplicated subexpressions in skipped branches do not raise."""
+    compiled = compile_expression("x != 0 and 1 / x + 1 / x")
+
+    assert compiled.deduplicated_nodes == 3
+    assert compiled.evaluate({"x": 0}) is False
+    assert compiled.evaluate({"x": 2}) == 1
+
+
+def test_common_subexpressions_simplified_expression() -> None:
+    """Test deduplicated subexpressions are repeated in the expression string."""
+    compiled = compile_expression("(x + y) * (x + y) ** 2")
+
+    assert compiled.simplified_expression == "(x + y) * (x + y) ** 2"
+
+
+# Fast path parser
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "(1 + 2) / 3",
+        "a * (b + 1) - a / (b - 2)",
+        "-2 ** -x ** 2 // +y % 3",
+        "--x - -(-y) + +(z)",
+        "1.5e3 * .5 - 1. + 2j * 1e-2J",
+        "x * 1 + 0 - (y - 0) ** 1",
+        "(x + y) * (x + y)",
+        "x\t+ y ",
+    ],
+)
+@pytest.mark.parametrize("number_type", [None, Decimal, Fraction])
+def test_fast_path_parser(
+    expression: str, number_type: type, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test simple expressions are compiled without ast like from their ast."""
+    calculator = StringCalculator(number_type=number_type, parser="ast")
+    try:
+        expected = calculator.compile(expression)
+    except StringCalculatorError as exc:
+        expected_error = str(exc)
+        calculator.parser = "auto"
+        with pytest.raises(StringCalculatorError) as exc_info:
+            calculator.compile(expression)
+        assert str(exc_info.value) == expected_error
+        return
+    monkeypatch.setattr(ast, "parse", None)
+    calculator.parser = "auto"
+
+    compiled = calculator.compile(expression)
+
+    assert compiled._code == expected._code
+    assert compiled.names == expected.names
+    assert compiled.simplified_expression == expected.simplified_expression
+    assert compiled.deduplicated_nodes == expected.deduplicated_nodes
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        " x + 1",
+        "x +",
+        "(x + 1",
+        "x + 1)",
+        "x y",
+        "007 + x",
+        "00 + x",
+        "1_000 * x",
+        "0x10 * x",
+        "1e * x",
+        "x.real",
+        "x if y else 1",
+        "True + 1",
+        "f(x) + 1",
+        "x @ y",
+        "x << 1",
+        "x + 1\n",
+        "\u00e9 + 1",
+        "\u0661 + 1",
+        "x ** 2 ** 3 ** 4 ** 5",
+        "+".join(["x"] * 200),
+        "(" * 60 + "x" + ")" * 60,
+    ],
+)
+def test_fast_path_parser_fallback(expression: str) -> None:
+    """Test other expressions and errors are left to the ast path with the same result."""
+    results: List[Tuple[Any, ...]] = []
+    for parser in ("auto", "ast"):
+        try:
+            compiled = StringCalculator(parser=parser).compile(expression)
+        except (StringCalculatorError, SyntaxError) as exc:
+            results.append((type(exc), str(exc)))
+        else:
+            results.append((compiled.names, compiled.simplified_expression))
+
+    assert results[0] == results[1]
+
+
+@pytest.mark.parametrize(
+    ("kwargs", "expression"),
+    [
+        ({"limits": Limits(max_nodes=5)}, "a * b + c"),
+        ({"limits": Limits(max_bits=8)}, "x + 1000"),
+        ({"operators": strcalc.DEFAULT_OPERATORS - {operator.pow}}, "x ** 2"),
+        ({"number_type": Decimal}, "1j + x"),
+    ],
+)
+def test_fast_path_parser_errors(kwargs: Dict[str, Any], expression: str) -> None:
+    """Test errors of simple expressions are the same as from the ast path."""
+    with pytest.raises(StringCalculatorError) as expected:
+        StringCalculator(parser="ast", **kwargs).compile(expression)
+    with pytest.raises(StringCalculatorError) as result:
+        StringCalculator(**kwargs).compile(expression)
+
+    assert str(result.value) == str(expected.value)
+
+
+def test_fast_path_parser_node_count() -> None:
+    """Test the fast path parser counts the nodes of the ast."""
+    profilers = {parser: ExpressionProfiler() for parser in ("auto", "ast")}
+    for parser, profiler in profilers.items():
+        StringCalculator(profiler=profiler, parser=parser).compile("-(x + 1) * 2")
+
+    assert profilers["auto"].as_dict()["-(x + 1) * 2"]["nodes"] == 8
+    assert profilers["ast"].as_dict()["-(x + 1) * 2"]["nodes"] == 8
+
+
+def test_parser_invalid() -> None:
+    """Test error is risen for unknown parsers."""
+    with pytest.raises(ValueError, match="Unknown parser `lark`."):
+        StringCalculator(parser="lark")
+
+
+# Profiler
+
+
+def test_profiler() -> None:
+    """Test compilations, cache hits, evaluations and errors are recorded."""
+    profiler = ExpressionProfiler()
+    calculator = StringCalculator(profiler=profiler)
+    for value in (1, 2, 0):
+        with contextlib.suppress(ZeroDivisionError):
+            calculator.calculate("1 / x", {"x": value})
+    with pytest.raises(StringCalculatorError):
+        calculator.calculate("1 / y")
+
+    stats = profiler.as_dict()["1 / x"]
+
+    assert stats["compilations"] == 1
+    assert stats["nodes"] == 5
+    assert stats["memory_hits"] == 2
+    assert stats["evaluations"] == 2
+    assert 0 < stats["max_evaluation_seconds"] <= stats["evaluation_seconds"]
+    assert stats["errors"] == {"ZeroDivisionError": 1}
+    assert profiler.as_dict()["1 / y"]["errors"] == {"StringCalculatorError": 1}
+
+
+def test_profiler_disk_hits(tmp_path: Path) -> None:
+    """Test expressions loaded from the disk cache are recorded as such."""
+    path = tmp_path / "cache.sqlite"
+    StringCalculator(disk_cache=DiskCache(path)).compile("x + 1")
+    profiler = ExpressionProfiler()
+
+    StringCalculator(disk_cache=DiskCache(path), profiler=profiler).calculate("x + 1", {"x": 1})
+
+    stats = profiler.as_dict()["x + 1"]
+    assert (stats["compilations"], stats["disk_hits"], stats["evaluations"]) == (0, 1, 1)
+
+
+def test_profiler_max_expressions() -> None:
+    """Test expressions beyond the maximum are recorded together."""
+    profiler = ExpressionProfiler(max_expressions=2)
+    calculator = StringCalculator(profiler=profiler)
+    for expression in ("1", "2", "3", "4"):
+        calculator.calculate(expression)
+
+    assert list(profiler.as_dict()) == ["1", "2", "<other>"]
+    assert profiler.as_dict()["<other>"]["evaluations"] == 2
+    profiler.clear()
+    assert not profiler.as_dict()
+
+
+def test_profiler_most_expensive() -> None:
+    """Test expressions are ordered by the time spent on them."""
+    profiler = ExpressionProfiler()
+    profiler.record_evaluation("a", 1.0)
+    profiler.record_compilation("b", 3.0, 4)
+    profiler.record_evaluation("c", 2.0)
+
+    assert [expression for expression, _ in profiler.most_expensive(2)] == ["b", "c"]
+
+
+def test_profiler_prometheus() -> None:
+    """Test statistics are exported in the Prometheus text format."""
+    profiler = ExpressionProfiler()
+    profiler.record_evaluation('a\\"b"\n', 0.5)
+    profiler.record_error("1 / 0", ZeroDivisionError())
+
+    text = profiler.to_prometheus(prefix="calc")
+
+    assert "# TYPE calc_evaluations_total counter\n" in text
+    assert 'calc_evaluations_total{expression="a\\\\\\"b\\"\\n"} 1\n' in text
+    assert 'calc_evaluation_seconds_max{expression="a\\\\\\"b\\"\\n"} 0.5\n' in text
+    assert 'calc_cache_hits_total{expression="1 / 0",cache="disk"} 0\n' in text
+    assert 'calc_errors_total{expression="1 / 0",category="ZeroDivisionError"} 1\n' in text
+
+
+def test_set_profiler() -> None:
+    """Test the calculator of `calculate_string` records statistics."""
+    profiler = ExpressionProfiler()
+    set_profiler(profiler)
+    try:
+        calculate_string("6 * 7")
+    finally:
+        set_profiler(None)
+    calculate_string("6 * 7")
+
+    assert profiler.as_dict()["6 * 7"]["evaluations"] == 1
+
+
+# Interval evaluation
+
+
+@pytest.mark.parametrize(
+    ("expression", "result"),
+    [
+        ("x + y", Interval(1, 6)),
+        ("x - y", Interval(-5, 0)),
+        ("x * y", Interval(-4, 8)),
+        ("y / (x + 2)", Interval(0.5, 4.0)),
+        ("-x", Interval(-2, 1)),
+        ("x ** 2", Interval(0, 4)),
+        ("x ** 3", Interval(-1, 8)),
+        ("y ** x", Interval(0.25, 16)),
+        ("abs(x) + fabs(x)", Interval(0, 4.0)),
+        ("max(x, y) - min(x, 0)", Interval(2, 5)),
+        ("x % 5", Interval(0, 5)),
+    ],
+)
+def test_evaluate_interval(expression: str, result: Interval) -> None:
+    """Test operators and functions result in the bounds of all results."""
+    assert (
+        compile_expression(expression).evaluate_interval(
+            {"x": Interval(-1, 2), "y": Interval(2, 4)}
+        )
+        == result
+    )
+
+
+def test_evaluate_interval_contains_results() -> None:
+    """Test results for values within the intervals lie within the resulting interval."""
+    compiled = compile_expression("sin(x) * y - sqrt(y) / (x + 5) + x ** 2 if y > 0 else 0")
+    variables = {"x": Interval(-1.5, 2.5), "y": Interval.from_uncertainty(3, 0.5)}
+    bounds = compiled.evaluate_interval(variables)
+    rng = random.Random(0)
+
+    for _ in range(200):
+        result = compiled.evaluate({"x": rng.uniform(-1.5, 2.5), "y": rng.uniform(2.5, 3.5)})
+        assert result in bounds
+
+
+def test_evaluate_interval_numbers() -> None:
+    """Test numbers are calculated as usual and decided conditions are taken."""
+    compiled = compile_expression("x * 2 if x >= 1 else 0")
+
+    assert compiled.evaluate_interval({"x": 3}) == 6
+    assert compiled.evaluate_interval({"x": Interval(1, 2)}) == Interval(2, 4)
+    assert compiled.evaluate_interval({"x": Interval(-2, 0)}) == 0
+
+
+@pytest.mark.parametrize(
+    ("expression", "message"),
+    [
+        ("1 if x > 0 else 2", "is undecided"),
+        ("10 if x == 1 else 0", r"Comparison Interval\(-1, 2\) == 1 is undecided"),
+        ("x != 0", r"Comparison Interval\(-1, 2\) != 0 is undecided"),
+        ("-2 < x == 1", "== 1 is undecided"),
+        ("x ** 0.5", "needs an integer exponent"),
+        ("tan(x * 2)", "is unbounded"),
+        ("atan2(x, 2)", "does not support intervals"),
+    ],
+)
+def test_evaluate_interval_error(expression: str, message: str) -> None:
+    """Test undecided or unbounded operations raise errors."""
+    with pytest.raises(StringCalculatorError, match=message):
+        compile_expression(expression).evaluate_interval({"x": Interval(-1, 2)})
+
+
+def test_evaluate_interval_equality_decided() -> None:
+    """Test equality comparisons of intervals are decided if the same for all values."""
+    compiled = compile_expression("x == y")
+
+    assert compiled.evaluate_interval({"x": Interval(0, 2), "y": Interval(3, 4)}) is False
+    assert compiled.evaluate_interval({"x": Interval(2), "y": 2}) is True
+    assert compile_expression("x != 5").evaluate_interval({"x": Interval(0, 2)}) is True
+
+
+def test_evaluate_interval_division_by_zero() -> None:
+    """Test division by intervals containing zero raises like division by zero."""
+    with pytest.raises(ZeroDivisionError):
+        compile_expression("1 / x").evaluate_interval({"x": Interval(-1, 2)})
+
+
+def test_evaluate_interval_program_reused(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the program for intervals is created once per compiled expression."""
+    calls: List[str] = []
+    interval_code = strcalc._interval_code
+    monkeypatch.setattr(
+        strcalc,
+        "_interval_code",
+        lambda code, limits: calls.append("called") or interval_code(code, limits),
+    )
+    compiled = compile_expression("max(x, 1) * 2")
+
+    assert compiled.evaluate_interval({"x": Interval(0, 2)}) == Interval(2, 4)
+    assert compiled.evaluate_interval({"x": Interval(2, 3)}) == Interval(4, 6)
+    assert compiled.evaluate({"x": 3}) == 6
+    assert calls == ["called"]
+
+
+def test_interval() -> None:
+    """Test creation and properties of intervals."""
+    interval = Interval.from_uncertainty(10, -2)
+
+    assert interval == Interval(8, 12)
+    assert interval.midpoint == 10
+    assert interval.uncertainty == 2
+    assert repr(interval) == "Interval(8, 12)"
+    assert Interval(5) == 5
+    assert hash(Interval(5)) == hash(5)
+    assert hash(Interval(1, 2)) == hash(Interval(1.0, 2.0))
+    assert 9 in interval
+    assert Interval(7, 9) not in interval
+    assert interval < 13
+    assert not interval > 12
+    with pytest.raises(ValueError, match="exceeds upper bound"):
+        Interval(2, 1)
+
+
+# Python functions
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "",
+        "a * (b + 1) - 2 ** 0.5 + 1j",
+        "sqrt(a * a + b * b) + 1 / sqrt(a * a + b * b)",
+        "0 < a < b <= 10 and not b == 3 or a if a > 1 else -b",
+        "x = a * b; a = x + 1; x * max(a, b)",
+        "_b0 = a + 1; _t0 = _b0 * 2; _t0 + sqrt(_b0 ** 2)",
+    ],
+)
+def test_to_function(expression: str) -> None:
+    """Test native functions calculate like the compiled expressions."""
+    compiled = compile_expression(expression)
+    function = compiled.to_function()
+
+    assert compiled.to_function() is function
+    for variables in ({"a": 2, "b": 3}, {"a": 0, "b": 7}):
+        args = [variables[name] for name in compiled.names]
+        assert function(*args) == compiled.evaluate(variables)
+        assert function(**dict(zip(compiled.names, args))) == compiled.evaluate(variables)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"limits": Limits(timeout=10)},
+        {"number_type": Decimal, "decimal_context": decimal.Context(prec=5)},
+        {"number_type": Fraction},
+    ],
+)
+def test_to_function_configuration(kwargs: Dict[str, Any]) -> None:
+    """Test native functions use the operators, functions and context of the calculator."""
+    calculator = StringCalculator(**kwargs)
+    compiled = calculator.compile("1 < x / 3 < y < 10 and abs(x / 3 - 2.5) or -x")
+
+    for x, y in ((4, 5), (4, 1), (6, 20)):
+        assert compiled.to_function()(x, y) == compiled.evaluate({"x": x, "y": y})
+
+
+def test_to_function_errors() -> None:
+    """Test native functions skip branches and raise the errors of the calculator."""
+    function = (
+        StringCalculator(limits=Limits(max_bits=16))
+        .compile("x != 0 and y ** x + 1 / x")
+        .to_function()
+    )
+
+    assert function(0, 2) is False
+    with pytest.raises(ZeroDivisionError):
+        compile_expression("1 / x").to_function()(0)
+    with pytest.raises(StringCalculatorError, match="Result exceeds the limit of 16 bits"):
+        function(20, 2)
+    with pytest.raises(StringCalculatorError, match="math domain error"):
+        compile_expression("sqrt(x)").to_function()(-1)
+
+
+def test_to_function_limit_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test native functions are aborted after the time limit."""
+    function = StringCalculator(limits=Limits(timeout=2.5)).compile("x + x + x + x").to_function()
+    clock = iter(range(100))
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+
+    with pytest.raises(StringCalculatorError, match="time limit of 2.5 seconds"):
+        function(1)
+
+
+def test_to_function_nested_too_deeply(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test error is risen if the generated source is too deep for compile."""
+    compiled = compile_expression("x + 1")
+
+    def _compile(*_: Any) -> None:
+        raise RecursionError
+
+    monkeypatch.setattr(strcalc, "compile", _compile, raising=False)
+
+    with pytest.raises(StringCalculatorError, match="nested too deeply to be compiled"):
+        compiled.to_function()
+
+
+# Serialization
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "",
+        "a * (b + 1) - 2 ** 0.5 + 1j",
+        "sqrt(a * a + b * b) + 1 / sqrt(a * a + b * b)",
+        "0 < a < b <= 10 and not b == 3 or a if a > 1 else -b",
+        "x = a * b; x = x + 1; x * max(a, b)",
+    ],
+)
+def test_serialization_roundtrip(expression: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test loaded expressions evaluate like the compiled ones without parsing."""
+    compiled = compile_expression(expression)
+    data = compiled.to_bytes()
+    monkeypatch.setattr(ast, "parse", None)
+
+    loaded = StringCalculator().load(data)
+
+    assert isinstance(data, bytes)
+    assert loaded.expression == expression
+    assert loaded.simplified_expression == compiled.simplified_expression
+    assert loaded.deduplicated_nodes == compiled.deduplicated_nodes
+    for variables in ({"a": 2, "b": 3}, {"a": 0, "b": 7}):
+        assert loaded.evaluate(variables) == compiled.evaluate(variables)
+
+
+@pytest.mark.parametrize(
+    ("number_type", "expression", "result"),
+    [
+        (Decimal, "0.1 + x / 3", Decimal("0.4333333333333333333333333333")),
+        (Fraction, "1 / 3 + x", Fraction(4, 3)),
+    ],
+)
+def test_serialization_number_types(number_type: type, expression: str, result: Any) -> None:
+    """Test exact constants are serialized without loss."""
+    calculator = StringCalculator(number_type=number_type)
+
+    loaded = calculator.load(calculator.compile(expression).to_bytes())
+
+    assert loaded.evaluate({"x": 1}) == result
+    with pytest.raises(ValueError, match="another number type"):
+        StringCalculator(number_type=None if number_type is Decimal else Decimal).load(
+            calculator.compile("x").to_bytes()
+        )
+
+
+def test_serialization_binds_calculator() -> None:
+    """Test operators and functions are bound to the loading calculator."""
+    data = StringCalculator(operators=strcalc.ALL_OPERATORS).compile("x << y").to_bytes()
+    calculator = StringCalculator(operators=strcalc.ALL_OPERATORS, limits=Limits(max_bits=16))
+
+    assert calculator.load(data).evaluate({"x": 1, "y": 8}) == 256
+    with pytest.raises(StringCalculatorError, match="Result exceeds the limit of 16 bits"):
+        calculator.load(data).evaluate({"x": 1, "y": 20})
+    with pytest.raises(StringCalculatorError, match="unavailable operator or function: `'lshift'`"):
+        StringCalculator().load(data)
+    with pytest.raises(StringCalculatorError, match="unavailable operator or function: `'f'`"):
+        StringCalculator().load(StringCalculator(functions={"f": abs}).compile("f(x)").to_bytes())
+
+
+def test_serialization_invalid() -> None:
+    """Test data of another format or version is rejected."""
+    data = compile_expression("1 + x").to_bytes()
+    header = strcalc._BYTECODE_HEADER
+
+    with pytest.raises(ValueError, match="too short"):
+        StringCalculator().load(data[:4])
+    with pytest.raises(ValueError, match="no serialized compiled expression"):
+        StringCalculator().load(b"XXXX" + data[4:])
+    with pytest.raises(ValueError, match="Unsupported bytecode version 99"):
+        StringCalculator().load(header.pack(b"SCBC", 99, 4) + data[header.size :])
+    with pytest.raises(ValueError, match="corrupt"):
+        StringCalculator().load(data[: header.size + 2])
+
+
+@pytest.mark.parametrize(
+    ("index", "instruction", "message"),
+    [
+        (0, (99, 0), "Unknown opcode `99`"),
+        (0, (strcalc._NAME, 2), "Argument `2` is out of range"),
+        (1, (strcalc._STORE, 0), "Argument `0` is out of range"),
+        (1, (strcalc._POP_JUMP_IF_FALSE, 5), "Argument `5` is out of range"),
+        (0, (strcalc._COMPARE, ("lt", -1)), "Argument `-1` is out of range"),
+        (1, (strcalc._CALL, ("abs", 3)), "Argument `3` is out of range"),
+        (0, (strcalc._CONST, ("Complex", 1)), "Unknown serialized constant"),
+        (0, (strcalc._BINARY, ["add"]), "unhashable"),
+    ],
+)
+def test_serialization_corrupt_program(
+    index: int, instruction: Tuple[int, Any], message: str
+) -> None:
+    """Test programs with invalid instructions are rejected on load."""
+    header = strcalc._BYTECODE_HEADER
+    data = compile_expression("abs(x) if y else 1").to_bytes()
+    payload = list(marshal.loads(data[header.size :]))
+    code = list(payload[-1])
+    code[index] = instruction
+    payload[-1] = tuple(code)
+
+    with pytest.raises(ValueError, match=f"corrupt: .*{message}"):
+        StringCalculator().load(data[: header.size] + marshal.dumps(tuple(payload)))
+
+
+def test_catalogue(tmp_path: Path) -> None:
+    """Test catalogues load stored expressions lazily and compile other ones."""
+    path = tmp_path / "catalogue.bin"
+    save_catalogue(path, [compile_expression("a + b"), compile_expression("a * b")])
+
+    with ExpressionCatalogue(path) as catalogue:
+        assert list(catalogue) == ["a + b", "a * b"]
+        assert len(catalogue) == 2
+        assert not catalogue._loaded
+        product = catalogue["a * b"]
+        assert catalogue["a * b"] is product
+        assert catalogue.compile("a * b") is product
+        assert catalogue.compile("a - b").evaluate({"a": 2, "b": 3}) == -1
+        with pytest.raises(KeyError):
+            catalogue["a - b"]  # pylint: disable=pointless-statement
+    assert product.evaluate({"a": 2, "b": 3}) == 6
+
+
+def test_catalogue_invalid(tmp_path: Path) -> None:
+    """Test files which are no catalogue are rejected."""
+    path = tmp_path / "catalogue.bin"
+    path.write_bytes(compile_expression("1").to_bytes())
+
+    with pytest.raises(ValueError, match="no serialized compiled expression"):
+        ExpressionCatalogue(path)
+
+
+# Disk cache
+
+
+def test_disk_cache_shared(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test expressions compiled once are loaded by other calculators without parsing."""
+    path = tmp_path / "cache.sqlite"
+    StringCalculator(disk_cache=DiskCache(path)).compile("a * max(b, 1)")
+    disk_cache = DiskCache(path)
+    monkeypatch.setattr(ast, "parse", None)
+
+    compiled = StringCalculator(disk_cache=disk_cache).compile("a * max(b, 1)")
+
+    assert compiled.evaluate({"a": 2, "b": 3}) == 6
+    assert disk_cache.info() == strcalc.CacheInfo(1, 0, 0, 100_000, 1)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"limits": Limits(max_bits=64)},
+        {"number_type": Decimal},
+        {"operators": strcalc.ALL_OPERATORS},
+        {"functions": {"sqrt": abs}},
+    ],
+)
+def test_disk_cache_keyed_by_configuration(tmp_path: Path, kwargs: Dict[str, Any]) -> None:
+    """Test expressions compiled with another configuration are not loaded."""
+    disk_cache = DiskCache(tmp_path / "cache.sqlite")
+    StringCalculator(disk_cache=disk_cache).compile("sqrt(2) + 1")
+
+    StringCalculator(disk_cache=disk_cache, **kwargs).compile("sqrt(2) + 1")
+
+    assert disk_cache.info().misses == 2
+    assert len(disk_cache) == 2
+
+
+def test_disk_cache_version_change(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test all entries are dropped when the library version changes."""
+    path = tmp_path / "cache.sqlite"
+    StringCalculator(disk_cache=DiskCache(path)).compile("1 + x")
+    assert len(DiskCache(path)) == 1
+
+    monkeypatch.setattr(strcalc, "__version__", "0.0.0")
+
+    assert len(DiskCache(path)) == 0
+
+
+def test_disk_cache_max_entries(tmp_path: Path) -> None:
+    """Test the least recently used entries are evicted."""
+    disk_cache = DiskCache(tmp_path / "cache.sqlite", max_entries=2)
+    calculator = StringCalculator(disk_cache=disk_cache, cache_size=0)
+    for expression in ("x + 1", "x + 2", "x + 1", "x + 3"):
+        calculator.compile(expression)
+
+    assert disk_cache.info() == strcalc.CacheInfo(1, 3, 1, 2, 2)
+    calculator.compile("x + 1")
+    assert disk_cache.info().hits == 2
+    with pytest.raises(ValueError, match="must be positive"):
+        DiskCache(tmp_path / "cache.sqlite", max_entries=0)
+
+
+def test_disk_cache_errors_ignored(tmp_path: Path) -> None:
+    """Test an unusable database does not make calculations fail."""
+    disk_cache = DiskCache(tmp_path / "missing" / "cache.sqlite")
+
+    assert StringCalculator(disk_cache=disk_cache).calculate("1 + 2") == 3
+    assert disk_cache.info().misses == 1
+
+
+def test_disk_cache_no_database_ignored(tmp_path: Path) -> None:
+    """Test a file which is no SQLite database does not make calculations fail."""
+    path = tmp_path / "cache.sqlite"
+    path.write_bytes(b"no database" * 100)
+    disk_cache = DiskCache(path)
+
+    assert StringCalculator(disk_cache=disk_cache).calculate("1 + 2") == 3
+    assert len(disk_cache) == 0
+    disk_cache.clear()
+    assert disk_cache.info().misses == 0
+    assert path.read_bytes() == b"no database" * 100
+
+
+def test_disk_cache_pickle(tmp_path: Path) -> None:
+    """Test calculators with disk cache can be sent to worker processes."""
+    calculator = StringCalculator(disk_cache=DiskCache(tmp_path / "cache.sqlite"))
+    calculator.compile("2 * x")
+
+    clone = pickle.loads(pickle.dumps(calculator))
+
+    assert clone.disk_cache is not None
+    assert calculator.disk_cache is not None
+    assert clone.disk_cache.path == calculator.disk_cache.path
+    assert clone.compile("2 * x").evaluate({"x": 4}) == 8
+    assert clone.disk_cache.info().hits == 1
+
+
+def test_set_disk_cache(tmp_path: Path) -> None:
+    """Test the calculator of `calculate_string` consults the disk cache."""
+    disk_cache = DiskCache(tmp_path / "cache.sqlite")
+    set_disk_cache(disk_cache)
+    try:
+        assert compile_expression("1 + 2 * y").evaluate({"y": 2}) == 5
+    finally:
+        set_disk_cache(None)
+
+    assert len(disk_cache) == 1
+
+
+# Asynchronous calculation
+
+
+class _CountingExecutor(ThreadPoolExecutor):
+    """Thread pool counting the submitted calculations."""
+
+    submitted = 0
+
+    def submit(self, *args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        """Count and submit the call."""
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+@pytest.mark.parametrize(
+    ("expression", "kwargs", "cost"),
+    [
+        ("a * (b + 1)", {}, 5),
+        ("x ** 2 + 1 << 3", {"operators": strcalc.ALL_OPERATORS}, 7),
+        ("x ** y", {}, float("inf")),
+        ("x ** (y if z else 2)", {}, float("inf")),
+        ("2 ** x", {"limits": Limits(max_bits=64)}, 3),
+        ("9 ** 9 ** 9", {}, float("inf")),
+        ("sqrt(x) + f(x)", {"functions": {"sqrt": math.sqrt, "f": pow}}, float("inf")),
+        ("x ** 64", {}, 3),
+        ("x ** 65", {}, float("inf")),
+        ("(((10**60)**60)**60)**60 % 7", {}, float("inf")),
+        ("(x if y else 2) ** 3", {}, 7),
+        ("(x if y else x ** 60) ** 2", {}, float("inf")),
+        ("round(x, 2) + round(x, -1000)", {}, 7),
+        ("round(x, -y)", {}, float("inf")),
+        ("round(x, -2000)", {}, float("inf")),
+        ("round(x, -y)", {"limits": Limits(max_bits=64)}, 4),
+        ("a = x * x; b = a * a; c = b * b; d = c * c; e = d * d; e * e", {}, 23),
+        (
+            "a = x * x; b = a * a; c = b * b; d = c * c; e = d * d; f = e * e; f * f",
+            {},
+            float("inf"),
+        ),
+    ],
+)
+def test_cost(expression: str, kwargs: Dict[str, Any], cost: float) -> None:
+    """Test the cost is infinite for operations which can take arbitrarily long."""
+    assert StringCalculator(**kwargs).compile(expression).cost == cost
+
+
+def test_calculate_async_inline() -> None:
+    """Test cheap expressions are calculated in the event loop."""
+    calculator = StringCalculator()
+    with _CountingExecutor(1) as executor:
+        result = asyncio.run(
+            calculator.calculate_async("a * (b + 1)", {"a": 2, "b": 3}, executor=executor)
+        )
+
+    assert result == 8
+    assert executor.submitted == 0
+    assert "a * (b + 1)" in calculator.cache
+
+
+@pytest.mark.parametrize(
+    ("expression", "kwargs"),
+    [
+        ("a ** b", {}),
+        ("+".join(["a"] * 50), {"max_inline_cost": 20}),
+        ("+".join(["a"] * 50), {"max_inline_length": 20}),
+    ],
+)
+def test_calculate_async_offloaded(expression: str, kwargs: Dict[str, Any]) -> None:
+    """Test expensive and long uncached expressions are calculated by the executor."""
+    calculator = StringCalculator()
+    with _CountingExecutor(1) as executor:
+        result = asyncio.run(
+            calculator.calculate_async(expression, {"a": 2, "b": 10}, executor=executor, **kwargs)
+        )
+
+    assert result == calculate_string(expression, {"a": 2, "b": 10})
+    assert executor.submitted == 1
+
+
+def test_calculate_async_inline_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test calculations in the event loop are aborted after the timeout."""
+    calculator = StringCalculator()
+    clock = itertools.count(step=2)
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+
+    with _CountingExecutor(1) as executor:
+        with pytest.raises(StringCalculatorError, match="time limit of 1 seconds"):
+            asyncio.run(
+                calculator.calculate_async(
+                    "x * y + 1", {"x": 2, "y": 3}, timeout=1, executor=executor
+                )
+            )
+
+    assert executor.submitted == 0
+
+
+def test_calculate_async_timeout() -> None:
+    """Test waiting for an offloaded calculation stops after the timeout."""
+    event = threading.Event()
+    calculator = StringCalculator()
+    calculator.register_function("wait", event.wait)
+
+    with ThreadPoolExecutor(1) as executor:
+        try:
+            with pytest.raises(StringCalculatorError, match="time limit of 0.01 seconds"):
+                asyncio.run(calculator.calculate_async("wait(5)", timeout=0.01, executor=executor))
+        finally:
+            event.set()
+
+
+def test_calculate_async_errors() -> None:
+    """Test errors of inline and offloaded calculations are risen."""
+    with pytest.raises(ZeroDivisionError):
+        asyncio.run(calculate_string_async("1 / 0"))
+    with pytest.raises(StringCalculatorError, match="unsupported node"):
+        asyncio.run(calculate_string_async("a.b", max_inline_length=0))
+
+
+def test_calculate_async_big_integers() -> None:
+    """Test big integer operations holding the GIL neither block nor occupy a process."""
+
+    async def calculate() -> int:
+        ticks = 0
+
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        try:
+            for expression, variables in (
+                ("9 ** 9 ** 9 % 10", {}),
+                ("(((10**60)**60)**60)**60 % 7", {}),
+                ("round(x, -y)", {"x": 1, "y": 10**7}),
+            ):
+                with pytest.raises(StringCalculatorError, match="time limit of 0.1 seconds"):
+                    await calculate_string_async(expression, variables, timeout=0.1)
+        finally:
+            ticker.cancel()
+        assert await calculate_string_async("2 ** x", {"x": 10}, timeout=2) == 1024
+        return ticks
+
+    start = time.monotonic()
+    ticks = asyncio.run(calculate())
+
+    assert time.monotonic() - start < 2
+    assert ticks > 2
+    #: the workers which exceeded the timeout were replaced by a single idle one
+    assert len(multiprocessing.active_children()) == 1
+
+
+def test_calculate_async_worker_reused() -> None:
+    """Test offloaded calculations reuse the worker process."""
+
+    async def calculate() -> List[Any]:
+        results = []
+        for exponent in (10, 20):
+            result = await calculate_string_async("2 ** x", {"x": exponent}, timeout=5)
+            results.append((result, multiprocessing.active_children()))
+        return results
+
+    (first, first_workers), (second, second_workers) = asyncio.run(calculate())
+
+    assert (first, second) == (2**10, 2**20)
+    assert len(first_workers) == 1
+    assert second_workers == first_workers
+
+
+def test_calculate_async_timeout_stops_executor() -> None:
+    """Test offloaded calculations stop after the timeout without a timeout limit."""
+    calls = []
+
+    def _slow(value: int) -> int:
+        calls.append(value)
+        time.sleep(0.02)
+        return value
+
+    calculator = StringCalculator()
+    calculator.register_function("slow", _slow)
+
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(StringCalculatorError, match="time limit of 0.1 seconds"):
+            asyncio.run(
+                calculator.calculate_async(
+                    "+".join(["slow(1)"] * 50), timeout=0.1, executor=executor
+                )
+            )
+
+    assert len(calls) < 50
+
+
+def test_calculate_async_unpicklable() -> None:
+    """Test calculators which cannot be sent to a process use the default executor."""
+    calculator = StringCalculator()
+    calculator.register_function("f", lambda x: x**2)
+
+    assert asyncio.run(calculator.calculate_async("f(3)", timeout=5)) == 9
+
+
+def test_calculate_until_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test offloaded calculations are aborted after the timeout with a timeout limit."""
+    calculator = StringCalculator(limits=Limits(timeout=60))
+    compiled = calculator.compile("x ** y")
+    clock = iter([0, 0, 2])
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+
+    with pytest.raises(StringCalculatorError, match="exceeded the time limit"):
+        calculator._calculate_until(compiled, compiled.expression, {"x": 2, "y": 3}, 1)
+
+
+def test_calculate_until_program_reused(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the program checking the deadline is created once per timeout."""
+    calls: List[float] = []
+    deadline_code = strcalc._deadline_code
+    monkeypatch.setattr(
+        strcalc,
+        "_deadline_code",
+        lambda code, timeout: calls.append(timeout) or deadline_code(code, timeout),
+    )
+    calculator = StringCalculator()
+
+    for timeout in (1, 1, 2, 2):
+        assert asyncio.run(calculator.calculate_async("x * 2", {"x": 3}, timeout=timeout)) == 6
+
+    assert calls == [1, 2]
+
+
+def test_calculate_string_async() -> None:
+    """Test expressions are calculated with the default calculator."""
+    result = asyncio.run(calculate_string_async("a ** b", {"a": 2, "b": 10}, timeout=5))
+
+    assert result == 1024
+
+
+# Formula sheets
+
+
+def test_sheet() -> None:
+    """Test formulas are calculated in order of their dependencies."""
+    sheet = FormulaSheet(
+        {"total": "net + tax", "tax": "net * rate", "net": "price * count"},
+        {"price": 10, "count": 3, "rate": 0.5},
+    )
+
+    assert list(sheet.formulas) == ["net", "tax", "total"]
+    assert sheet["total"] == 45
+    assert sheet.result("tax") == strcalc.CalculationResult("net * rate", 15, None)
+    assert sheet.dependencies("total") == {"net", "tax"}
+    assert sheet.dependents("net") == {"tax", "total"}
+    assert len(sheet) == 3
+    assert "tax" in sheet
+    assert "price" not in sheet
+
+
+def test_sheet_update_recalculates_affected() -> None:
+    """Test only formulas depending on changed variables are recalculated."""
+    sheet = FormulaSheet(
+        {"a2": "a * 2", "b2": "b * 2", "sum": "a2 + b2", "sign": "1 if a2 > 0 else -1"},
+        {"a": 1, "b": 2},
+    )
+
+    assert sheet.update({"b": 3}) == ["b2", "sum"]
+    assert sheet.update({"a": 2}) == ["a2", "sign", "sum"]
+    assert sheet.update({"a": 2, "b": 3}) == []
+    assert sheet.update({"a": 2.0}) == ["a2", "sign", "sum"]
+    assert sheet["sum"] == 10.0
+
+
+def test_sheet_update_stops_at_unchanged_results() -> None:
+    """Test formulas are not recalculated if the results they use did not change."""
+    sheet = FormulaSheet({"positive": "x > 0", "label": "positive * 10"}, {"x": 1})
+
+    assert sheet.update({"x": 5}) == ["positive"]
+    assert sheet["label"] == 10
+
+
+def test_sheet_errors() -> None:
+    """Test errors are kept per formula and propagate to formulas using them."""
+    sheet = FormulaSheet({"ratio": "a / b", "percent": "ratio * 100", "other": "a"})
+    sheet.update({"a": 1, "b": 0})
+
+    with pytest.raises(ZeroDivisionError):
+        sheet["ratio"]  # pylint: disable=pointless-statement
+    with pytest.raises(StringCalculatorError, match="no value for variable: `ratio`"):
+        sheet["percent"]  # pylint: disable=pointless-statement
+    assert sheet["other"] == 1
+    assert sheet.update({"b": 4}) == ["ratio", "percent"]
+    assert sheet["percent"] == 25
+
+
+def test_sheet_set_and_remove_formula() -> None:
+    """Test changed formulas are recalculated with the formulas using them."""
+    sheet = FormulaSheet({"double": "x * 2", "quad": "double * 2"}, {"x": 3})
+
+    assert sheet.set_formula("double", "x + x + 1") == ["double", "quad"]
+    assert sheet["quad"] == 14
+    assert sheet.set_formula("half", "quad / 2") == ["half"]
+    assert sheet.remove_formula("double") == ["quad", "half"]
+    with pytest.raises(StringCalculatorError, match="no value for variable: `quad`"):
+        sheet["half"]  # pylint: disable=pointless-statement
+    assert sheet.dependents("double") == {"quad"}
+
+
+@pytest.mark.parametrize(
+    "formulas", [{"a": "a + 1"}, {"a": "b + 1", "b": "c * 2", "c": "a - 1", "d": "c"}]
+)
+def test_sheet_cycle(formulas: Dict[str, str]) -> None:
+    """Test formulas referring to each other in a cycle are rejected."""
+    sheet = FormulaSheet({"c": "x"}, {"x": 1})
+
+    with pytest.raises(StringCalculatorError, match="cycle"):
+        sheet.set_formulas(formulas)
+    assert sheet.formulas == {"c": "x"}
+    assert sheet.dependents("a") == frozenset()
+    assert sheet.update({"x": 2}) == ["c"]
+
+
+def test_sheet_invalid_names() -> None:
+    """Test names cannot be used for a formula and a variable."""
+    sheet = FormulaSheet({"y": "x + 1"}, {"x": 1})
+
+    with pytest.raises(ValueError, match="Name `x` is used for a variable."):
+        sheet.set_formula("x", "2")
+    with pytest.raises(ValueError, match="Name `y` is used for a formula."):
+        sheet.update({"y": 2})
+
+
+def test_sheet_incremental_like_full_calculation() -> None:
+    """Test incremental recalculation results in the same values as a new sheet."""
+    rand = random.Random(1)
+    formulas = {}
+    for index in range(200):
+        used = [f"f{other}" for other in rand.sample(range(index), min(index, 2))]
+        used.append(rand.choice(["a", "b", "c"]))
+        formulas[f"f{index}"] = f"{used[0]} * 0.5 - {used[-1]} % 3"
+    sheet = FormulaSheet(formulas, {"a": 1, "b": 2, "c": 3})
+
+    for _ in range(20):
+        variables = {rand.choice("abc"): rand.randrange(-3, 4)}
+        sheet.update(variables)
+        expected = FormulaSheet(formulas, sheet.variables)
+        for name in formulas:
+            assert repr(sheet.result(name)) == repr(expected.result(name))
+
+
+# Parallel batch calculation
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_calculate_many(executor: str) -> None:
+    """Test results are in order and errors do not abort the batch."""
+    expressions = [f"{num} * 2" for num in range(50)] + ["1 / 0", "1 @ 1", "2 ** 2"]
+
+    results = list(calculate_many(expressions, workers=2, executor=executor, chunksize=7))
+
+    assert [item.expression for item in results] == expressions
+    assert [item.result for item in results[:50]] == [num * 2 for num in range(50)]
+    assert isinstance(results[50].error, ZeroDivisionError)
+    assert isinstance(results[51].error, StringCalculatorError)
+    assert results[52] == CalculationResult("2 ** 2", 4, None)
+
+
+def test_calculate_many_calculator() -> None:
+    """Test given calculator is used in worker processes."""
+    calculator = StringCalculator(limits=Limits(max_exponent=2))
+
+    results = list(calculate_many(["2 ** 3"], workers=1, calculator=calculator))
+
+    assert isinstance(results[0].error, StringCalculatorError)
+
+
+def test_calculate_many_streaming() -> None:
+    """Test expressions are consumed lazily."""
+    consumed = []
+
+    def _expressions() -> Iterator[str]:
+        for num in range(1000):
+            consumed.append(num)
+            yield str(num)
+
+    results = calculate_many(_expressions(), workers=1, executor="thread", chunksize=10)
+    first = next(results)
+    results.close()  # type: ignore[attr-defined]  # generator
+
+    assert first.result == 0
+    assert len(consumed) < 1000
+
+
+def test_calculate_many_not_iterated(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the pool is created on iteration and shut down when it ends."""
+    pools: List[_CountingExecutor] = []
+
+    def _create_pool(*args: Any, **kwargs: Any) -> _CountingExecutor:
+        pools.append(_CountingExecutor(*args, **kwargs))
+        return pools[-1]
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", _create_pool)
+    monkeypatch.setattr(strcalc, "_WORKER_CALCULATOR", None)
+
+    results = calculate_many(["1 + 1"], workers=2)
+    del results
+    assert not pools
+
+    results = calculate_many(["1 + 1", "2 + 2"], workers=2, chunksize=1)
+    assert next(results).result == 2
+    results.close()  # type: ignore[attr-defined]  # generator
+    assert len(pools) == 1
+    assert pools[0]._shutdown
+
+
+@pytest.mark.parametrize("kwargs", [{"executor": "cluster"}, {"workers": -1}, {"chunksize": 0}])
+def test_calculate_many_invalid_args(kwargs: Dict[str, Any]) -> None:
+    """Test invalid arguments are rejected on call."""
+    with pytest.raises(ValueError):
+        calculate_many(["1"], **kwargs)
+
+
+def test_string_calculator_pickle() -> None:
+    """Test calculator is pickled with its configuration only."""
+    calculator = StringCalculator(limits=Limits(max_bits=8), cache_size=3)
+    calculator.calculate("1")
+
+    result = pickle.loads(pickle.dumps(calculator))  # noqa: S301
+
+    assert result.limits == calculator.limits
+    assert result.cache.maxsize == 3
+    assert len(result.cache) == 0
+
+
+# CLI
+
+
+def test_cli_plain(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    """Test CLI reads stdin and writes one line per expression."""
+    monkeypatch.setattr("sys.stdin", io.StringIO("1+2\n\n  2**10  \n"))
+
+    exit_code = cli_caller([])
+
+    assert exit_code == 0
+    assert capsys.readouterr().out == "3\n\n1024\n"
+
+
+def test_cli_error_exit_code(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test CLI reports errors inline and exits with 1."""
+    monkeypatch.setattr("sys.stdin", io.StringIO("1/0\n1\n"))
+
+    exit_code = cli_caller(["-"])
+
+    assert exit_code == 1
+    assert capsys.readouterr().out == "ZeroDivisionError: division by zero\n1\n"
+
+
+def test_cli_csv_files(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    """Test CLI reads multiple files and writes CSV."""
+    (tmp_path / "a.txt").write_text("1+1\n")
+    (tmp_path / "b.txt").write_text("2*3\n")
+
+    cli_caller(["--format", "csv", str(tmp_path / "a.txt"), str(tmp_path / "b.txt")])
+
+    assert capsys.readouterr().out.splitlines() == [
+        "expression,result,error",
+        "1+1,2,",
+        "2*3,6,",
+    ]
+
+
+@pytest.mark.parametrize("workers", ["0", "2"])
+def test_cli_jsonl(
+    workers: str, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test CLI writes JSON Lines with and without worker processes."""
+    monkeypatch.setattr("sys.stdin", io.StringIO("1j*2\n1 @ 1\n"))
+
+    cli_caller(["-f", "jsonl", "-w", workers])
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records[0] == {"expression": "1j*2", "result": "2j", "error": None}
+    assert records[1]["result"] is None
+    assert records[1]["error"].startswith("StringCalculatorError: ")
+
+
+@pytest.mark.parametrize(
+    ("output_format", "expected"),
+    [
+        ("plain", ["ValueError: Exceeds the limit", "2"]),
+        ("csv", ["expression,result,error", "10**5000,,ValueError: Exceeds the limit", "1+1,2,"]),
+        (
+            "jsonl",
+            [
+                '{"expression": "10**5000", "result": null, "error": "ValueError: Exceeds',
+                '{"expression": "1+1", "result": 2, "error": null}',
+            ],
+        ),
+    ],
+)
+def test_cli_result_not_writable(
+    output_format: str,
+    expected: List[str],
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """Test results which cannot be converted to strings are reported as errors."""
+    monkeypatch.setattr("sys.stdin", io.StringIO("10**5000\n1+1\n"))
+
+    exit_code = cli_caller(["-f", output_format])
+
+    lines = capsys.readouterr().out.splitlines()
+    assert exit_code == 1
+    assert [line[: len(start)] for line, start in zip(lines, expected)] == expected
+    assert len(lines) == len(expected)
+
+
+def test_cli_jsonl_safe_numbers(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test non-finite floats and integers beyond doubles are written as strings."""
+    monkeypatch.setattr("sys.stdin", io.StringIO("1e308*10\n2**53\n2**53+1\n1.5\n"))
+
+    cli_caller(["-f", "jsonl"])
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["result"] for line in lines] == ["inf", 2**53, str(2**53 + 1), 1.5]
+
+
+def test_cli_broken_pipe(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test CLI stops quietly when the reader of stdout closes the pipe."""
+
+    class ClosedPipe(io.StringIO):
+        """Stdout of a closed pipe."""
+
+        def write(self, text: str) -> int:
+            raise BrokenPipeError(32, "Broken pipe")
+
+    monkeypatch.setattr("sys.stdin", io.StringIO("1+1\n2+2\n"))
+    monkeypatch.setattr("sys.stdout", ClosedPipe())
+
+    assert cli_caller([]) == 1